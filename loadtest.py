@@ -0,0 +1,704 @@
+"""Офлайн нагрузочный тест бота (без обращения к настоящему Telegram).
+
+Поднимает локальный фейковый Bot API (aiohttp), который записывает вызовы sendMessage,
+editMessageText и т.д., умеет добавлять задержку ответа и отвечать 429. Затем прогоняет
+сценарии пользователей (регистрация, ИТ- и АХО-заявки, принятие, диалог уточнения,
+выполнение) с заданной параллельностью и печатает пропускную способность, перцентили
+задержки по хендлерам и число запросов к БД.
+
+С --bench-pagination вместо сценариев заполняет таблицу requests синтетическими заявками
+(по умолчанию 500 000) и сравнивает время страниц списков "Мои заявки"/"Мои принятые заявки"
+с индексами и без них, а также выборку по ключу (created_at, id) с OFFSET.
+
+С --bench-db-layer сравнивает задержку обработки пачки одновременных апдейтов (создание заявки
+и чтение списка) при синхронной сессии SQLAlchemy внутри хендлеров - как было до перехода на
+aiosqlite - и при AsyncSession бота, а также задержку цикла событий. Базы создаются во временном
+каталоге: чтобы учесть fsync диска сервера, задайте TMPDIR на том же диске, что и bot.db.
+
+Скрипт - регрессионный порог: код выхода 1, если были ошибки сценариев или хендлеров,
+двойное принятие заявки (или, с --auto-assign, принятие не назначенным администратором), страница списка заявок потребовала больше одного запроса к БД,
+состояние FSM какого-либо чата читалось из таблицы fsm_storage больше одного раза
+или p95 какого-либо хендлера выше --max-p95-ms.
+
+Пример:
+    python loadtest.py --users 200 --concurrency 50 --api-latency 30 --rate-429 0.01
+    python loadtest.py --users 50 --accept-race   # гонка одновременного принятия заявки
+    python loadtest.py --users 50 --auto-assign --accept-race   # принять может только назначенный
+    python loadtest.py --users 200 --max-p95-ms 500 --max-errors 0
+    python loadtest.py --bench-pagination --rows 500000
+    python loadtest.py --bench-db-layer --users 200
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+# Настройки бота должны быть заданы до импорта main.py
+_work_dir = tempfile.mkdtemp(prefix="bot_loadtest_")
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_work_dir}/bot.db"
+
+from aiohttp import web  # noqa: E402
+from aiogram import BaseMiddleware, Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update, User as TelegramUser  # noqa: E402
+from sqlalchemy import create_engine, event, func, select, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+import main  # noqa: E402
+
+BOT_ID = 123456
+IT_ADMIN_BASE_ID = 900_000
+AHO_ADMIN_BASE_ID = 950_000
+USER_BASE_ID = 1_000_000
+LIST_PAGE_MAX_QUERIES = 1  # Создатель и исполнитель загружаются вместе с заявками страницы
+ACCEPT_NOTICE = re.compile(r"заявка ID:(\d+) .*принята к исполнению", re.S)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- Фейковый Bot API ---
+class FakeTelegramAPI:
+    """HTTP-сервер, отвечающий как Bot API: записывает вызовы и возвращает правдоподобные ответы."""
+
+    def __init__(self, latency: float, rate_429: float):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.calls = Counter()
+        self.rejected_429 = 0
+        # Сколько раз пользователю сообщили о принятии каждой заявки (больше одного - двойное принятие)
+        self.accept_notices = Counter()
+        self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id, text=None):
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, "text": text}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method not in ("getMe", "answerCallbackQuery") and random.random() < self.rate_429:
+            self.rejected_429 += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        self.calls[method] += 1
+        accepted = ACCEPT_NOTICE.search(params.get("text", "")) if method == "sendMessage" else None
+        if accepted:
+            self.accept_notices[int(accepted.group(1))] += 1
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "LoadTest"}
+        elif method.startswith("send"):
+            result = self._message(params.get("chat_id", 0), params.get("text"))
+        elif method == "editMessageText":
+            result = self._message(params.get("chat_id", 0), params.get("text"))
+        elif method == "copyMessage":
+            result = {"message_id": next(self._message_ids)}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+# --- Сбор статистики ---
+current_handler = contextvars.ContextVar("current_handler", default=None)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Внутренний middleware: время и число запросов к БД для каждого вызова хендлера."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = Counter()
+        self.errors = Counter()
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        token = current_handler.set(name)
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.latencies[name].append(time.perf_counter() - started_at)
+            current_handler.reset(token)
+
+
+# --- Сценарии ---
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.admin_locks = defaultdict(asyncio.Lock)
+        self.timing = HandlerTimingMiddleware()
+        self.total_queries = 0
+        self.fsm_reads = 0  # SELECT из fsm_storage: идут до хендлера, в счетчик хендлеров не попадают
+        self.fsm_writes = 0
+        self.chats = set()
+        self.updates_sent = 0
+        self.failed_journeys = 0
+        self.foreign_accepts = 0  # Автоназначенные заявки, которые принял не исполнитель
+        self.outbox_drain = 0.0
+        self.list_pages = {}
+
+    def _user(self, user_id):
+        return TelegramUser(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+    def _message(self, user_id, text):
+        return Message(message_id=next(self.message_ids), date=datetime.now(),
+                       chat=Chat(id=user_id, type="private"), from_user=self._user(user_id), text=text)
+
+    async def send_text(self, user_id, text):
+        self.chats.add(user_id)
+        await self._feed(Update(update_id=next(self.update_ids), message=self._message(user_id, text)))
+
+    async def press(self, user_id, data):
+        self.chats.add(user_id)
+        callback = CallbackQuery(id=str(next(self.update_ids)), from_user=self._user(user_id), chat_instance="lt",
+                                 data=data, message=self._message(user_id, "..."))
+        await self._feed(Update(update_id=next(self.update_ids), callback_query=callback))
+
+    async def _feed(self, update):
+        self.updates_sent += 1
+        await self.dp.feed_update(self.bot, update)
+
+    async def last_request_id(self, user_id):
+        async with main.SessionLocal() as db:
+            return await db.scalar(select(main.Request.id).where(main.Request.user_id == user_id)
+                                   .order_by(main.Request.id.desc()).limit(1))
+
+    async def assigned_admin_id(self, request_id):
+        async with main.SessionLocal() as db:
+            return await db.scalar(select(main.Request.assigned_admin_id).where(main.Request.id == request_id))
+
+    async def journey(self, index):
+        user_id = USER_BASE_ID + index
+        it_admin = IT_ADMIN_BASE_ID + index % self.args.admins
+        aho_admin = AHO_ADMIN_BASE_ID + index % self.args.admins
+
+        # Регистрация
+        await self.send_text(user_id, "/start")
+        await self.send_text(user_id, f"Пользователь {index}")
+        await self.send_text(user_id, "+7 900 000-00-00")
+        await self.press(user_id, "org_idx_0")
+        await self.send_text(user_id, str(100 + index % 300))
+
+        # ИТ-заявка: принятие, диалог уточнения, выполнение администратором
+        await self.send_text(user_id, "Создать ИТ-заявку")
+        await self.send_text(user_id, f"Не работает принтер (нагрузочный тест {index})")
+        await self.press(user_id, "urgency_asap")
+        request_id = await self.last_request_id(user_id)
+        if main.AUTO_ASSIGN:
+            # Исполнителя выбрал бот; до принятия заявка остается новой
+            it_admin = await self.assigned_admin_id(request_id)
+        if self.args.accept_race:
+            # Все ИТ-администраторы одновременно нажимают "Принять"; дальше работает победитель
+            assignee = it_admin
+            await asyncio.gather(*(self.press(admin_id, f"admin_accept_{request_id}")
+                                   for admin_id in main.IT_ADMIN_IDS))
+            it_admin = await self.assigned_admin_id(request_id)
+            if main.AUTO_ASSIGN and it_admin != assignee:
+                self.foreign_accepts += 1
+        else:
+            await self.press(it_admin, f"admin_accept_{request_id}")
+        # У администратора одновременно может быть только один диалог уточнения
+        async with self.admin_locks[it_admin]:
+            await self.press(it_admin, f"admin_clarify_start_{request_id}")
+            await self.send_text(it_admin, "Уточните модель принтера")
+            await self.send_text(user_id, "HP LaserJet")
+            await self.press(it_admin, f"admin_clarify_end_{request_id}")
+        await self.press(it_admin, f"admin_done_{request_id}")
+
+        # АХО-заявка к дате: принятие и отметка о выполнении пользователем
+        await self.send_text(user_id, "Создать АХО-заявку")
+        await self.send_text(user_id, "Сломан стул")
+        await self.press(user_id, "urgency_date")
+        await self.send_text(user_id, "2030-01-01 10:00")
+        request_id = await self.last_request_id(user_id)
+        if main.AUTO_ASSIGN:
+            aho_admin = await self.assigned_admin_id(request_id)
+        await self.press(aho_admin, f"admin_accept_{request_id}")
+        await self.send_text(user_id, "Мои заявки")
+        await self.press(user_id, f"user_done_{request_id}")
+        await self.send_text(aho_admin, "Мои принятые заявки")
+
+    async def _guarded_journey(self, index, semaphore):
+        async with semaphore:
+            try:
+                await self.journey(index)
+            except Exception as e:
+                self.failed_journeys += 1
+                print(f"Сценарий {index} завершился ошибкой: {e!r}", file=sys.stderr)
+
+    async def wait_outbox_drained(self, timeout=120.0):
+        started_at = time.perf_counter()
+        while time.perf_counter() - started_at < timeout:
+            async with main.SessionLocal() as db:
+                if not await db.scalar(select(func.count()).select_from(main.OutboxMessage)):
+                    break
+            await asyncio.sleep(0.05)
+        return time.perf_counter() - started_at
+
+    async def measure_list_pages(self):
+        """Запросы к БД на первую страницу "Мои заявки" и "Мои принятые заявки" (проверка N+1).
+
+        Считает счетчик main.db_query_metrics; для администратора берется тот, у кого больше всего заявок.
+        """
+        async with main.SessionLocal() as db:
+            admin_id = await db.scalar(
+                select(main.Request.assigned_admin_id).where(main.Request.assigned_admin_id.is_not(None))
+                .group_by(main.Request.assigned_admin_id).order_by(func.count().desc()).limit(1))
+            for owner, owner_id in (("user", USER_BASE_ID), ("admin", admin_id)):
+                queries_before = main.db_query_metrics.queries
+                _, keyboard = await main.build_requests_page(db, owner, owner_id)
+                self.list_pages[owner] = {
+                    # Последний ряд клавиатуры - навигация, остальные - по ряду на заявку
+                    "items": len(keyboard.inline_keyboard) - 1 if keyboard else 0,
+                    "queries": main.db_query_metrics.queries - queries_before,
+                }
+                db.expunge_all()
+
+    async def run(self):
+        args = self.args
+        api = FakeTelegramAPI(args.api_latency / 1000, args.rate_429)
+        api_runner = await api.start("127.0.0.1", args.api_port)
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.api_port}"))
+        self.bot = Bot(token=os.environ["BOT_TOKEN"], session=session)
+
+        if args.auto_assign:
+            main.AUTO_ASSIGN = True
+        main.IT_ADMIN_IDS = [IT_ADMIN_BASE_ID + i for i in range(args.admins)]
+        main.AHO_ADMIN_IDS = [AHO_ADMIN_BASE_ID + i for i in range(args.admins)]
+        main.telegram_limiter = main.TelegramRateLimiter(args.global_rate, args.chat_rate, main.TELEGRAM_CHAT_BURST)
+
+        self.dp = main.create_dispatcher()
+        self.dp.message.middleware(self.timing)
+        self.dp.callback_query.middleware(self.timing)
+
+        @event.listens_for(main.engine.sync_engine, "before_cursor_execute")
+        def count_query(_connection, _cursor, statement, *_):
+            self.total_queries += 1
+            if "fsm_storage" in statement:
+                # Чтение состояния одного ключа; подсчет размера хранилища для метрик не учитываем
+                if statement.startswith("SELECT fsm_storage."):
+                    self.fsm_reads += 1
+                elif not statement.startswith("SELECT"):
+                    self.fsm_writes += 1
+            name = current_handler.get()
+            if name:
+                self.timing.queries[name] += 1
+
+        await main.init_db()
+        await self.dp.emit_startup(bot=self.bot, dispatcher=self.dp)
+        self.total_queries = 0
+        self.fsm_reads = self.fsm_writes = 0
+        self.timing.queries.clear()
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        started_at = time.perf_counter()
+        await asyncio.gather(*(self._guarded_journey(i, semaphore) for i in range(args.users)))
+        elapsed = time.perf_counter() - started_at
+        # Уведомления отправляются из outbox фоном: ждем, пока очередь опустеет
+        self.outbox_drain = await self.wait_outbox_drained()
+        await self.measure_list_pages()
+
+        await self.dp.emit_shutdown(bot=self.bot, dispatcher=self.dp)
+        await self.bot.session.close()
+        await api_runner.cleanup()
+        await main.engine.dispose()
+        return self.report(elapsed, api)
+
+    def report(self, elapsed, api):
+        handlers = {}
+        for name, values in sorted(self.timing.latencies.items()):
+            handlers[name] = {
+                "calls": len(values),
+                "errors": self.timing.errors[name],
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "db_queries_per_call": round(self.timing.queries[name] / len(values), 2),
+            }
+        return {
+            "users": self.args.users,
+            "concurrency": self.args.concurrency,
+            "auto_assign": main.AUTO_ASSIGN,
+            "failed_journeys": self.failed_journeys,
+            "elapsed_s": round(elapsed, 3),
+            "outbox_drain_s": round(self.outbox_drain, 3),
+            "journeys_per_s": round(self.args.users / elapsed, 2),
+            "updates_per_s": round(self.updates_sent / elapsed, 2),
+            "db_queries_total": self.total_queries,
+            "db_queries_outside_handlers": self.total_queries - sum(self.timing.queries.values()),
+            "fsm_storage_queries": {
+                "reads": self.fsm_reads,
+                "writes": self.fsm_writes,
+                "chats": len(self.chats),
+                "reads_per_update": round(self.fsm_reads / max(self.updates_sent, 1), 3),
+            },
+            "api_calls": dict(api.calls),
+            "api_429_injected": api.rejected_429,
+            "double_accepts": sum(1 for count in api.accept_notices.values() if count > 1),
+            "foreign_accepts": self.foreign_accepts,
+            "list_page_queries": self.list_pages,
+            "handlers": handlers,
+        }
+
+
+# --- Бенчмарк постраничных списков ---
+BENCH_ADMIN_IDS = (IT_ADMIN_BASE_ID, IT_ADMIN_BASE_ID + 1, IT_ADMIN_BASE_ID + 2)
+BENCH_USERS = 2000
+BENCH_OPEN_REQUESTS = 3000  # Самые новые заявки не выполнены, остальные выполнены в прошлом
+LIST_INDEXES = ("ix_requests_user_status", "ix_requests_admin_status",
+                "ix_requests_user_created", "ix_requests_admin_created")
+
+
+async def fill_requests(rows: int, chunk: int = 10000):
+    """Заполняет пустую БД пользователями и rows заявками; заявке i соответствует created_at = now - i минут."""
+    now = datetime.now()
+    async with main.SessionLocal() as db:
+        await db.execute(main.User.__table__.insert(), [
+            {"id": USER_BASE_ID + i, "full_name": f"user{i}", "organization": main.PREDEFINED_ORGANIZATIONS[0],
+             "phone_number": "+7 900 000-00-00", "registered": True} for i in range(BENCH_USERS)])
+        for start in range(0, rows, chunk):
+            batch = []
+            for i in range(start, min(start + chunk, rows)):
+                created_at = now - timedelta(minutes=i)
+                done = i >= BENCH_OPEN_REQUESTS
+                batch.append({
+                    "user_id": USER_BASE_ID + i % BENCH_USERS, "request_type": "IT",
+                    "description": f"Синтетическая заявка {i}", "urgency": "ASAP",
+                    "status": main.RequestStatus.DONE if done else main.OPEN_STATUSES[i % 3],
+                    "assigned_admin_id": BENCH_ADMIN_IDS[i % len(BENCH_ADMIN_IDS)],
+                    "created_at": created_at, "completed_at": created_at + timedelta(hours=3) if done else None})
+            await db.execute(main.Request.__table__.insert(), batch)
+        await db.commit()
+        await db.execute(text("ANALYZE"))
+
+
+async def timed(coro_factory, repeat: int) -> float:
+    """Медиана времени выполнения, мс."""
+    samples = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        await coro_factory()
+        samples.append(time.perf_counter() - started_at)
+    return round(percentile(samples, 0.5) * 1000, 2)
+
+
+async def bench_page_queries(repeat: int) -> dict:
+    admin_id, user_id = BENCH_ADMIN_IDS[0], USER_BASE_ID
+    async with main.SessionLocal() as db:
+        # Курсор последней страницы списка администратора - проходим список целиком по кнопке "Старее"
+        pages, cursor = 1, None
+        requests, _, has_older = await main.fetch_requests_page(db, "admin", admin_id)
+        while has_older:
+            cursor = main._page_cursor(requests[-1])
+            requests, _, has_older = await main.fetch_requests_page(db, "admin", admin_id, "next", cursor)
+            pages += 1
+        two_days_ago = datetime.now() - timedelta(days=2)
+        # Та же выборка, что и у страницы по ключу, но последняя страница ищется через OFFSET
+        recent = main.recent_owner_requests(main.Request.assigned_admin_id, admin_id, two_days_ago)
+        page_ids = (select(recent.c.id).order_by(recent.c.created_at.desc(), recent.c.id.desc())
+                    .offset((pages - 1) * main.REQUESTS_PAGE_SIZE).limit(main.REQUESTS_PAGE_SIZE + 1))
+        offset_query = select(main.Request).where(main.Request.id.in_(page_ids))
+
+        async def run_page(owner, owner_id, direction="first", page_cursor=None):
+            await main.fetch_requests_page(db, owner, owner_id, direction, page_cursor)
+            db.expunge_all()
+
+        async def run_offset():
+            (await db.scalars(offset_query)).all()
+            db.expunge_all()
+
+        return {
+            "pages": pages,
+            "user_first_ms": await timed(lambda: run_page("user", user_id), repeat),
+            "admin_first_ms": await timed(lambda: run_page("admin", admin_id), repeat),
+            "admin_last_keyset_ms": await timed(lambda: run_page("admin", admin_id, "next", cursor), repeat),
+            "admin_last_offset_ms": await timed(run_offset, repeat),
+        }
+
+
+async def bench_pagination(args) -> dict:
+    await main.init_db()
+    started_at = time.perf_counter()
+    await fill_requests(args.rows)
+    fill_seconds = time.perf_counter() - started_at
+    with_indexes = await bench_page_queries(args.repeat)
+    async with main.SessionLocal() as db:
+        for name in LIST_INDEXES:
+            await db.execute(text(f"DROP INDEX {name}"))
+        await db.commit()
+    without_indexes = await bench_page_queries(args.repeat)
+    await main.engine.dispose()
+    return {"rows": args.rows, "fill_s": round(fill_seconds, 1), "pages": with_indexes.pop("pages"),
+            "with_indexes": with_indexes, "without_indexes": without_indexes}
+
+
+def print_pagination_report(report):
+    print(f"Заявок: {report['rows']} (заполнение {report['fill_s']} с), "
+          f"страниц в списке администратора: {report['pages']}")
+    cases = {"user_first_ms": "Мои заявки: первая страница",
+             "admin_first_ms": "Мои принятые заявки: первая страница",
+             "admin_last_keyset_ms": "Мои принятые заявки: последняя, по ключу",
+             "admin_last_offset_ms": "Мои принятые заявки: последняя, OFFSET"}
+    print(f"{'запрос (медиана, мс)':<45}{'с индексами':>14}{'без индексов':>14}")
+    for key, title in cases.items():
+        print(f"{title:<45}{report['with_indexes'][key]:>14}{report['without_indexes'][key]:>14}")
+
+
+# --- Бенчмарк слоя БД: синхронная сессия против AsyncSession ---
+BURST_SECONDS = 1.0  # Апдейты пачки приходят равномерно за это время
+LOOP_PROBE_INTERVAL = 0.001  # Период проверки задержки цикла событий, секунды
+
+
+def _bench_request(user_id: int) -> "main.Request":
+    return main.Request(user_id=user_id, request_type="IT", description="Не работает принтер", urgency="ASAP",
+                        status=main.RequestStatus.NEW, created_at=datetime.now())
+
+
+def _bench_list_query(user_id: int):
+    return (select(main.Request).where(main.Request.user_id == user_id)
+            .order_by(main.Request.created_at.desc(), main.Request.id.desc()).limit(main.REQUESTS_PAGE_SIZE + 1))
+
+
+def sync_db_handlers(path: str, wal: bool):
+    """Хендлеры в старом стиле: синхронная сессия прямо в async def блокирует цикл событий."""
+    sync_engine = create_engine(f"sqlite:///{path}")
+    if wal:
+        @event.listens_for(sync_engine, "connect")
+        def set_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+    main.Base.metadata.create_all(sync_engine)
+    session_factory = sessionmaker(sync_engine)
+
+    async def create(user_id):
+        with session_factory() as db:
+            db.add(_bench_request(user_id))
+            db.commit()
+
+    async def read(user_id):
+        with session_factory() as db:
+            db.scalars(_bench_list_query(user_id)).all()
+
+    return create, read, sync_engine.dispose
+
+
+async def async_db_handlers():
+    """Хендлеры бота: AsyncSession поверх aiosqlite (WAL, synchronous=NORMAL)."""
+    await main.init_db()
+
+    async def create(user_id):
+        async with main.SessionLocal() as db:
+            db.add(_bench_request(user_id))
+            await db.commit()
+
+    async def read(user_id):
+        async with main.SessionLocal() as db:
+            (await db.scalars(_bench_list_query(user_id))).all()
+
+    return create, read, main.engine.dispose
+
+
+async def run_burst(create, read, updates: int, api_latency: float) -> dict:
+    """Задержка апдейтов от момента прихода до ответа; четные - создание заявки, нечетные - чтение списка.
+
+    После работы с БД каждый хендлер ждет ответа Bot API (api_latency), как настоящие хендлеры.
+    loop_lag - насколько позже срока просыпалась фоновая задача: столько ждали все чаты,
+    в том числе не обращающиеся к БД.
+    """
+    latencies = defaultdict(list)
+    lags = []
+    finished = asyncio.Event()
+
+    async def probe_loop():
+        while not finished.is_set():
+            expected = time.perf_counter() + LOOP_PROBE_INTERVAL
+            await asyncio.sleep(LOOP_PROBE_INTERVAL)
+            lags.append(max(0.0, time.perf_counter() - expected))
+
+    probe = asyncio.create_task(probe_loop())
+    started_at = time.perf_counter()
+
+    async def handle(index):
+        arrival = started_at + BURST_SECONDS * index / updates
+        await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+        kind = "create" if index % 2 == 0 else "read"
+        await (create if kind == "create" else read)(USER_BASE_ID + index % 20)
+        await asyncio.sleep(api_latency)
+        latencies[kind].append(time.perf_counter() - arrival)
+
+    await asyncio.gather(*(handle(i) for i in range(updates)))
+    finished.set()
+    await probe
+    result = {f"{kind}_{name}_ms": round(percentile(values, q) * 1000, 2)
+              for kind, values in sorted(latencies.items()) for name, q in (("p50", 0.50), ("p99", 0.99))}
+    result["loop_lag_p99_ms"] = round(percentile(lags, 0.99) * 1000, 2)
+    result["loop_lag_max_ms"] = round(max(lags, default=0.0) * 1000, 2)
+    return result
+
+
+async def bench_db_layer(args) -> dict:
+    variants = {}
+    for name, handlers in (("sync", lambda: sync_db_handlers(f"{_work_dir}/sync.db", wal=False)),
+                           ("sync_wal", lambda: sync_db_handlers(f"{_work_dir}/sync_wal.db", wal=True))):
+        create, read, dispose = handlers()
+        variants[name] = await run_burst(create, read, args.users, args.api_latency / 1000)
+        dispose()
+    create, read, dispose = await async_db_handlers()
+    variants["async"] = await run_burst(create, read, args.users, args.api_latency / 1000)
+    await dispose()
+    return {"updates": args.users, "burst_s": BURST_SECONDS, "variants": variants}
+
+
+def print_db_layer_report(report):
+    print(f"Апдейтов: {report['updates']} за {report['burst_s']} с "
+          f"(поровну создание заявки и чтение списка), задержка от прихода до ответа, мс")
+    titles = {"sync": "до: синхронная сессия", "sync_wal": "синхронная сессия + WAL",
+              "async": "после: AsyncSession + WAL"}
+    columns = list(next(iter(report["variants"].values())))
+    print(f"{'вариант':<30}" + "".join(f"{column[:-3]:>14}" for column in columns))
+    for name, stats in report["variants"].items():
+        print(f"{titles[name]:<30}" + "".join(f"{stats[column]:>14}" for column in columns))
+
+
+def check_report(report, args) -> list:
+    """Нарушенные пороги прогона (пустой список - прогон успешен)."""
+    violations = []
+    errors = report["failed_journeys"] + sum(stats["errors"] for stats in report["handlers"].values())
+    if errors > args.max_errors:
+        violations.append(f"ошибок сценариев и хендлеров: {errors} (допустимо {args.max_errors})")
+    if report["double_accepts"]:
+        violations.append(f"заявок, принятых больше одного раза: {report['double_accepts']}")
+    if report["foreign_accepts"]:
+        violations.append(f"автоназначенных заявок, принятых не исполнителем: {report['foreign_accepts']}")
+    for owner, page in report["list_page_queries"].items():
+        if page["queries"] > LIST_PAGE_MAX_QUERIES:
+            violations.append(f"запросов к БД на страницу списка ({owner}, заявок {page['items']}): "
+                              f"{page['queries']} (допустимо {LIST_PAGE_MAX_QUERIES})")
+    fsm = report["fsm_storage_queries"]
+    if fsm["reads"] > fsm["chats"]:
+        # Кэш SQLiteStorage помнит и отсутствие записи, поэтому каждый чат читается из таблицы не больше раза
+        violations.append(f"чтений fsm_storage: {fsm['reads']} на {fsm['chats']} чатов (допустимо не больше "
+                          f"одного на чат)")
+    if args.max_p95_ms is not None:
+        for name, stats in report["handlers"].items():
+            if stats["p95_ms"] > args.max_p95_ms:
+                violations.append(f"p95 хендлера {name}: {stats['p95_ms']} мс (допустимо {args.max_p95_ms} мс)")
+    return violations
+
+
+def print_report(report):
+    print(f"Сценариев: {report['users']} (ошибок: {report['failed_journeys']}), "
+          f"параллельность: {report['concurrency']}, время: {report['elapsed_s']} с"
+          f"{', автоназначение' if report['auto_assign'] else ''}")
+    print(f"Доставка оставшихся уведомлений из outbox после сценариев: {report['outbox_drain_s']} с")
+    print(f"Пропускная способность: {report['journeys_per_s']} сценариев/с, {report['updates_per_s']} апдейтов/с")
+    print(f"Запросов к БД: {report['db_queries_total']}, ответов 429 от фейкового API: {report['api_429_injected']}")
+    fsm = report["fsm_storage_queries"]
+    print(f"Запросов к БД вне хендлеров: {report['db_queries_outside_handlers']}, из них fsm_storage: "
+          f"чтений {fsm['reads']} ({fsm['reads_per_update']} на апдейт, чатов {fsm['chats']}), "
+          f"записей {fsm['writes']}")
+    print(f"Заявок, принятых больше одного раза: {report['double_accepts']}, "
+          f"принятых не назначенным исполнителем: {report['foreign_accepts']}")
+    print("Запросов к БД на страницу списка: " + ", ".join(
+        f"{owner}={page['queries']} (заявок {page['items']})" for owner, page in report["list_page_queries"].items()))
+    print("Вызовы Bot API: " + ", ".join(f"{k}={v}" for k, v in sorted(report["api_calls"].items())))
+    print(f"{'хендлер':<40}{'вызовы':>8}{'ошибки':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'БД/вызов':>10}")
+    for name, stats in report["handlers"].items():
+        print(f"{name:<40}{stats['calls']:>8}{stats['errors']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['db_queries_per_call']:>10}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест бота с фейковым Bot API")
+    parser.add_argument("--users", type=int, default=100, help="сколько пользовательских сценариев прогнать")
+    parser.add_argument("--concurrency", type=int, default=20, help="сколько сценариев выполняется одновременно")
+    parser.add_argument("--admins", type=int, default=10, help="число ИТ- и АХО-администраторов")
+    parser.add_argument("--api-latency", type=float, default=20.0, help="задержка ответа фейкового API, мс")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--api-port", type=int, default=8081, help="порт фейкового Bot API")
+    # По умолчанию лимиты бота на отправку фактически сняты: фейковый API их не проверяет, и иначе
+    # время прогона определяется лимитом 1 сообщение/с в чат администратора, а не кодом бота.
+    # Для проверки с реальными лимитами Telegram: --global-rate 30 --chat-rate 1
+    parser.add_argument("--global-rate", type=float, default=10000,
+                        help="глобальный лимит отправки, сообщений/с")
+    parser.add_argument("--chat-rate", type=float, default=10000,
+                        help="лимит отправки в один чат, сообщений/с")
+    parser.add_argument("--accept-race", action="store_true",
+                        help="все ИТ-администраторы одновременно принимают каждую ИТ-заявку")
+    parser.add_argument("--auto-assign", action="store_true",
+                        help="включить автоназначение (как AUTO_ASSIGN=1): заявку принимает назначенный исполнитель")
+    parser.add_argument("--bench-pagination", action="store_true",
+                        help="вместо сценариев измерить время страниц списков на синтетической таблице")
+    parser.add_argument("--bench-db-layer", action="store_true",
+                        help="вместо сценариев сравнить синхронную сессию БД в хендлерах с AsyncSession "
+                             "на пачке из --users апдейтов")
+    parser.add_argument("--rows", type=int, default=500_000, help="число синтетических заявок для --bench-pagination")
+    parser.add_argument("--repeat", type=int, default=20, help="повторов каждого запроса в --bench-pagination")
+    parser.add_argument("--json", help="сохранить отчет в JSON-файл (для сравнения между версиями)")
+    parser.add_argument("--max-p95-ms", type=float,
+                        help="порог p95 задержки любого хендлера, мс; превышение - код выхода 1")
+    parser.add_argument("--max-errors", type=int, default=0,
+                        help="допустимое число ошибок сценариев и хендлеров; превышение - код выхода 1")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    try:
+        if arguments.bench_pagination:
+            result = asyncio.run(bench_pagination(arguments))
+        elif arguments.bench_db_layer:
+            result = asyncio.run(bench_db_layer(arguments))
+        else:
+            result = asyncio.run(LoadTest(arguments).run())
+    finally:
+        shutil.rmtree(_work_dir, ignore_errors=True)
+    if arguments.bench_pagination:
+        print_pagination_report(result)
+        problems = []
+    elif arguments.bench_db_layer:
+        print_db_layer_report(result)
+        problems = []
+    else:
+        print_report(result)
+        problems = check_report(result, arguments)
+    if arguments.json:
+        with open(arguments.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    for problem in problems:
+        print(f"ПОРОГ НАРУШЕН: {problem}", file=sys.stderr)
+    sys.exit(1 if problems else 0)
@@ -1,18 +1,39 @@
 import asyncio
+import contextvars
+import csv
+import heapq
+import io
+import json
 import logging
+import re
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart, StateFilter
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiohttp import web
+from aiogram.filters import Command, CommandObject, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from aiogram.types import BufferedInputFile, FSInputFile, TelegramObject, Update, Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Index, TypeDecorator, bindparam, column, delete, event, exists, func, insert, literal, literal_column, select, table, text, tuple_, union_all, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, aliased, declarative_base, joinedload, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import UnaryExpression
 from dotenv import load_dotenv
 import os
-from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
@@ -38,16 +59,126 @@ ORGANIZATIONS_NEEDING_OFFICE_NUMBER = set([
     "ОКУ «Центра бухгалтерского учета» г.Липецк"
 ])
 
+# Хранилище состояний FSM: 'sqlite' (таблица в bot.db), 'redis' (несколько процессов бота) или 'memory'.
+# Для 'redis' нужен пакет redis, его нет в requirements.txt: pip install redis
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+FSM_FLUSH_INTERVAL = 0.2  # Окно группировки записей FSM в SQLite, секунды
+FSM_CACHE_SIZE = 10000  # Сколько ключей FSM SQLiteStorage держит в памяти
+
+# Диалог уточнения, в котором никто не пишет дольше таймаута, завершается автоматически (0 - никогда)
+DIALOGUE_IDLE_TIMEOUT = int(os.getenv("DIALOGUE_IDLE_TIMEOUT", "3600"))  # Секунды
+DIALOGUE_SWEEP_INTERVAL = 60  # Как часто искать простаивающие диалоги, секунды
+MESSAGE_LOG_FLUSH_INTERVAL = 1.0  # Окно группировки записей истории переписки, секунды
+MAX_REQUEST_ATTACHMENTS = 10  # Максимум вложений при создании заявки
+
+# Кэш профилей пользователей (ФИО, роль, флаг регистрации) в памяти процесса
+USER_CACHE_SIZE = 10000  # Максимум пользователей в кэше
+USER_CACHE_TTL = 300  # Время жизни записи, секунды
+
+# Способ получения апдейтов: 'polling' (long polling) или 'webhook' (HTTP-сервер aiohttp за обратным прокси)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес вебхука, например https://bot.example.org/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))  # Максимум апдейтов в очереди
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))  # Сколько апдейтов обрабатывается одновременно
+
+# Очередь исходящих уведомлений (таблица outbox), которую разбирают фоновые воркеры
+OUTBOX_WORKERS = 8  # Сколько чатов обслуживается одновременно
+OUTBOX_BATCH_SIZE = 100  # Сколько сообщений выбирается из таблицы за один проход
+OUTBOX_POLL_INTERVAL = 1.0  # Как часто проверять отложенные повторы, секунды
+OUTBOX_MAX_ATTEMPTS = 8  # После стольких неудачных попыток сообщение удаляется из очереди
+OUTBOX_MAX_BACKOFF = 300  # Максимальная пауза между попытками, секунды
+
+# Контроль сроков заявок: напоминание о сроке и эскалация срочных заявок, которые никто не принял
+SLA_REMINDER_BEFORE = int(os.getenv("SLA_REMINDER_BEFORE", "3600"))  # За сколько секунд до срока напоминать
+SLA_ESCALATION_DELAY = int(os.getenv("SLA_ESCALATION_DELAY", "1800"))  # Через сколько секунд эскалировать (0 - нет)
+
+# Автоназначение (AUTO_ASSIGN=1): новая заявка сразу назначается наименее загруженному администратору
+# ее типа, и уведомление получает только он. Заявка остается новой, пока исполнитель ее не примет;
+# принять ее может только он. По умолчанию заявка рассылается всем администраторам типа
+AUTO_ASSIGN = os.getenv("AUTO_ASSIGN", "0") == "1"
+
+# Формат желаемой даты выполнения заявки (поле due_date)
+DUE_DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+# Архив: заявки, выполненные раньше чем ARCHIVE_AFTER_DAYS дней назад, переносятся в requests_archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = 3600  # Как часто запускать перенос, секунды
+ARCHIVE_BATCH_SIZE = 500  # Заявок в одной транзакции переноса
+
+# Границы гистограмм времени принятия и выполнения заявок, секунды
+STATS_LATENCY_BUCKETS = (900, 3600, 4 * 3600, 8 * 3600, 86400, 3 * 86400, 7 * 86400)
+
+# Выгрузка заявок (/export)
+EXPORT_CHUNK_SIZE = 200  # Строк, читаемых из БД (одной короткой транзакцией) и записываемых в файл за раз
+EXPORT_DEFAULT_DAYS = 30
+EXPORT_MAX_FILE_SIZE = 49 * 1024 * 1024  # Лимит Telegram на отправку файла ботом - 50 МБ
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0 отключает сервер)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Настройка базы данных SQLAlchemy ---
-DATABASE_URL = "sqlite:///./bot.db"
-engine = create_engine(DATABASE_URL)
+# Асинхронный движок (aiosqlite): запросы к SQLite не блокируют цикл событий,
+# пока диспетчер обслуживает другие чаты
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot.db")
+engine = create_async_engine(DATABASE_URL)
 Base = declarative_base()
 
 
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL позволяет читать во время записи, а synchronous=NORMAL убирает fsync на каждый коммит
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+# --- Статусы заявок ---
+# В БД статус хранится целым кодом; русские названия используются только при выводе пользователям
+class RequestStatus(IntEnum):
+    NEW = 1  # Принято: ждет администратора
+    IN_PROGRESS = 2  # Принято к исполнению
+    CLARIFICATION = 3  # Идет диалог уточнения
+    DONE = 4  # Выполнено
+
+    @property
+    def label(self) -> str:
+        return REQUEST_STATUS_LABELS[self]
+
+
+REQUEST_STATUS_LABELS = {
+    RequestStatus.NEW: "Принято",
+    RequestStatus.IN_PROGRESS: "Принято к исполнению",
+    RequestStatus.CLARIFICATION: "Уточнение",
+    RequestStatus.DONE: "Выполнено",
+}
+
+# Статусы незавершенных заявок
+OPEN_STATUSES = (RequestStatus.NEW, RequestStatus.IN_PROGRESS, RequestStatus.CLARIFICATION)
+
+
+class RequestStatusType(TypeDecorator):
+    """Колонка статуса: INTEGER в БД, RequestStatus в Python."""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else RequestStatus(value)
+
+
 # Модели базы данных
 class User(Base):
     __tablename__ = 'users'
@@ -73,39 +204,1616 @@ class Request(Base):
     description = Column(String)
     urgency = Column(String)  # 'ASAP' (Как можно скорее), 'DATE' (Указать дату)
     due_date = Column(String, nullable=True)  # Желаемая дата выполнения (если выбрана 'DATE')
-    status = Column(String, default='Принято')  # 'Принято', 'Принято к исполнению', 'Выполнено', 'Уточнение'
+    status = Column(RequestStatusType, default=RequestStatus.NEW)  # Код RequestStatus
     assigned_admin_id = Column(Integer, nullable=True)  # ID администратора, принявшего заявку
     created_at = Column(DateTime, default=datetime.now)  # Дата и время создания заявки
     completed_at = Column(DateTime, nullable=True)  # Дата и время выполнения заявки
-    admin_message_id = Column(Integer, nullable=True)  # ID сообщения администратору для обновления
+    accepted_at = Column(DateTime, nullable=True)  # Когда администратор впервые взял заявку в работу
+    reminder_sent_at = Column(DateTime, nullable=True)  # Когда отправлено напоминание о сроке
+    escalated_at = Column(DateTime, nullable=True)  # Когда непринятая срочная заявка эскалирована
+    # ID сообщений администраторам хранятся в таблице request_notifications
+    # (старая колонка admin_message_id в существующих БД больше не используется)
+
+    # Индексы под списки "Мои заявки"/"Мои принятые заявки": владелец + статус + дата выполнения,
+    # а также владелец + (created_at, id) для постраничного вывода
+    __table_args__ = (
+        Index('ix_requests_user_status', 'user_id', 'status', 'completed_at'),
+        Index('ix_requests_admin_status', 'assigned_admin_id', 'status', 'completed_at'),
+        Index('ix_requests_user_created', 'user_id', 'created_at', 'id'),
+        Index('ix_requests_admin_created', 'assigned_admin_id', 'created_at', 'id'),
+        Index('ix_requests_status_completed', 'status', 'completed_at'),  # Выборка для архиватора
+    )
 
     creator = relationship("User", back_populates="requests")
+    # Администратор-исполнитель; внешнего ключа в схеме нет, поэтому связь только для чтения
+    assignee = relationship("User", primaryjoin="foreign(Request.assigned_admin_id) == User.id", viewonly=True)
+
+    def __repr__(self):
+        return f"<Request(id={self.id}, type='{self.request_type}', status={self.status!r})>"
+
+
+class ArchivedRequest(Base):
+    # Выполненная заявка, перенесенная из requests архиватором. Колонки те же, что у Request,
+    # ID сохраняется - на него по-прежнему ссылаются история переписки, вложения и поиск
+    __tablename__ = 'requests_archive'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    request_type = Column(String)
+    description = Column(String)
+    urgency = Column(String)
+    due_date = Column(String, nullable=True)
+    status = Column(RequestStatusType)
+    assigned_admin_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime)
+    completed_at = Column(DateTime, nullable=True)
+    accepted_at = Column(DateTime, nullable=True)
+    reminder_sent_at = Column(DateTime, nullable=True)
+    escalated_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_requests_archive_user_created', 'user_id', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f"<ArchivedRequest(id={self.id}, type='{self.request_type}')>"
+
+
+def all_requests_subquery(conditions=None):
+    """Оперативные и архивные заявки одним подзапросом (колонки Request) - для поиска и отчетов.
+
+    conditions(table) - условия отбора, которые ставятся в каждую ветку UNION отдельно: так строки
+    отбираются при чтении каждой таблицы, а не после объединения обеих целиком.
+    """
+    live, archive = Request.__table__, ArchivedRequest.__table__
+    return union_all(
+        select(live).where(*(conditions(live) if conditions else ())),
+        select(*(archive.c[c.name] for c in live.c)).where(*(conditions(archive) if conditions else ()))
+    ).subquery("all_requests")
+
+
+class RequestStatsDaily(Base):
+    # Счетчики заявок за день в разрезе тип x организация x исполнитель. Обновляются при создании
+    # заявки и переходах статуса, поэтому отчету не нужно читать саму таблицу requests
+    __tablename__ = 'request_stats_daily'
+    day = Column(String, primary_key=True)  # 'ГГГГ-ММ-ДД' дня события
+    request_type = Column(String, primary_key=True)
+    organization = Column(String, primary_key=True)
+    admin_id = Column(Integer, primary_key=True)  # Исполнитель, 0 - не назначен
+    created = Column(Integer, default=0, nullable=False)
+    accepted = Column(Integer, default=0, nullable=False)
+    completed = Column(Integer, default=0, nullable=False)
+    accept_seconds = Column(Integer, default=0, nullable=False)  # Сумма времени от создания до принятия
+    complete_seconds = Column(Integer, default=0, nullable=False)  # Сумма времени от создания до выполнения
 
     def __repr__(self):
-        return f"<Request(id={self.id}, type='{self.request_type}', status='{self.status}')>"
+        return f"<RequestStatsDaily(day='{self.day}', type='{self.request_type}', admin_id={self.admin_id})>"
+
+
+class RequestLatencyBucket(Base):
+    # Гистограмма времени принятия/выполнения в тех же разрезах, что и RequestStatsDaily
+    __tablename__ = 'request_latency_buckets'
+    day = Column(String, primary_key=True)
+    request_type = Column(String, primary_key=True)
+    organization = Column(String, primary_key=True)
+    admin_id = Column(Integer, primary_key=True)
+    event = Column(String, primary_key=True)  # 'accepted' или 'completed'
+    le_seconds = Column(Integer, primary_key=True)  # Граница из STATS_LATENCY_BUCKETS, -1 - больше последней
+    count = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<RequestLatencyBucket(day='{self.day}', event='{self.event}', le={self.le_seconds})>"
+
+
+class RequestNotification(Base):
+    # Копия уведомления о заявке, отправленная конкретному администратору
+    __tablename__ = 'request_notifications'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    admin_chat_id = Column(Integer, nullable=False)  # Чат администратора (совпадает с его ID Telegram)
+    message_id = Column(Integer, nullable=False)  # ID сообщения в этом чате
+
+    __table_args__ = (
+        Index('ix_request_notifications_request', 'request_id'),
+    )
+
+    def __repr__(self):
+        return f"<RequestNotification(request_id={self.request_id}, admin_chat_id={self.admin_chat_id})>"
+
+
+class RequestMessage(Base):
+    # Сообщение, пересланное в диалоге уточнения по заявке (история переписки)
+    __tablename__ = 'request_messages'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    sender_id = Column(Integer, nullable=False)  # Telegram ID отправителя
+    recipient_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        Index('ix_request_messages_request', 'request_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f"<RequestMessage(id={self.id}, request_id={self.request_id}, sender_id={self.sender_id})>"
+
+
+class RequestAttachment(Base):
+    # Вложение к заявке или к диалогу уточнения. Сам файл остается на серверах Telegram:
+    # хранится только file_id, по которому файл отправляется повторно без скачивания
+    __tablename__ = 'request_attachments'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    request_id = Column(Integer, ForeignKey('requests.id'), nullable=False)
+    sender_id = Column(Integer, nullable=False)  # Telegram ID отправителя
+    kind = Column(String, nullable=False)  # 'photo', 'document', 'voice', 'video', 'audio'
+    file_id = Column(String, nullable=False)
+    file_unique_id = Column(String, nullable=False)
+    file_name = Column(String, nullable=True)
+    file_size = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        Index('ix_request_attachments_request', 'request_id'),
+    )
+
+    def __repr__(self):
+        return f"<RequestAttachment(id={self.id}, request_id={self.request_id}, kind='{self.kind}')>"
+
+
+class FSMRecord(Base):
+    # Состояние и данные FSM одного чата (используется SQLiteStorage)
+    __tablename__ = 'fsm_storage'
+    key = Column(String, primary_key=True)  # Ключ вида fsm:<bot_id>:<chat_id>:<user_id>:<destiny>
+    state = Column(String, nullable=True)
+    data = Column(String, nullable=True)  # JSON
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self):
+        return f"<FSMRecord(key='{self.key}', state='{self.state}')>"
+
+
+class OutboxMessage(Base):
+    # Уведомление, ожидающее отправки. Пишется в той же транзакции, что и изменение заявки,
+    # поэтому не теряется ни при ошибке Telegram, ни при перезапуске бота
+    __tablename__ = 'outbox'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Integer, nullable=False)
+    method = Column(String, nullable=False)  # Метод Bot, например 'send_message' или 'edit_message_text'
+    payload = Column(String, nullable=False)  # JSON с аргументами метода
+    # Для уведомлений о новой заявке: после отправки сохраняется RequestNotification
+    request_id = Column(Integer, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.now, nullable=False)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        Index('ix_outbox_next_attempt', 'next_attempt_at'),
+        Index('ix_outbox_chat', 'chat_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, chat_id={self.chat_id}, method='{self.method}')>"
 
 
 class Admin(Base):
     __tablename__ = 'admins'
-    id = Column(Integer, primary_key=True, unique=True)  # ID администратора Telegram
-    admin_type = Column(String)  # 'IT_ADMIN', 'AHO_ADMIN'
+    # Составной ключ: один и тот же человек может быть одновременно ИТ- и АХО-администратором
+    id = Column(Integer, primary_key=True)  # ID администратора Telegram
+    admin_type = Column(String, primary_key=True)  # 'IT_ADMIN', 'AHO_ADMIN'
 
     def __repr__(self):
         return f"<Admin(id={self.id}, type='{self.admin_type}')>"
 
 
-# Создание таблиц в базе данных
-Base.metadata.create_all(engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: после коммита атрибуты объектов остаются доступны без повторного запроса
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+async def transition_request(db_session: AsyncSession, request_id: int, from_statuses: tuple,
+                             to_status: RequestStatus,
+                             *conditions, **values) -> Optional[Request]:
+    """Переводит заявку в статус to_status одним условным UPDATE ... RETURNING.
+
+    Строка меняется, только если заявка сейчас в одном из from_statuses и выполнены
+    дополнительные условия, поэтому из одновременных попыток (например, два администратора
+    нажали "Принять") выигрывает ровно одна. Возвращает обновленную заявку или None, если
+    переход выполнил кто-то другой. Загруженный ранее объект Request обновляется из RETURNING,
+    но его связи (creator) сбрасываются - нужные значения сохраните до вызова.
+    UPDATE берет блокировку записи SQLite, поэтому после него транзакцию нужно быстро
+    завершить: при неудаче - сразу rollback. Хендлеры вызывают его через apply_transition.
+    """
+    return await db_session.scalar(
+        update(Request)
+        .where(Request.id == request_id, Request.status.in_(from_statuses), *conditions)
+        .values(status=to_status, **values)
+        .returning(Request)
+        .execution_options(synchronize_session=False, populate_existing=True))
+
+
+# --- Миграции схемы БД ---
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется один раз
+# и должна быть идемпотентной: в новой БД первая миграция сразу создает таблицы в актуальном виде.
+def _migration_initial(connection):
+    Base.metadata.create_all(connection)
+
+
+def _migration_requests_indexes(connection):
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_requests_user_status ON requests (user_id, status, completed_at)")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_requests_admin_status ON requests (assigned_admin_id, status, completed_at)")
+
+
+def _migration_request_notifications(connection):
+    # Старые admin_message_id не переносятся: неизвестно, какому администратору принадлежало сообщение
+    RequestNotification.__table__.create(connection, checkfirst=True)
+
+
+def _migration_fsm_storage(connection):
+    FSMRecord.__table__.create(connection, checkfirst=True)
+
+
+def _migration_admins_composite_key(connection):
+    # SQLite не меняет первичный ключ на месте: пересоздаем таблицу и переносим строки
+    pk_columns = [row[1] for row in connection.exec_driver_sql("PRAGMA table_info(admins)") if row[5]]
+    if pk_columns == ["id", "admin_type"]:
+        return
+    connection.exec_driver_sql("ALTER TABLE admins RENAME TO admins_old")
+    Admin.__table__.create(connection)
+    connection.exec_driver_sql(
+        "INSERT OR IGNORE INTO admins (id, admin_type) SELECT id, admin_type FROM admins_old WHERE admin_type IS NOT NULL")
+    connection.exec_driver_sql("DROP TABLE admins_old")
+
+
+def _migration_outbox(connection):
+    OutboxMessage.__table__.create(connection, checkfirst=True)
+
+
+def _migration_requests_page_indexes(connection):
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_requests_user_created ON requests (user_id, created_at, id)")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_requests_admin_created ON requests (assigned_admin_id, created_at, id)")
+
+
+def _migration_requests_status_codes(connection):
+    # Строковые статусы заменяются кодами RequestStatus. Тип колонки в SQLite на месте не меняется:
+    # добавляем колонку с кодами, удаляем индексы по старой колонке и ее саму (DROP COLUMN - SQLite 3.35+),
+    # переименовываем новую колонку и заново создаем индексы
+    column_types = {row[1]: row[2] for row in connection.exec_driver_sql("PRAGMA table_info(requests)")}
+    if column_types.get("status", "").upper() == "INTEGER":
+        return
+    cases = " ".join(f"WHEN '{label}' THEN {int(status)}" for status, label in REQUEST_STATUS_LABELS.items())
+    connection.exec_driver_sql("ALTER TABLE requests ADD COLUMN status_code INTEGER")
+    connection.exec_driver_sql(
+        f"UPDATE requests SET status_code = CASE status {cases} ELSE {int(RequestStatus.NEW)} END")
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_requests_user_status")
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_requests_admin_status")
+    connection.exec_driver_sql("ALTER TABLE requests DROP COLUMN status")
+    connection.exec_driver_sql("ALTER TABLE requests RENAME COLUMN status_code TO status")
+    _migration_requests_indexes(connection)
+
+
+def _migration_requests_sla_columns(connection):
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA table_info(requests)")}
+    for column in ("reminder_sent_at", "escalated_at"):
+        if column not in columns:
+            connection.exec_driver_sql(f"ALTER TABLE requests ADD COLUMN {column} DATETIME")
+
+
+def _migration_request_messages(connection):
+    RequestMessage.__table__.create(connection, checkfirst=True)
+
+
+def _migration_request_attachments(connection):
+    RequestAttachment.__table__.create(connection, checkfirst=True)
+
+
+def _migration_requests_fts(connection):
+    # Полнотекстовый индекс FTS5: rowid = id заявки, колонки - описание и текст переписки по заявке.
+    # Индекс обновляется триггерами в той же транзакции, что и сами таблицы
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5("
+        "description, messages, tokenize = 'unicode61 remove_diacritics 2')")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS requests_fts_insert AFTER INSERT ON requests BEGIN
+            INSERT INTO requests_fts (rowid, description, messages) VALUES (new.id, new.description, '');
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS requests_fts_update AFTER UPDATE OF description ON requests BEGIN
+            UPDATE requests_fts SET description = new.description WHERE rowid = new.id;
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS requests_fts_delete AFTER DELETE ON requests BEGIN
+            DELETE FROM requests_fts WHERE rowid = old.id;
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS request_messages_fts_insert AFTER INSERT ON request_messages BEGIN
+            UPDATE requests_fts SET messages = messages || char(10) || new.text WHERE rowid = new.request_id;
+        END""")
+    connection.exec_driver_sql("DELETE FROM requests_fts")
+    connection.exec_driver_sql("""
+        INSERT INTO requests_fts (rowid, description, messages)
+        SELECT id, description, coalesce((SELECT group_concat(text, char(10)) FROM request_messages
+                                          WHERE request_messages.request_id = requests.id), '')
+        FROM requests""")
+
+
+def _migration_requests_archive(connection):
+    ArchivedRequest.__table__.create(connection, checkfirst=True)
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_requests_status_completed ON requests (status, completed_at)")
+    # При переносе в архив строка удаляется из requests, но должна остаться в поиске:
+    # из индекса удаляются только заявки, которых нет в архиве, и заявки, удаленные из архива
+    connection.exec_driver_sql("DROP TRIGGER IF EXISTS requests_fts_delete")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER requests_fts_delete AFTER DELETE ON requests
+        WHEN NOT EXISTS (SELECT 1 FROM requests_archive WHERE id = old.id) BEGIN
+            DELETE FROM requests_fts WHERE rowid = old.id;
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER IF NOT EXISTS requests_archive_fts_delete AFTER DELETE ON requests_archive BEGIN
+            DELETE FROM requests_fts WHERE rowid = old.id;
+        END""")
+
+
+def _migration_requests_fts_scope(connection):
+    # Тип заявки и ее автор - в самом индексе FTS, чтобы поиск отбирал и ранжировал заявки без соединения
+    # с таблицами заявок: request_type не индексируется (фильтр администратора по типу), а user_id -
+    # индексируемая колонка, и поиск пользователя по своим заявкам - пересечение списков документов FTS5.
+    # Индекс перестраивается в новой таблице; триггеры пересоздаются, так как ссылаются на нее по имени
+    for trigger in ("requests_fts_insert", "requests_fts_update", "requests_fts_delete",
+                    "request_messages_fts_insert", "requests_archive_fts_delete"):
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+    connection.exec_driver_sql("DROP TABLE IF EXISTS requests_fts_new")
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE requests_fts_new USING fts5("
+        "description, messages, request_type UNINDEXED, user_id, tokenize = 'unicode61 remove_diacritics 2')")
+    connection.exec_driver_sql("""
+        INSERT INTO requests_fts_new (rowid, description, messages, request_type, user_id)
+        SELECT requests_fts.rowid, requests_fts.description, requests_fts.messages,
+               all_requests.request_type, all_requests.user_id
+        FROM requests_fts
+        JOIN (SELECT id, request_type, user_id FROM requests
+              UNION ALL SELECT id, request_type, user_id FROM requests_archive) AS all_requests
+            ON all_requests.id = requests_fts.rowid""")
+    connection.exec_driver_sql("DROP TABLE requests_fts")
+    connection.exec_driver_sql("ALTER TABLE requests_fts_new RENAME TO requests_fts")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER requests_fts_insert AFTER INSERT ON requests BEGIN
+            INSERT INTO requests_fts (rowid, description, messages, request_type, user_id)
+            VALUES (new.id, new.description, '', new.request_type, new.user_id);
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER requests_fts_update AFTER UPDATE OF description ON requests BEGIN
+            UPDATE requests_fts SET description = new.description WHERE rowid = new.id;
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER requests_fts_delete AFTER DELETE ON requests
+        WHEN NOT EXISTS (SELECT 1 FROM requests_archive WHERE id = old.id) BEGIN
+            DELETE FROM requests_fts WHERE rowid = old.id;
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER request_messages_fts_insert AFTER INSERT ON request_messages BEGIN
+            UPDATE requests_fts SET messages = messages || char(10) || new.text WHERE rowid = new.request_id;
+        END""")
+    connection.exec_driver_sql("""
+        CREATE TRIGGER requests_archive_fts_delete AFTER DELETE ON requests_archive BEGIN
+            DELETE FROM requests_fts WHERE rowid = old.id;
+        END""")
+
+
+def _migration_request_stats(connection):
+    for table_name in ("requests", "requests_archive"):
+        columns = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table_name})")}
+        if "accepted_at" not in columns:
+            connection.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN accepted_at DATETIME")
+    RequestStatsDaily.__table__.create(connection, checkfirst=True)
+    RequestLatencyBucket.__table__.create(connection, checkfirst=True)
+    # Заполняем статистику по уже существующим заявкам (время принятия для них неизвестно).
+    # Колонки перечислены явно, а не взяты из моделей: модели описывают последнюю версию схемы,
+    # и колонка, добавленная в requests позже, сломала бы обновление с версий до 14
+    daily: Dict[tuple, Dict[str, int]] = {}
+    buckets: Dict[tuple, int] = {}
+    query = text("""
+        SELECT all_requests.request_type, all_requests.assigned_admin_id,
+               all_requests.created_at, all_requests.completed_at, users.organization
+        FROM (SELECT user_id, request_type, assigned_admin_id, created_at, completed_at FROM requests
+              UNION ALL
+              SELECT user_id, request_type, assigned_admin_id, created_at, completed_at FROM requests_archive
+        ) AS all_requests
+        LEFT JOIN users ON users.id = all_requests.user_id
+    """).columns(request_type=String, assigned_admin_id=Integer, created_at=DateTime, completed_at=DateTime,
+                 organization=String)
+    # yield_per: строки читаются порциями, а не загружаются в память все сразу
+    rows = connection.execute(query, execution_options={"yield_per": 1000})
+    for row in rows:
+        for stats_event in ("created", "completed"):
+            increments = request_stats_increments(stats_event, row, row.organization)
+            if increments is None:
+                continue
+            key, counters, bucket = increments
+            totals = daily.setdefault(tuple(key.values()), dict.fromkeys(
+                ("created", "accepted", "completed", "accept_seconds", "complete_seconds"), 0))
+            for name, value in counters.items():
+                totals[name] += value
+            if bucket:
+                bucket_key = tuple(key.values()) + (bucket["event"], bucket["le_seconds"])
+                buckets[bucket_key] = buckets.get(bucket_key, 0) + 1
+    key_names = ("day", "request_type", "organization", "admin_id")
+    connection.execute(delete(RequestStatsDaily))
+    connection.execute(delete(RequestLatencyBucket))
+    if daily:
+        connection.execute(insert(RequestStatsDaily), [dict(zip(key_names, key), **counters)
+                                                       for key, counters in daily.items()])
+    if buckets:
+        connection.execute(insert(RequestLatencyBucket), [
+            dict(zip(key_names + ("event", "le_seconds"), key), count=count) for key, count in buckets.items()])
+
+
+MIGRATIONS = [
+    (1, _migration_initial),
+    (2, _migration_requests_indexes),
+    (3, _migration_request_notifications),
+    (4, _migration_fsm_storage),
+    (5, _migration_admins_composite_key),
+    (6, _migration_outbox),
+    (7, _migration_requests_page_indexes),
+    (8, _migration_requests_status_codes),
+    (9, _migration_requests_sla_columns),
+    (10, _migration_request_messages),
+    (11, _migration_request_attachments),
+    (12, _migration_requests_fts),
+    (13, _migration_requests_archive),
+    (14, _migration_request_stats),
+    (15, _migration_requests_fts_scope),
+]
+
+
+def _upgrade_schema(connection):
+    current_version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+    for version, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        migration(connection)
+        connection.exec_driver_sql(f"PRAGMA user_version = {version}")
+        logger.info(f"Схема БД обновлена до версии {version} ({migration.__name__}).")
+
+
+# Создание и обновление таблиц в базе данных
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(_upgrade_schema)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Открывает ровно одну сессию БД на апдейт и передает ее хендлеру аргументом `db`.
+
+    После хендлера изменения фиксируются (при исключении - откатываются), а сессия
+    закрывается в любом случае, поэтому соединения не накапливаются.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker):
+        self.session_factory = session_factory
+        self.open_sessions = 0  # Сессии, открытые в данный момент
+        self.sessions_total = 0  # Всего открыто сессий с момента запуска
+        self.rollbacks_total = 0  # Сколько апдейтов завершилось откатом
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        async with self.session_factory() as session:
+            self.open_sessions += 1
+            self.sessions_total += 1
+            data["db"] = session
+            try:
+                result = await handler(event, data)
+                await session.commit()
+                return result
+            except Exception:
+                await session.rollback()
+                self.rollbacks_total += 1
+                raise
+            finally:
+                self.open_sessions -= 1
+
+
+db_session_middleware = DbSessionMiddleware(SessionLocal)
+
+
+# --- Кэш профилей пользователей ---
+class UserProfile(NamedTuple):
+    """Поля пользователя, которые читает почти каждый хендлер."""
+    id: int
+    full_name: Optional[str]
+    role: str
+    registered: bool
+
+
+class UserProfileCache:
+    """LRU-кэш профилей пользователей по Telegram ID с ограниченным временем жизни записей.
+
+    Записи загружаются из БД при первом обращении. Код, меняющий пользователя, обновляет
+    запись (put) или сбрасывает ее (invalidate); TTL ограничивает устаревание, если
+    пользователя изменил другой процесс бота.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple] = OrderedDict()  # user_id -> (момент устаревания, профиль)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, user: User) -> UserProfile:
+        profile = UserProfile(user.id, user.full_name, user.role or 'user', bool(user.registered))
+        self._entries[user.id] = (time.monotonic() + self.ttl, profile)
+        self._entries.move_to_end(user.id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    async def get(self, db_session: AsyncSession, user_id: int) -> Optional[UserProfile]:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        user = await db_session.get(User, user_id)
+        if user is None:
+            self._entries.pop(user_id, None)
+            return None
+        return self.put(user)
+
+
+user_profile_cache = UserProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# --- Таблица маршрутизации администраторов ---
+# Тип заявки -> тип администраторов, которые ее получают
+REQUEST_TYPE_ADMIN_TYPES = {"IT": "IT_ADMIN", "AHO": "AHO_ADMIN"}
+
+
+class AdminRoster:
+    """Копия таблицы admins в памяти: кому отправлять заявку и является ли ID администратором.
+
+    Строится при запуске (on_startup) и перечитывается командой /reload_admins,
+    поэтому новая заявка и проверки прав не требуют запросов к БД.
+    """
+
+    def __init__(self):
+        self.ids_by_type: Dict[str, tuple] = {}
+        self.types_by_id: Dict[int, frozenset] = {}
+
+    async def reload(self, db_session: AsyncSession):
+        ids_by_type: Dict[str, list] = {}
+        types_by_id: Dict[int, set] = {}
+        for admin_id, admin_type in (await db_session.execute(
+                select(Admin.id, Admin.admin_type).order_by(Admin.id))).all():
+            ids_by_type.setdefault(admin_type, []).append(admin_id)
+            types_by_id.setdefault(admin_id, set()).add(admin_type)
+        # Подменяем словари целиком, чтобы хендлеры не увидели наполовину построенную таблицу
+        self.ids_by_type = {admin_type: tuple(ids) for admin_type, ids in ids_by_type.items()}
+        self.types_by_id = {admin_id: frozenset(types) for admin_id, types in types_by_id.items()}
+        logger.info(f"Таблица администраторов загружена: "
+                    f"{', '.join(f'{t}={len(ids)}' for t, ids in self.ids_by_type.items()) or 'пусто'}.")
+
+    def recipients(self, request_type: str) -> tuple:
+        return self.ids_by_type.get(REQUEST_TYPE_ADMIN_TYPES.get(request_type), ())
+
+    def admin_types(self, user_id: int) -> frozenset:
+        return self.types_by_id.get(user_id, frozenset())
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id in self.types_by_id
+
+
+admin_roster = AdminRoster()
+
+
+# --- Нагрузка администраторов и автоназначение ---
+class AdminWorkload:
+    """Число незавершенных заявок у каждого администратора - для выбора исполнителя новой заявки.
+
+    Строится одним запросом при запуске (и по /reload_admins), дальше обновляется после коммита
+    переходов заявок, поэтому автоназначение не делает COUNT по таблице заявок. Хранится исполнитель
+    каждой открытой заявки, а не приращения +1/-1: повторное обновление той же заявки не сбивает счетчики.
+    Выбранный исполнитель сразу получает резерв, который снимается по окончании транзакции: иначе
+    одновременные заявки до коммита первой из них видели бы одну и ту же нагрузку и шли к одному администратору.
+    """
+
+    def __init__(self):
+        self.assignee_by_request: Dict[int, int] = {}
+        self.open_by_admin: Dict[int, int] = {}
+        self.reserved_by_admin: Dict[int, int] = {}  # Выбранные исполнители еще не закоммиченных заявок
+        self._last_picked: Dict[str, int] = {}  # Тип заявки -> администратор, выбранный последним
+        self.auto_assigned_total = 0
+
+    async def reload(self, db_session: AsyncSession):
+        assignee_by_request = dict((await db_session.execute(
+            select(Request.id, Request.assigned_admin_id)
+            .where(Request.status.in_(OPEN_STATUSES), Request.assigned_admin_id.is_not(None)))).all())
+        open_by_admin: Dict[int, int] = {}
+        for admin_id in assignee_by_request.values():
+            open_by_admin[admin_id] = open_by_admin.get(admin_id, 0) + 1
+        self.assignee_by_request, self.open_by_admin = assignee_by_request, open_by_admin
+        logger.info(f"Нагрузка администраторов загружена: {len(assignee_by_request)} открытых заявок "
+                    f"у {len(open_by_admin)} исполнителей.")
+
+    def load(self, admin_id: int) -> int:
+        return self.open_by_admin.get(admin_id, 0) + self.reserved_by_admin.get(admin_id, 0)
+
+    def update(self, request_id: int, admin_id: Optional[int]):
+        """Запоминает исполнителя открытой заявки (None - заявка закрыта или без исполнителя)."""
+        previous = self.assignee_by_request.pop(request_id, None)
+        if previous is not None:
+            remaining = self.open_by_admin.get(previous, 0) - 1
+            if remaining > 0:
+                self.open_by_admin[previous] = remaining
+            else:
+                self.open_by_admin.pop(previous, None)
+        if admin_id is not None:
+            self.assignee_by_request[request_id] = admin_id
+            self.open_by_admin[admin_id] = self.open_by_admin.get(admin_id, 0) + 1
+
+    def track(self, db_session: AsyncSession, request: Request):
+        """Учитывает изменение заявки в текущей транзакции: счетчики обновятся после коммита."""
+        admin_id = request.assigned_admin_id if request.status in OPEN_STATUSES else None
+        db_session.info.setdefault("workload_pending", {})[request.id] = admin_id
+
+    def pick(self, db_session: AsyncSession, request_type: str) -> Optional[int]:
+        """Администратор типа заявки с наименьшей нагрузкой; при равной - следующий по кругу после прошлого выбора.
+
+        Выбор резервируется до конца транзакции db_session; заявку нужно учесть через track до коммита.
+        """
+        candidates = admin_roster.recipients(request_type)
+        if not candidates:
+            return None
+        last = self._last_picked.get(request_type)
+        start = candidates.index(last) + 1 if last in candidates else 0
+        # min возвращает первого из равных, поэтому обход начинается со следующего за прошлым выбором
+        admin_id = min(candidates[start:] + candidates[:start], key=self.load)
+        self._last_picked[request_type] = admin_id
+        self.reserved_by_admin[admin_id] = self.reserved_by_admin.get(admin_id, 0) + 1
+        db_session.info.setdefault("workload_reserved", []).append(admin_id)
+        self.auto_assigned_total += 1
+        return admin_id
+
+    def release(self, admin_ids: list):
+        for admin_id in admin_ids:
+            remaining = self.reserved_by_admin.get(admin_id, 0) - 1
+            if remaining > 0:
+                self.reserved_by_admin[admin_id] = remaining
+            else:
+                self.reserved_by_admin.pop(admin_id, None)
+
+
+admin_workload = AdminWorkload()
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_workload_after_commit(session):
+    for request_id, admin_id in session.info.pop("workload_pending", {}).items():
+        admin_workload.update(request_id, admin_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_workload_after_rollback(session):
+    session.info.pop("workload_pending", None)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _release_workload_reservations(session, transaction):
+    # Срабатывает и при коммите (после after_commit - заявка уже учтена), и при откате или закрытии сессии
+    if transaction.parent is None:
+        admin_workload.release(session.info.pop("workload_reserved", []))
+
+
+# --- Ограничение частоты исходящих сообщений ---
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 сообщения в секунду в один чат
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = 3
+
+
+class TokenBucket:
+    """Токен-бакет: в среднем `rate` операций в секунду, всплеск до `capacity` операций."""
 
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
 
-# Функция для получения сессии БД
-def get_db():
-    db = SessionLocal()
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TelegramRateLimiter:
+    """Пропускает вызовы Bot API через глобальный бакет и бакет конкретного чата.
+
+    При ответе 429 (TelegramRetryAfter) ждет указанное Telegram время и повторяет вызов.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self.retry_after_total = 0  # Сколько раз Telegram ответил 429
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self.chat_buckets) > self.max_chats:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def call(self, chat_id: int, make_call: Callable[[], Awaitable[Any]]) -> Any:
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await make_call()
+            except TelegramRetryAfter as e:
+                self.retry_after_total += 1
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                logger.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой в чат {chat_id}.")
+                await asyncio.sleep(e.retry_after)
+
+
+telegram_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+
+
+class LatencyStats:
+    """Счетчик задержек: общее число и сумма замеров плюс окно последних значений для перцентилей."""
+
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# Время от сохранения заявки до доставки уведомления администратору
+admin_notify_latency = LatencyStats()
+
+
+# --- Очередь исходящих уведомлений (outbox) ---
+def enqueue_message(db_session: AsyncSession, chat_id: int, method: str, request_id: Optional[int] = None,
+                    **params):
+    """Ставит вызов `bot.<method>(chat_id=chat_id, **params)` в очередь в текущей транзакции.
+
+    Сообщение уйдет только после коммита сессии; при откате оно пропадает вместе с остальными изменениями.
+    """
+    db_session.add(OutboxMessage(
+        chat_id=chat_id, method=method, request_id=request_id,
+        payload=json.dumps(params, ensure_ascii=False, default=lambda obj: obj.model_dump(exclude_none=True))))
+    db_session.info["outbox_pending"] = True
+
+
+class OutboxDelivery:
+    """Фоновая доставка сообщений из таблицы outbox.
+
+    Выборщик берет готовые к отправке сообщения и раздает их воркерам пачками по чатам:
+    пачка одного чата отправляется по порядку, и пока она в работе, новые сообщения этого
+    чата не выбираются. Поэтому чат, упершийся в лимит Telegram, задерживает только
+    свой воркер, а не сообщения в другие чаты. Если сообщение не удалось отправить, оно откладывается с растущей
+    паузой, а более поздние сообщения того же чата ждут его (порядок в чате сохраняется).
+    Так же откладывается сообщение, на котором воркер получил любую другую ошибку (например, от БД).
+    Отправленные сообщения удаляются из таблицы.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, workers: int):
+        self.session_factory = session_factory
+        self.workers_count = workers
+        self.bot: Optional[Bot] = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks = []
+        self._busy_chats = set()
+        self._wakeup = asyncio.Event()
+        self.delivered_total = 0
+        self.retries_total = 0  # Отложенные повторы после неудачной отправки
+        self.dropped_total = 0  # Сообщения, удаленные без доставки
+        # Отправленные сообщения, которые не удалось удалить из таблицы: при повторе не отправляются снова
+        self._sent: Dict[int, Any] = {}
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+        self.tasks.append(asyncio.create_task(self._fetch_loop()))
+        self.wake()  # Сообщения, оставшиеся в таблице с прошлого запуска
+
+    async def stop(self):
+        # Недоставленные сообщения остаются в таблице и будут отправлены после перезапуска
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self._busy_chats.clear()
+
+    async def _fetch_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._dispatch_due()
+            except Exception as e:
+                logger.error(f"Ошибка при выборке сообщений из outbox: {e}")
+
+    async def _dispatch_due(self):
+        now = datetime.now()
+        earlier = aliased(OutboxMessage)
+        query = select(OutboxMessage).where(
+            OutboxMessage.next_attempt_at <= now,
+            # Сообщение ждет, пока не доставлено отложенное более раннее сообщение того же чата
+            ~exists().where(earlier.chat_id == OutboxMessage.chat_id, earlier.id < OutboxMessage.id,
+                            earlier.next_attempt_at > now)
+        ).order_by(OutboxMessage.id).limit(OUTBOX_BATCH_SIZE)
+        if self._busy_chats:
+            query = query.where(OutboxMessage.chat_id.not_in(self._busy_chats))
+        async with self.session_factory() as db_session:
+            messages = (await db_session.scalars(query)).all()
+
+        batches: Dict[int, list] = {}
+        for message in messages:
+            batches.setdefault(message.chat_id, []).append(message)
+        for chat_id, batch in batches.items():
+            self._busy_chats.add(chat_id)
+            self.queue.put_nowait((chat_id, batch))
+
+    async def _worker(self):
+        while True:
+            chat_id, batch = await self.queue.get()
+            try:
+                for message in batch:
+                    try:
+                        delivered = await self._deliver(message)
+                    except Exception as e:
+                        # Ошибка БД или испорченное сообщение не должны останавливать воркер
+                        logger.exception(f"Ошибка при доставке сообщения {message.id} из outbox: {e}")
+                        delivered = await self._retry_later(message, e)
+                    if not delivered:
+                        break
+            except Exception as e:
+                logger.exception(f"Не удалось отложить сообщения outbox в чат {chat_id}: {e}")
+            finally:
+                self._busy_chats.discard(chat_id)
+                self.queue.task_done()
+                self.wake()  # В таблице могли остаться сообщения этого чата
+
+    async def _deliver(self, message: OutboxMessage) -> bool:
+        """Отправляет одно сообщение. Возвращает False, если сообщение отложено до следующей попытки."""
+        if message.id in self._sent:
+            await self._finish(message, self._sent[message.id])
+            return True
+        if message.request_id is not None:
+            async with self.session_factory() as db_session:
+                status = await db_session.scalar(select(Request.status).where(Request.id == message.request_id))
+            if status != RequestStatus.NEW:
+                # Заявку уже приняли, пока уведомление ждало в очереди: кнопка "Принять" не нужна
+                await self._finish(message)
+                return True
+        call = getattr(self.bot, message.method)
+        params = json.loads(message.payload)
+        try:
+            result = await telegram_limiter.call(message.chat_id, lambda: call(chat_id=message.chat_id, **params))
+        except (TelegramBadRequest, TelegramForbiddenError) as e:
+            # Повтор не поможет: бот заблокирован, сообщение удалено или не изменилось
+            self.dropped_total += 1
+            logger.error(f"Сообщение {message.id} ({message.method}) в чат {message.chat_id} не доставлено: {e}")
+            await self._finish(message)
+            return True
+        except Exception as e:
+            return await self._retry_later(message, e)
+
+        self.delivered_total += 1
+        self._sent[message.id] = result
+        await self._finish(message, result)
+        return True
+
+    async def _retry_later(self, message: OutboxMessage, error: Exception) -> bool:
+        """Откладывает сообщение с растущей паузой (False); после OUTBOX_MAX_ATTEMPTS попыток удаляет (True)."""
+        attempts = message.attempts + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            self.dropped_total += 1
+            logger.error(f"Сообщение {message.id} ({message.method}) в чат {message.chat_id} не доставлено "
+                         f"за {attempts} попыток, удаляется из очереди: {error}")
+            await self._finish(message, self._sent.get(message.id))
+            return True
+        self.retries_total += 1
+        delay = min(OUTBOX_MAX_BACKOFF, 2 ** attempts)
+        logger.warning(f"Сообщение {message.id} в чат {message.chat_id} отложено "
+                       f"(попытка {attempts}), повтор через {delay} с: {error}")
+        async with self.session_factory() as db_session:
+            stored = await db_session.get(OutboxMessage, message.id)
+            if stored is not None:
+                stored.attempts = attempts
+                stored.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+                await db_session.commit()
+        return False
+
+    async def _finish(self, message: OutboxMessage, result: Any = None):
+        async with self.session_factory() as db_session:
+            await db_session.execute(delete(OutboxMessage).where(OutboxMessage.id == message.id))
+            if message.request_id is not None and isinstance(result, Message):
+                # Сохраняем ID сообщения администратора для последующего редактирования
+                db_session.add(RequestNotification(request_id=message.request_id, admin_chat_id=message.chat_id,
+                                                   message_id=result.message_id))
+                admin_notify_latency.observe((datetime.now() - message.created_at).total_seconds())
+            await db_session.commit()
+        self._sent.pop(message.id, None)
+
+
+outbox_delivery = OutboxDelivery(SessionLocal, OUTBOX_WORKERS)
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_outbox_after_commit(session):
+    # Воркеры будятся только после коммита: до него новые строки outbox им не видны
+    if session.info.pop("outbox_pending", False):
+        outbox_delivery.wake()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_outbox_after_rollback(session):
+    session.info.pop("outbox_pending", None)
+
+
+# --- Сроки заявок (SLA) ---
+def parse_due_date(value: Optional[str]) -> Optional[datetime]:
     try:
-        yield db
-    finally:
-        db.close()
+        return datetime.strptime(value, DUE_DATE_FORMAT) if value else None
+    except ValueError:
+        return None
+
+
+class SlaScheduler:
+    """Напоминания о сроках и эскалация непринятых срочных заявок одной фоновой задачей.
+
+    События хранятся в куче (время срабатывания, ID заявки, вид события): при запуске она
+    заполняется одним запросом по открытым заявкам, дальше пополняется при создании заявок.
+    Таблица requests не опрашивается - задача спит до ближайшего события. Актуальность события
+    проверяется при срабатывании условным UPDATE (заявка не закрыта, событие еще не отправлено),
+    поэтому события закрытых или уже принятых заявок просто пропускаются.
+    """
+
+    REMIND = "remind"
+    ESCALATE = "escalate"
+
+    def __init__(self, session_factory: async_sessionmaker, remind_before: int, escalation_delay: int):
+        self.session_factory = session_factory
+        self.remind_before = timedelta(seconds=remind_before)
+        self.escalation_delay = timedelta(seconds=escalation_delay)
+        self.task: Optional[asyncio.Task] = None
+        self._heap = []
+        self._changed = asyncio.Event()
+        self.reminders_total = 0
+        self.escalations_total = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, request: Request):
+        """Добавляет события заявки; вызывается после коммита новой заявки."""
+        due_at = parse_due_date(request.due_date) if request.urgency == "DATE" else None
+        if due_at and request.reminder_sent_at is None:
+            self._push(due_at - self.remind_before, request.id, self.REMIND)
+        if (request.urgency == "ASAP" and self.escalation_delay and request.escalated_at is None
+                and request.status == RequestStatus.NEW):
+            self._push(request.created_at + self.escalation_delay, request.id, self.ESCALATE)
+
+    def _push(self, fire_at: datetime, request_id: int, kind: str):
+        if not self._heap or fire_at < self._heap[0][0]:
+            self._changed.set()  # Ближайшее событие стало раньше - задача пересчитает время сна
+        heapq.heappush(self._heap, (fire_at, request_id, kind))
+
+    async def start(self):
+        async with self.session_factory() as db_session:
+            requests = (await db_session.scalars(select(Request).where(
+                Request.status.in_(OPEN_STATUSES),
+                ((Request.urgency == "DATE") & Request.reminder_sent_at.is_(None))
+                | ((Request.urgency == "ASAP") & (Request.status == RequestStatus.NEW)
+                   & Request.escalated_at.is_(None))))).all()
+        self._heap = []
+        for request in requests:
+            self.schedule(request)
+        logger.info(f"Планировщик сроков: {len(self._heap)} событий по {len(requests)} открытым заявкам.")
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _run(self):
+        while True:
+            now = datetime.now()
+            while self._heap and self._heap[0][0] <= now:
+                _, request_id, kind = heapq.heappop(self._heap)
+                try:
+                    await self._fire(request_id, kind)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке события '{kind}' для заявки {request_id}: {e}")
+            timeout = max(0.0, (self._heap[0][0] - datetime.now()).total_seconds()) if self._heap else None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, request_id: int, kind: str):
+        async with self.session_factory() as db_session:
+            request = await db_session.get(Request, request_id, options=[joinedload(Request.creator)])
+            if not request:
+                return
+            now = datetime.now()
+            if kind == self.REMIND:
+                # Напоминание - исполнителю, а если заявку еще никто не принял - всем администраторам ее типа
+                marked = update(Request).where(Request.id == request_id, Request.status.in_(OPEN_STATUSES),
+                                               Request.reminder_sent_at.is_(None)).values(reminder_sent_at=now)
+                recipients = [request.assigned_admin_id] if request.assigned_admin_id else \
+                    admin_roster.recipients(request.request_type)
+                text = (f"⏰ Напоминание: срок заявки ID:{request.id} ({request.description[:50]}...) - "
+                        f"{request.due_date}.\nСтатус: {request.status.label}.")
+                keyboard = None
+            else:
+                marked = update(Request).where(Request.id == request_id, Request.status == RequestStatus.NEW,
+                                               Request.escalated_at.is_(None)).values(escalated_at=now)
+                # Назначенную заявку принять может только исполнитель - эскалация напоминает ему
+                recipients = [request.assigned_admin_id] if request.assigned_admin_id else \
+                    admin_roster.recipients(request.request_type)
+                minutes = int(self.escalation_delay.total_seconds() // 60)
+                text = (f"⚠️ Срочная заявка не принята уже {minutes} мин.\n\n"
+                        f"{build_admin_request_text(request, request.creator)}")
+                keyboard = get_admin_new_request_keyboard(request.id)
+
+            if (await db_session.execute(marked)).rowcount != 1:
+                return  # Заявку уже закрыли, приняли или событие отправил другой процесс
+            for admin_id in recipients:
+                # Эскалация - копия уведомления о новой заявке: outbox сохранит ее, и кнопки обновятся при принятии
+                enqueue_message(db_session, admin_id, "send_message",
+                                request_id=request.id if kind == self.ESCALATE else None,
+                                text=text, reply_markup=keyboard)
+            await db_session.commit()
+        if kind == self.REMIND:
+            self.reminders_total += 1
+        else:
+            self.escalations_total += 1
+        logger.info(f"Заявка {request_id}: событие '{kind}' отправлено {len(recipients)} администраторам.")
+
+
+sla_scheduler = SlaScheduler(SessionLocal, SLA_REMINDER_BEFORE, SLA_ESCALATION_DELAY)
+
+
+# --- Архив выполненных заявок ---
+class RequestArchiver:
+    """Периодически переносит давно выполненные заявки из requests в requests_archive.
+
+    Списки заявок и проверки в хендлерах работают с небольшой оперативной таблицей, а поиск
+    и отчеты читают обе таблицы (all_requests_subquery). Перенос идет пачками по batch_size
+    заявок, каждая пачка - отдельная короткая транзакция, чтобы не держать блокировку записи.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, archive_after_days: int, interval: float,
+                 batch_size: int):
+        self.session_factory = session_factory
+        self.archive_after = timedelta(days=archive_after_days)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task: Optional[asyncio.Task] = None
+        self.archived_total = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive()
+            except Exception as e:
+                logger.error(f"Ошибка при переносе заявок в архив: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def archive(self) -> int:
+        archived = 0
+        while True:
+            moved = await self._archive_batch(datetime.now() - self.archive_after)
+            archived += moved
+            if moved < self.batch_size:
+                break
+            await asyncio.sleep(0)  # Между пачками даем хендлерам записать свои изменения
+        if archived:
+            logger.info(f"В архив перенесено заявок: {archived}.")
+        return archived
+
+    async def _archive_batch(self, completed_before: datetime) -> int:
+        async with self.session_factory() as db_session:
+            request_ids = (await db_session.scalars(
+                select(Request.id).where(Request.status == RequestStatus.DONE, Request.completed_at < completed_before)
+                .order_by(Request.completed_at).limit(self.batch_size))).all()
+            if not request_ids:
+                return 0
+            columns = [c.name for c in Request.__table__.c]
+            await db_session.execute(insert(ArchivedRequest).from_select(
+                columns + ["archived_at"],
+                select(*Request.__table__.c, literal(datetime.now(), DateTime)).where(Request.id.in_(request_ids))))
+            # Копии уведомлений администраторам больше не будут редактироваться
+            await db_session.execute(delete(RequestNotification).where(RequestNotification.request_id.in_(request_ids)))
+            await db_session.execute(delete(Request).where(Request.id.in_(request_ids)))
+            await db_session.commit()
+        self.archived_total += len(request_ids)
+        return len(request_ids)
+
+
+request_archiver = RequestArchiver(SessionLocal, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL, ARCHIVE_BATCH_SIZE)
+
+
+# --- Статистика по заявкам ---
+# Событие -> (счетчик, сумма задержек от создания, поле времени события)
+STATS_EVENTS = {
+    "created": ("created", None, "created_at"),
+    "accepted": ("accepted", "accept_seconds", "accepted_at"),
+    "completed": ("completed", "complete_seconds", "completed_at"),
+}
+
+
+def request_stats_increments(event: str, request, organization: Optional[str]) -> Optional[tuple]:
+    """Приращения агрегатов для события заявки: (ключ строки, счетчики, корзина гистограммы или None).
+
+    request - заявка или строка с теми же колонками (используется и при заполнении статистики в миграции).
+    """
+    counter, seconds_column, time_column = STATS_EVENTS[event]
+    happened_at = getattr(request, time_column)
+    if happened_at is None:
+        return None
+    # Новая заявка еще без исполнителя (и при заполнении по старым заявкам - тоже)
+    admin_id = 0 if event == "created" else request.assigned_admin_id or 0
+    key = dict(day=happened_at.strftime("%Y-%m-%d"), request_type=request.request_type or "",
+               organization=organization or "", admin_id=admin_id)
+    counters = {counter: 1}
+    bucket = None
+    if seconds_column and request.created_at:
+        latency = max(0, int((happened_at - request.created_at).total_seconds()))
+        counters[seconds_column] = latency
+        le_seconds = next((le for le in STATS_LATENCY_BUCKETS if latency <= le), -1)
+        bucket = dict(event=event, le_seconds=le_seconds)
+    return key, counters, bucket
+
+
+async def record_request_stats(db_session: AsyncSession, event: str, request: Request, organization: Optional[str]):
+    """Увеличивает дневные агрегаты в текущей транзакции (вместе с изменением самой заявки)."""
+    increments = request_stats_increments(event, request, organization)
+    if increments is None:
+        return
+    key, counters, bucket = increments
+    await db_session.execute(sqlite_insert(RequestStatsDaily).values(**key, **counters).on_conflict_do_update(
+        index_elements=list(key),
+        set_={name: getattr(RequestStatsDaily, name) + value for name, value in counters.items()}))
+    if bucket:
+        await db_session.execute(sqlite_insert(RequestLatencyBucket).values(**key, **bucket, count=1).on_conflict_do_update(
+            index_elements=list(key) + list(bucket), set_={"count": RequestLatencyBucket.count + 1}))
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours} ч {minutes} мин"
+    days, hours = divmod(hours, 24)
+    return f"{days} дн {hours} ч"
+
+
+def _bucket_median(counts: Dict[int, int]) -> Optional[str]:
+    """Медиана по гистограмме: граница корзины, в которую попадает половина событий."""
+    total = sum(counts.values())
+    seen = 0
+    for le in sorted(counts, key=lambda le: le if le >= 0 else float("inf")):
+        seen += counts[le]
+        if seen * 2 >= total:
+            return f"до {format_duration(le)}" if le >= 0 else f"больше {format_duration(STATS_LATENCY_BUCKETS[-1])}"
+    return None
+
+
+def stats_scope(user_id: int) -> list:
+    """Типы заявок, статистику по которым видит администратор."""
+    return [request_type for request_type, admin_type in REQUEST_TYPE_ADMIN_TYPES.items()
+            if admin_type in admin_roster.admin_types(user_id)]
+
+
+async def build_stats_report(db_session: AsyncSession, user_id: int, days: int) -> str:
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    request_types = stats_scope(user_id)
+    conditions = [RequestStatsDaily.day >= since, RequestStatsDaily.request_type.in_(request_types)]
+    sums = (func.sum(RequestStatsDaily.created), func.sum(RequestStatsDaily.accepted),
+            func.sum(RequestStatsDaily.completed), func.sum(RequestStatsDaily.accept_seconds),
+            func.sum(RequestStatsDaily.complete_seconds))
+
+    lines = [f"📊 Статистика за {days} дн. (с {since})"]
+    medians: Dict[tuple, Dict[int, int]] = {}
+    for request_type, event, le_seconds, count in (await db_session.execute(
+            select(RequestLatencyBucket.request_type, RequestLatencyBucket.event, RequestLatencyBucket.le_seconds,
+                   func.sum(RequestLatencyBucket.count))
+            .where(RequestLatencyBucket.day >= since, RequestLatencyBucket.request_type.in_(request_types))
+            .group_by(RequestLatencyBucket.request_type, RequestLatencyBucket.event,
+                      RequestLatencyBucket.le_seconds))).all():
+        medians.setdefault((request_type, event), {})[le_seconds] = count
+
+    for request_type, created, accepted, completed, accept_seconds, complete_seconds in (await db_session.execute(
+            select(RequestStatsDaily.request_type, *sums).where(*conditions)
+            .group_by(RequestStatsDaily.request_type).order_by(RequestStatsDaily.request_type))).all():
+        lines.append(f"\n{request_type}: создано {created}, принято {accepted}, выполнено {completed}")
+        if accepted:
+            lines.append(f"  Время до принятия: в среднем {format_duration(accept_seconds / accepted)}, "
+                         f"медиана {_bucket_median(medians.get((request_type, 'accepted'), {}))}")
+        if completed:
+            lines.append(f"  Время до выполнения: в среднем {format_duration(complete_seconds / completed)}, "
+                         f"медиана {_bucket_median(medians.get((request_type, 'completed'), {}))}")
+
+    organizations = (await db_session.execute(
+        select(RequestStatsDaily.organization, *sums[:3]).where(*conditions)
+        .group_by(RequestStatsDaily.organization).order_by(func.sum(RequestStatsDaily.created).desc()))).all()
+    if organizations:
+        lines.append("\nПо организациям (создано / выполнено):")
+        lines.extend(f"  {organization or 'не указана'}: {created} / {completed}"
+                     for organization, created, _, completed in organizations)
+
+    admins = (await db_session.execute(
+        select(RequestStatsDaily.admin_id, *sums[1:3]).where(*conditions, RequestStatsDaily.admin_id != 0)
+        .group_by(RequestStatsDaily.admin_id).order_by(func.sum(RequestStatsDaily.completed).desc()))).all()
+    if admins:
+        lines.append("\nПо исполнителям (принято / выполнено):")
+        for admin_id, accepted, completed in admins:
+            admin = await user_profile_cache.get(db_session, admin_id)
+            lines.append(f"  {admin.full_name if admin else admin_id}: {accepted} / {completed}")
+
+    if len(lines) == 1:
+        lines.append("\nЗа этот период заявок нет.")
+    return "\n".join(lines)
+
+
+async def build_stats_csv(db_session: AsyncSession, user_id: int, days: int) -> bytes:
+    """Дневные агрегаты за период в CSV (по строке на день x тип x организацию x исполнителя)."""
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=";")
+    writer.writerow(["day", "request_type", "organization", "admin_id", "created", "accepted", "completed",
+                     "accept_seconds_sum", "complete_seconds_sum"])
+    rows = await db_session.stream(
+        select(RequestStatsDaily.day, RequestStatsDaily.request_type, RequestStatsDaily.organization,
+               RequestStatsDaily.admin_id, RequestStatsDaily.created, RequestStatsDaily.accepted,
+               RequestStatsDaily.completed, RequestStatsDaily.accept_seconds, RequestStatsDaily.complete_seconds)
+        .where(RequestStatsDaily.day >= since, RequestStatsDaily.request_type.in_(stats_scope(user_id)))
+        .order_by(RequestStatsDaily.day, RequestStatsDaily.request_type, RequestStatsDaily.organization))
+    async for row in rows:
+        writer.writerow(row)
+    # BOM - чтобы Excel открыл кириллицу без выбора кодировки
+    return output.getvalue().encode("utf-8-sig")
+
+
+# --- Метрики ---
+# Границы корзин гистограммы времени хендлера, секунды
+HANDLER_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма в стиле Prometheus: накопительные счетчики по корзинам, сумма и число замеров."""
+
+    def __init__(self, buckets=HANDLER_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.total += value
+
+
+class HandlerStats:
+    """Счетчики одного хендлера. db_seconds/api_seconds накапливаются, пока хендлер выполняется."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.api_seconds = 0.0
+        self.api_calls = 0
+
+
+# Статистика хендлера, который сейчас выполняется в этом контексте (None вне хендлеров)
+current_handler_stats: contextvars.ContextVar[Optional[HandlerStats]] = contextvars.ContextVar(
+    "current_handler_stats", default=None)
+
+
+def create_background_task(coro) -> asyncio.Task:
+    """Запускает долгоживущую фоновую задачу в пустом контексте.
+
+    asyncio.create_task копирует contextvars вызывающего; задача, лениво запущенная из хендлера,
+    иначе записывала бы все свои будущие запросы к БД в статистику этого хендлера.
+    """
+    return contextvars.Context().run(asyncio.create_task, coro)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: число вызовов, ошибки и время каждого зарегистрированного хендлера.
+
+    Время запросов к БД и вызовов Bot API, сделанных во время хендлера, добавляют к его
+    статистике слушатели SQLAlchemy и BotApiMetricsMiddleware через current_handler_stats.
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, HandlerStats] = {}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        token = current_handler_stats.set(stats)
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.calls += 1
+            stats.latency.observe(time.perf_counter() - started_at)
+            current_handler_stats.reset(token)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: число, ошибки и время вызовов Bot API по методам."""
+
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method):
+        name = method.__api_method__
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started_at
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+            stats = current_handler_stats.get()
+            if stats is not None:
+                stats.api_calls += 1
+                stats.api_seconds += elapsed
+
+
+class DbQueryMetrics:
+    """Число и суммарное время SQL-запросов; время также относится к текущему хендлеру."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started_at = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started_at = getattr(context, "_metrics_started_at", None)
+        if started_at is None:
+            return
+        elapsed = time.perf_counter() - started_at
+        self.queries += 1
+        self.seconds += elapsed
+        stats = current_handler_stats.get()
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_seconds += elapsed
+
+
+handler_metrics = HandlerMetricsMiddleware()
+bot_api_metrics = BotApiMetricsMiddleware()
+db_query_metrics = DbQueryMetrics()
+event.listen(engine.sync_engine, "before_cursor_execute", db_query_metrics.before_cursor_execute)
+event.listen(engine.sync_engine, "after_cursor_execute", db_query_metrics.after_cursor_execute)
+
+
+def _label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsExporter:
+    """Отдает метрики бота в текстовом формате Prometheus по GET /metrics.
+
+    Кроме статистики хендлеров, Bot API и БД, включает счетчики сессий, ограничителя частоты,
+    задержку уведомлений администраторов и (в режиме вебхука) состояние очереди апдейтов.
+    """
+
+    def __init__(self):
+        self.webhook_server = None  # Устанавливается в run_webhook
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{key}="{_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+
+        handlers = sorted(handler_metrics.handlers.items())
+        metric("bot_handler_calls_total", "counter", "Вызовы хендлера",
+               [("", {"handler": name}, stats.calls) for name, stats in handlers])
+        metric("bot_handler_errors_total", "counter", "Вызовы хендлера, завершившиеся исключением",
+               [("", {"handler": name}, stats.errors) for name, stats in handlers])
+        histogram_samples = []
+        for name, stats in handlers:
+            for bound, count in zip(stats.latency.buckets, stats.latency.counts):
+                histogram_samples.append(("_bucket", {"handler": name, "le": bound}, count))
+            histogram_samples.append(("_bucket", {"handler": name, "le": "+Inf"}, stats.latency.count))
+            histogram_samples.append(("_sum", {"handler": name}, stats.latency.total))
+            histogram_samples.append(("_count", {"handler": name}, stats.latency.count))
+        metric("bot_handler_duration_seconds", "histogram", "Время выполнения хендлера", histogram_samples)
+        metric("bot_handler_db_seconds_total", "counter", "Время запросов к БД внутри хендлера",
+               [("", {"handler": name}, stats.db_seconds) for name, stats in handlers])
+        metric("bot_handler_db_queries_total", "counter", "Запросы к БД внутри хендлера",
+               [("", {"handler": name}, stats.db_queries) for name, stats in handlers])
+        metric("bot_handler_api_seconds_total", "counter", "Время вызовов Bot API внутри хендлера",
+               [("", {"handler": name}, stats.api_seconds) for name, stats in handlers])
+        metric("bot_handler_api_calls_total", "counter", "Вызовы Bot API внутри хендлера",
+               [("", {"handler": name}, stats.api_calls) for name, stats in handlers])
+
+        api_methods = sorted(bot_api_metrics.calls)
+        metric("bot_api_requests_total", "counter", "Вызовы Bot API",
+               [("", {"method": name}, bot_api_metrics.calls[name]) for name in api_methods])
+        metric("bot_api_errors_total", "counter", "Вызовы Bot API, завершившиеся ошибкой",
+               [("", {"method": name}, bot_api_metrics.errors.get(name, 0)) for name in api_methods])
+        metric("bot_api_seconds_total", "counter", "Время вызовов Bot API",
+               [("", {"method": name}, bot_api_metrics.seconds[name]) for name in api_methods])
+
+        metric("bot_db_queries_total", "counter", "Запросы к БД", [("", {}, db_query_metrics.queries)])
+        metric("bot_db_seconds_total", "counter", "Время запросов к БД", [("", {}, db_query_metrics.seconds)])
+        metric("bot_db_sessions_open", "gauge", "Открытые сессии БД", [("", {}, db_session_middleware.open_sessions)])
+        metric("bot_db_sessions_total", "counter", "Открытые сессии БД с момента запуска",
+               [("", {}, db_session_middleware.sessions_total)])
+        metric("bot_db_rollbacks_total", "counter", "Апдейты, завершившиеся откатом транзакции",
+               [("", {}, db_session_middleware.rollbacks_total)])
+        metric("bot_user_cache_hits_total", "counter", "Профили пользователей, найденные в кэше",
+               [("", {}, user_profile_cache.hits)])
+        metric("bot_user_cache_misses_total", "counter", "Профили пользователей, загруженные из БД",
+               [("", {}, user_profile_cache.misses)])
+        metric("bot_user_cache_size", "gauge", "Профили пользователей в кэше", [("", {}, len(user_profile_cache))])
+        metric("bot_admins", "gauge", "Администраторы в таблице маршрутизации",
+               [("", {"type": admin_type}, len(ids)) for admin_type, ids in sorted(admin_roster.ids_by_type.items())])
+        metric("bot_admin_open_requests", "gauge", "Незавершенные заявки, назначенные администратору",
+               [("", {"admin_id": admin_id}, count) for admin_id, count in sorted(admin_workload.open_by_admin.items())])
+        metric("bot_requests_auto_assigned_total", "counter", "Заявки, назначенные автоматически по нагрузке",
+               [("", {}, admin_workload.auto_assigned_total)])
+        metric("bot_outbox_delivered_total", "counter", "Сообщения, доставленные из outbox",
+               [("", {}, outbox_delivery.delivered_total)])
+        metric("bot_outbox_retries_total", "counter", "Отложенные повторы отправки из outbox",
+               [("", {}, outbox_delivery.retries_total)])
+        metric("bot_outbox_dropped_total", "counter", "Сообщения outbox, удаленные без доставки",
+               [("", {}, outbox_delivery.dropped_total)])
+        metric("bot_clarification_dialogues_active", "gauge", "Активные диалоги уточнения",
+               [("", {}, len(clarification_dialogues))])
+        metric("bot_clarification_dialogues_expired_total", "counter", "Диалоги уточнения, завершенные по таймауту",
+               [("", {}, clarification_dialogues.expired_total)])
+        metric("bot_request_messages_logged_total", "counter", "Сообщения диалогов, записанные в историю",
+               [("", {}, request_message_log.messages_logged_total)])
+        metric("bot_request_messages_buffered", "gauge", "Сообщения диалогов, ожидающие записи в историю",
+               [("", {}, len(request_message_log))])
+        if isinstance(clarification_dialogues.storage, SQLiteStorage):
+            metric("bot_fsm_cache_hits_total", "counter", "Чтения состояний FSM, обслуженные кэшем SQLiteStorage",
+                   [("", {}, clarification_dialogues.storage.cache_hits_total)])
+            metric("bot_fsm_reads_total", "counter", "Чтения таблицы fsm_storage при промахе кэша",
+                   [("", {}, clarification_dialogues.storage.reads_total)])
+        metric("bot_fsm_records", "gauge", "Записи в хранилище FSM (на момент последней очистки диалогов)",
+               [("", {}, clarification_dialogues.fsm_records)])
+        metric("bot_fsm_data_bytes", "gauge", "Объем данных FSM в JSON, байты (на момент последней очистки диалогов)",
+               [("", {}, clarification_dialogues.fsm_bytes)])
+        metric("bot_requests_archived_total", "counter", "Заявки, перенесенные в архив",
+               [("", {}, request_archiver.archived_total)])
+        metric("bot_sla_reminders_total", "counter", "Отправленные напоминания о сроке заявки",
+               [("", {}, sla_scheduler.reminders_total)])
+        metric("bot_sla_escalations_total", "counter", "Эскалации непринятых срочных заявок",
+               [("", {}, sla_scheduler.escalations_total)])
+        metric("bot_sla_scheduled", "gauge", "События в очереди планировщика сроков", [("", {}, len(sla_scheduler))])
+        metric("bot_telegram_retry_after_total", "counter", "Ответы 429 от Telegram",
+               [("", {}, telegram_limiter.retry_after_total)])
+        metric("bot_admin_notify_seconds", "summary", "Время от создания заявки до доставки уведомления администратору",
+               [("", {"quantile": q}, admin_notify_latency.percentile(q)) for q in (0.5, 0.95, 0.99)]
+               + [("_sum", {}, admin_notify_latency.total), ("_count", {}, admin_notify_latency.count)])
+
+        if self.webhook_server is not None:
+            server = self.webhook_server
+            metric("bot_webhook_updates_accepted_total", "counter", "Апдейты, принятые вебхуком",
+                   [("", {}, server.accepted_total)])
+            metric("bot_webhook_updates_rejected_total", "counter", "Апдейты, отклоненные из-за переполнения очереди",
+                   [("", {}, server.rejected_total)])
+            metric("bot_webhook_queue_size", "gauge", "Апдейты в очереди вебхука", [("", {}, server.queue.qsize())])
+        return "\n".join(lines) + "\n"
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+        return runner
+
+
+metrics_exporter = MetricsExporter()
 
 
 # --- Состояния для FSM ---
@@ -131,6 +1839,434 @@ class ClarificationState(StatesGroup):
     user_active_dialogue = State()
 
 
+# --- Хранилища состояний FSM ---
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage базы bot.db, переживает перезапуск бота.
+
+    Записи не идут в БД по одной: они копятся в буфере и раз в FSM_FLUSH_INTERVAL
+    сбрасываются одной транзакцией. Чтение сначала смотрит в буфер, поэтому хендлеры
+    сразу видят собственные изменения, затем в LRU-кэш последних известных значений
+    (в том числе "записи нет"), и только при промахе читает таблицу. Кэш верен, пока
+    в таблицу пишет один процесс бота - для нескольких процессов есть FSM_STORAGE=redis.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 cache_size: int = FSM_CACHE_SIZE):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pending: Dict[str, Dict[str, Any]] = {}  # Ключ -> еще не записанные поля ('state' и/или 'data')
+        self._in_flight: Dict[str, Dict[str, Any]] = {}  # Поля, которые записываются прямо сейчас
+        self._cache: OrderedDict[str, Dict[str, Any]] = OrderedDict()  # Ключ -> последние известные поля
+        self._loading: Dict[str, asyncio.Task] = {}  # Идущие чтения таблицы: одно на ключ
+        self._wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flushes_total = 0
+        self.records_flushed_total = 0
+        self.cache_hits_total = 0
+        self.reads_total = 0  # Чтения таблицы при промахе кэша
+
+    def _buffered(self, key: str, field: str):
+        for buffer in (self._pending, self._in_flight):
+            if key in buffer and field in buffer[key]:
+                return True, buffer[key][field]
+        return False, None
+
+    def _remember(self, key: str, fields: Dict[str, Any], overwrite: bool):
+        cached = self._cache.setdefault(key, {})
+        self._cache.move_to_end(key)
+        for field, value in fields.items():
+            # Прочитанное из БД не затирает поле, записанное, пока шло чтение
+            if overwrite or field not in cached:
+                cached[field] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _write(self, key: StorageKey, field: str, value: Any):
+        storage_key = self.key_builder.build(key)
+        self._pending.setdefault(storage_key, {})[field] = value
+        self._remember(storage_key, {field: value}, overwrite=True)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = create_background_task(self._flush_loop())
+        self._wakeup.set()
+
+    async def _get(self, key: StorageKey, field: str) -> Any:
+        storage_key = self.key_builder.build(key)
+        found, value = self._buffered(storage_key, field)
+        if found:
+            return value
+        cached = self._cache.get(storage_key)
+        if cached is not None and field in cached:
+            self._cache.move_to_end(storage_key)
+            self.cache_hits_total += 1
+            return cached[field]
+        # Одновременные апдейты одного чата ждут общее чтение, а не читают таблицу каждый
+        loading = self._loading.get(storage_key)
+        if loading is None or loading.done():
+            loading = self._loading[storage_key] = create_background_task(self._load(storage_key))
+        fields = await asyncio.shield(loading)
+        cached = self._cache.get(storage_key)
+        return cached[field] if cached is not None and field in cached else fields[field]
+
+    async def _load(self, storage_key: str) -> Dict[str, Any]:
+        try:
+            async with self.session_factory() as session:
+                record = await session.get(FSMRecord, storage_key)
+        finally:
+            del self._loading[storage_key]
+        self.reads_total += 1
+        fields = {'state': record.state if record else None,
+                  'data': json.loads(record.data) if record and record.data else {}}
+        self._remember(storage_key, fields, overwrite=False)
+        return fields
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._write(key, 'state', state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._get(key, 'state')
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._write(key, 'data', dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(await self._get(key, 'data'))
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval)  # Собираем записи, пришедшие за окно
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояния FSM в БД: {e}")
+                self._wakeup.set()  # Повторим на следующей итерации
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._in_flight, self._pending = self._pending, {}
+        try:
+            async with self.session_factory() as session:
+                for key, fields in self._in_flight.items():
+                    if fields.get('state', '') is None and fields.get('data') == {}:
+                        # Состояние очищено полностью - запись не нужна
+                        await session.execute(delete(FSMRecord).where(FSMRecord.key == key))
+                        continue
+                    values = {}
+                    if 'state' in fields:
+                        values['state'] = fields['state']
+                    if 'data' in fields:
+                        values['data'] = json.dumps(fields['data'], ensure_ascii=False)
+                    values['updated_at'] = datetime.now()
+                    await session.execute(sqlite_insert(FSMRecord).values(key=key, **values).on_conflict_do_update(
+                        index_elements=[FSMRecord.key], set_=values))
+                await session.commit()
+            self.flushes_total += 1
+            self.records_flushed_total += len(self._in_flight)
+        except BaseException:
+            # Возвращаем несохраненные поля в буфер, не затирая более свежие
+            for key, fields in self._in_flight.items():
+                self._pending[key] = {**fields, **self._pending.get(key, {})}
+            raise
+        finally:
+            self._in_flight = {}
+
+    async def close(self) -> None:
+        if self._flush_task:
+            # Дожидаемся отмены: прерванный сброс возвращает свои записи в буфер до финального flush
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "redis":
+        # Необязательная зависимость: нужна только при FSM_STORAGE=redis
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise ValueError("FSM_STORAGE=redis требует пакет redis: установите его командой pip install redis") from e
+        return RedisStorage.from_url(REDIS_URL)
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(SessionLocal)
+
+
+async def fsm_storage_usage(storage: BaseStorage) -> tuple:
+    """Число записей FSM и объем их данных (байты JSON) для метрик. Redis не учитывается: (0, 0)."""
+    if isinstance(storage, SQLiteStorage):
+        async with storage.session_factory() as session:
+            records, size = (await session.execute(
+                select(func.count(), func.coalesce(func.sum(func.length(FSMRecord.data)), 0)))).one()
+        return records, size
+    if isinstance(storage, MemoryStorage):
+        # MemoryStorage не удаляет очищенные записи - они тоже занимают память
+        return len(storage.storage), sum(len(json.dumps(record.data, ensure_ascii=False, default=str))
+                                         for record in storage.storage.values())
+    return 0, 0
+
+
+# --- Диалоги уточнения ---
+class ClarificationDialogues:
+    """Активные диалоги уточнения с таймаутом простоя.
+
+    Диалог - пара (администратор, пользователь) по одной заявке. Записи упорядочены по времени
+    последнего сообщения (OrderedDict), поэтому фоновая очистка просматривает только самые старые.
+    Если в диалоге никто не пишет дольше idle_timeout, очистка снимает состояние диалога с обеих
+    сторон, возвращает заявку из "Уточнения" и сообщает об этом обоим участникам.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, idle_timeout: int, sweep_interval: float):
+        self.session_factory = session_factory
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.bot: Optional[Bot] = None
+        self.storage: Optional[BaseStorage] = None
+        self.task: Optional[asyncio.Task] = None
+        self._dialogues: OrderedDict = OrderedDict()  # (admin_id, user_id) -> (request_id, время активности)
+        self.expired_total = 0
+        self.fsm_records = 0  # Записи в хранилище FSM на момент последней очистки
+        self.fsm_bytes = 0
+
+    def __len__(self):
+        return len(self._dialogues)
+
+    def touch(self, admin_id: int, user_id: int, request_id: int):
+        """Отмечает начало диалога или новое сообщение в нем."""
+        key = (admin_id, user_id)
+        self._dialogues[key] = (request_id, time.monotonic())
+        self._dialogues.move_to_end(key)
+
+    def end(self, admin_id: int, user_id: int):
+        self._dialogues.pop((admin_id, user_id), None)
+
+    async def start(self, bot: Bot, storage: BaseStorage):
+        self.bot = bot
+        self.storage = storage
+        if isinstance(storage, SQLiteStorage):
+            # Диалоги, начатые до перезапуска: таймаут простоя отсчитывается заново с момента запуска
+            async with self.session_factory() as db_session:
+                records = (await db_session.scalars(select(FSMRecord).where(FSMRecord.state.in_(
+                    (ClarificationState.admin_active_dialogue.state,
+                     ClarificationState.user_active_dialogue.state))))).all()
+            for record in records:
+                data = json.loads(record.data) if record.data else {}
+                chat_id = int(record.key.split(':')[2])  # fsm:<bot_id>:<chat_id>:<user_id>:<destiny>
+                if record.state == ClarificationState.admin_active_dialogue.state:
+                    admin_id, user_id = chat_id, data.get('target_user_id')
+                else:
+                    admin_id, user_id = data.get('target_admin_id'), chat_id
+                if admin_id and user_id and data.get('request_id'):
+                    self.touch(admin_id, user_id, data['request_id'])
+            logger.info(f"Восстановлено активных диалогов уточнения: {len(self._dialogues)}.")
+        if self.idle_timeout:
+            self.task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка при очистке диалогов уточнения: {e}")
+
+    async def sweep(self):
+        deadline = time.monotonic() - self.idle_timeout
+        while self._dialogues:
+            key, (request_id, last_activity) = next(iter(self._dialogues.items()))
+            if last_activity > deadline:
+                break
+            del self._dialogues[key]
+            try:
+                await self._expire(*key, request_id)
+            except Exception as e:
+                logger.error(f"Не удалось завершить диалог уточнения по заявке {request_id}: {e}")
+        self.fsm_records, self.fsm_bytes = await fsm_storage_usage(self.storage)
+
+    async def _expire(self, admin_id: int, user_id: int, request_id: int):
+        cleared = []
+        for chat_id, dialogue_state in ((admin_id, ClarificationState.admin_active_dialogue),
+                                        (user_id, ClarificationState.user_active_dialogue)):
+            context = FSMContext(storage=self.storage,
+                                 key=StorageKey(bot_id=self.bot.id, chat_id=chat_id, user_id=chat_id))
+            # Участник мог уже начать другой диалог - его состояние не трогаем
+            if await context.get_state() == dialogue_state.state and (
+                    await context.get_data()).get('request_id') == request_id:
+                await context.clear()
+                cleared.append(chat_id)
+        if not cleared:
+            return  # Диалог уже завершен кнопкой (например, в другом процессе бота)
+
+        async with self.session_factory() as db_session:
+            request = await db_session.get(Request, request_id, options=[joinedload(Request.creator)])
+            if request:
+                # Как при кнопке "Завершить уточнение": заявка возвращается в "Принято к исполнению"
+                await apply_transition(db_session, "clarify_end", request)
+            for chat_id in cleared:
+                enqueue_message(
+                    db_session, chat_id, "send_message",
+                    text=f"⌛ Диалог уточнения по заявке ID:{request_id} завершен автоматически: "
+                         f"сообщений не было {self.idle_timeout // 60} мин.")
+            await db_session.commit()
+        self.expired_total += 1
+        logger.info(f"Диалог уточнения по заявке {request_id} (администратор {admin_id}, "
+                    f"пользователь {user_id}) завершен по таймауту.")
+
+
+clarification_dialogues = ClarificationDialogues(SessionLocal, DIALOGUE_IDLE_TIMEOUT, DIALOGUE_SWEEP_INTERVAL)
+
+
+def clarification_relay_header(request: Request, user_full_name: Optional[str] = None) -> str:
+    """Заголовок пересылаемых сообщений диалога. Считается один раз при начале диалога и хранится
+    в FSM-данных отправителя, чтобы пересылка сообщения не читала заявку и профиль из БД."""
+    sender = f"пользователя {user_full_name}" if user_full_name else "администратора"
+    return f"💬 От {sender} по заявке ID:{request.id} ({request.description[:50]})"
+
+
+async def relay_clarification_message(message: Message, bot: Bot, db_session: AsyncSession, request_id: int,
+                                      target_chat_id: int, relay_header: str):
+    """Пересылает сообщение диалога второй стороне и записывает его в историю.
+
+    Вложение копируется через copy_message: бот не скачивает и не загружает файл заново,
+    а в request_attachments сохраняется его file_id.
+    """
+    attachment = extract_attachment(message)
+    if attachment is None:
+        await bot.send_message(chat_id=target_chat_id, text=f"{relay_header}\n\n{message.text}")
+        request_message_log.add(request_id, message.from_user.id, target_chat_id, message.text)
+        return
+    caption = f"{relay_header}\n\n{message.caption}" if message.caption else relay_header
+    await bot.copy_message(chat_id=target_chat_id, from_chat_id=message.chat.id, message_id=message.message_id,
+                           caption=caption[:1024])  # Лимит Telegram на подпись
+    db_session.add(RequestAttachment(request_id=request_id, sender_id=message.from_user.id, **attachment))
+    request_message_log.add(request_id, message.from_user.id, target_chat_id,
+                            f"📎 {ATTACHMENT_LABELS[attachment['kind']]} {message.caption or ''}".rstrip())
+
+
+# --- История переписки по заявкам ---
+class RequestMessageLog:
+    """Запись пересланных сообщений диалогов уточнения в request_messages.
+
+    Как и SQLiteStorage, не пишет в БД на каждое сообщение: строки копятся в буфере
+    и раз в flush_interval вставляются одной транзакцией.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, flush_interval: float = MESSAGE_LOG_FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._pending: list = []
+        self._wakeup = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.messages_logged_total = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, request_id: int, sender_id: int, recipient_id: int, text: str):
+        self._pending.append(dict(request_id=request_id, sender_id=sender_id, recipient_id=recipient_id,
+                                  text=text, created_at=datetime.now()))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = create_background_task(self._flush_loop())
+        self._wakeup.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval)  # Собираем сообщения, пришедшие за окно
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось сохранить историю переписки в БД: {e}")
+                self._wakeup.set()  # Повторим на следующей итерации
+
+    async def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            async with self.session_factory() as session:
+                await session.execute(RequestMessage.__table__.insert(), rows)
+                await session.commit()
+            self.messages_logged_total += len(rows)
+        except BaseException:
+            self._pending = rows + self._pending  # Сохраняем порядок сообщений
+            raise
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+
+request_message_log = RequestMessageLog(SessionLocal)
+
+
+# --- Вложения ---
+# Тип вложения -> подпись в истории. Тип совпадает с полем Message и с методом Bot.send_<тип>
+ATTACHMENT_LABELS = {"photo": "Фото", "document": "Документ", "voice": "Голосовое сообщение",
+                     "video": "Видео", "audio": "Аудио"}
+ATTACHMENT_FILTER = F.photo | F.document | F.voice | F.video | F.audio
+
+
+def extract_attachment(message: Message) -> Optional[dict]:
+    """Метаданные вложения сообщения (поля RequestAttachment) или None. Файл не скачивается."""
+    for kind in ATTACHMENT_LABELS:
+        media = getattr(message, kind)
+        if not media:
+            continue
+        if kind == "photo":
+            media = media[-1]  # Самый крупный из размеров фото
+        return dict(kind=kind, file_id=media.file_id, file_unique_id=media.file_unique_id,
+                    file_name=getattr(media, 'file_name', None), file_size=media.file_size)
+    return None
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ (например, StorageKey чата). Запись удаляется, когда замок больше никто не ждет."""
+
+    def __init__(self):
+        self._locks: Dict[Any, list] = {}  # Ключ -> [замок, число держащих и ожидающих]
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+# Файлы альбома приходят отдельными апдейтами и обрабатываются параллельно: чтение и дополнение
+# списка вложений в данных FSM выполняются под замком чата, иначе одновременные записи теряют файлы
+attachment_locks = KeyedLocks()
+
+
+def enqueue_attachment(db_session: AsyncSession, chat_id: int, attachment: dict, caption: str):
+    # send_photo(photo=file_id), send_document(document=file_id) и т.д.: Telegram не загружает файл заново
+    enqueue_message(db_session, chat_id, f"send_{attachment['kind']}",
+                    **{attachment['kind']: attachment['file_id']}, caption=caption)
+
+
 # --- Клавиатуры ---
 
 # Главное меню
@@ -188,15 +2324,6 @@ def get_admin_post_clarification_keyboard(request_id: int) -> InlineKeyboardMark
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-# Кнопки для пользователя в разделе "Мои заявки"
-def get_user_request_actions_keyboard(request_id: int, status: str) -> InlineKeyboardMarkup:
-    buttons = []
-    if status != "Выполнено":
-        buttons.append([InlineKeyboardButton(text="Отметить как выполнено", callback_data=f"user_done_{request_id}")])
-    buttons.append([InlineKeyboardButton(text="Задать уточнение", callback_data=f"user_clarify_start_{request_id}")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-
 # Кнопки для пользователя во время активного диалога уточнения
 def get_user_clarify_active_keyboard(request_id: int) -> InlineKeyboardMarkup:
     buttons = [
@@ -215,6 +2342,453 @@ def get_organization_selection_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+# --- Постраничные списки заявок ---
+# Список "Мои заявки"/"Мои принятые заявки" выводится одним сообщением на страницу.
+# Страницы выбираются по ключу (created_at, id) от первой/последней заявки текущей страницы,
+# поэтому из БД читается только одна страница. callback_data кнопок навигации:
+# list_<user|admin>_<first|next|prev|cur>_<курсор>, курсор - created_at и id заявки.
+REQUESTS_PAGE_SIZE = 5
+LIST_DESCRIPTION_LIMIT = 300  # Длинные описания в списке обрезаются, чтобы страница влезла в сообщение
+
+
+def _page_cursor(request: Request) -> str:
+    return f"{request.created_at.strftime('%Y%m%d%H%M%S%f')}_{request.id}"
+
+
+def _parse_page_cursor(cursor: str) -> tuple:
+    created_at, request_id = cursor.split('_')
+    return datetime.strptime(created_at, '%Y%m%d%H%M%S%f'), int(request_id)
+
+
+def _without_index(column):
+    """Унарный плюс: по выражению +column SQLite не выбирает индекс ни для условия, ни для сортировки."""
+    return UnaryExpression(column, operator=operators.custom_op("+"), type_=column.type)
+
+
+def recent_owner_requests(owner_column, owner_id: int, completed_since: datetime, *conditions):
+    """id и created_at незавершенных заявок владельца и выполненных не раньше completed_since.
+
+    Каждая ветка UNION читает по индексу (владелец, status, completed_at) только незавершенные и
+    недавно выполненные заявки. Обход индекса (владелец, created_at, id) от курсора на последних
+    страницах просматривал бы всю историю владельца, поэтому created_at в условиях взят через +.
+    """
+    return union_all(
+        select(Request.id, Request.created_at).where(
+            owner_column == owner_id, Request.status.in_(OPEN_STATUSES), *conditions),
+        select(Request.id, Request.created_at).where(
+            owner_column == owner_id, Request.status == RequestStatus.DONE, Request.completed_at >= completed_since,
+            *conditions),
+    ).subquery()
+
+
+async def fetch_requests_page(db_session: AsyncSession, owner: str, owner_id: int, direction: str = "first",
+                              cursor: Optional[str] = None) -> tuple:
+    """Возвращает (заявки страницы от новых к старым, есть ли более новые, есть ли более старые).
+
+    direction: first - первая страница, next - более старые заявки после курсора,
+    prev - более новые до курсора, cur - страница, начинающаяся с курсора (обновление).
+    """
+    two_days_ago = datetime.now() - timedelta(days=2)
+    owner_column = Request.user_id if owner == "user" else Request.assigned_admin_id
+    conditions = []
+    key = tuple_(_without_index(Request.created_at), Request.id)
+
+    if cursor is None:
+        direction = "first"
+    else:
+        cursor_key = tuple_(*_parse_page_cursor(cursor))
+    if direction == "next":
+        conditions.append(key < cursor_key)
+    elif direction == "prev":
+        conditions.append(key > cursor_key)
+    elif direction == "cur":
+        conditions.append(key <= cursor_key)
+
+    recent = recent_owner_requests(owner_column, owner_id, two_days_ago, *conditions)
+    page_ids = select(recent.c.id).limit(REQUESTS_PAGE_SIZE + 1)
+    query = select(Request).options(joinedload(Request.creator), joinedload(Request.assignee))
+    if direction == "prev":
+        page_ids = page_ids.order_by(_without_index(recent.c.created_at), recent.c.id)
+        query = query.order_by(Request.created_at, Request.id)
+    else:
+        page_ids = page_ids.order_by(_without_index(recent.c.created_at).desc(), recent.c.id.desc())
+        query = query.order_by(Request.created_at.desc(), Request.id.desc())
+    requests = list((await db_session.scalars(query.where(Request.id.in_(page_ids)))).all())
+    has_more = len(requests) > REQUESTS_PAGE_SIZE
+    requests = requests[:REQUESTS_PAGE_SIZE]
+
+    if direction == "prev":
+        requests.reverse()
+        return requests, has_more, True
+    if direction == "next":
+        return requests, True, has_more
+    if direction == "cur":
+        if not requests:
+            # Заявки страницы выпали из списка - показываем первую страницу
+            return await fetch_requests_page(db_session, owner, owner_id)
+        newer = recent_owner_requests(owner_column, owner_id, two_days_ago, key > cursor_key)
+        has_newer = await db_session.scalar(select(select(newer.c.id).exists()))
+        return requests, bool(has_newer), has_more
+    return requests, False, has_more
+
+
+def _format_list_description(description: str) -> str:
+    if len(description) > LIST_DESCRIPTION_LIMIT:
+        return description[:LIST_DESCRIPTION_LIMIT] + "..."
+    return description
+
+
+def format_user_request_item(req: Request) -> str:
+    admin_info = ""
+    if req.assignee:
+        admin_info = f"Исполнитель: {req.assignee.full_name}\n"
+
+    text = (
+        f"--- Заявка ID: {req.id} ({req.request_type}) ---\n"
+        f"Описание: {_format_list_description(req.description)}\n"
+        f"Срочность: {'Как можно скорее' if req.urgency == 'ASAP' else f'К {req.due_date}'}\n"
+        f"Статус: {req.status.label}\n"
+        f"{admin_info}"
+        f"Создана: {req.created_at.strftime('%Y-%m-%d %H:%M')}\n"
+    )
+    if req.status == RequestStatus.DONE and req.completed_at:
+        text += f"Выполнена: {req.completed_at.strftime('%Y-%m-%d %H:%M')}\n"
+    return text
+
+
+def format_admin_request_item(req: Request) -> str:
+    user = req.creator
+    user_info = f"{user.full_name}, {user.organization}, {user.phone_number}"
+    if user and user.office_number:
+        user_info += f", каб. {user.office_number}"
+
+    return (
+        f"--- Заявка ID: {req.id} ({req.request_type}) ---\n"
+        f"От: {user_info}\n"
+        f"Описание: {_format_list_description(req.description)}\n"
+        f"Срочность: {'Как можно скорее' if req.urgency == 'ASAP' else f'К {req.due_date}'}\n"
+        f"Статус: {req.status.label}\n"
+    )
+
+
+def get_user_list_item_buttons(req: Request) -> list:
+    buttons = []
+    if req.status != RequestStatus.DONE:
+        buttons.append(InlineKeyboardButton(text=f"✅ Выполнено #{req.id}", callback_data=f"user_done_{req.id}"))
+    buttons.append(InlineKeyboardButton(text=f"❓ Уточнить #{req.id}", callback_data=f"user_clarify_start_{req.id}"))
+    buttons.append(InlineKeyboardButton(text=f"📜 История #{req.id}", callback_data=f"history_{req.id}_last_0"))
+    return buttons
+
+
+def get_admin_list_item_buttons(req: Request) -> list:
+    history = InlineKeyboardButton(text=f"📜 #{req.id}", callback_data=f"history_{req.id}_last_0")
+    if req.status == RequestStatus.NEW:
+        return [InlineKeyboardButton(text=f"Принять #{req.id}", callback_data=f"admin_accept_{req.id}"),
+                InlineKeyboardButton(text=f"Уточнить #{req.id}", callback_data=f"admin_clarify_start_{req.id}"),
+                history]
+    if req.status == RequestStatus.IN_PROGRESS:
+        return [InlineKeyboardButton(text=f"Выполнено #{req.id}", callback_data=f"admin_done_{req.id}"), history]
+    if req.status == RequestStatus.CLARIFICATION:
+        return [InlineKeyboardButton(text=f"Завершить уточнение #{req.id}",
+                                     callback_data=f"admin_clarify_end_{req.id}"), history]
+    return [history]  # Для выполненных заявок (в рамках 2 дней) остается только история
+
+
+async def build_requests_page(db_session: AsyncSession, owner: str, owner_id: int, direction: str = "first",
+                              cursor: Optional[str] = None) -> tuple:
+    """Текст и клавиатура страницы списка; (None, None), если заявок нет."""
+    requests, has_newer, has_older = await fetch_requests_page(db_session, owner, owner_id, direction, cursor)
+    if not requests:
+        return None, None
+
+    if owner == "user":
+        title, format_item, item_buttons = "Ваши заявки:", format_user_request_item, get_user_list_item_buttons
+    else:
+        title, format_item, item_buttons = "Ваши принятые заявки:", format_admin_request_item, get_admin_list_item_buttons
+    text = "\n".join([title] + [format_item(req) for req in requests])
+
+    keyboard = [buttons for buttons in (item_buttons(req) for req in requests) if buttons]
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Новее", callback_data=f"list_{owner}_prev_{_page_cursor(requests[0])}"))
+    # Кнопка обновления есть на каждой странице: по ней хендлеры действий узнают сообщение-список
+    navigation.append(InlineKeyboardButton(
+        text="🔄 Обновить", callback_data=f"list_{owner}_cur_{_page_cursor(requests[0])}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton(
+            text="Старее ➡️", callback_data=f"list_{owner}_next_{_page_cursor(requests[-1])}"))
+    keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_list_page_refresh_data(message: Optional[Message]) -> Optional[str]:
+    """callback_data кнопки "Обновить", если сообщение - страница списка заявок."""
+    if not message or not message.reply_markup:
+        return None
+    for row in message.reply_markup.inline_keyboard:
+        for button in row:
+            if button.callback_data and button.callback_data.startswith("list_") and "_cur_" in button.callback_data:
+                return button.callback_data
+    return None
+
+
+async def refresh_list_page(bot: Bot, db_session: AsyncSession, chat_id: int, message_id: int, refresh_data: str):
+    """Перерисовывает страницу списка после действия с заявкой (вместо дописывания статуса в сообщение)."""
+    _, owner, direction, cursor = refresh_data.split('_', 3)
+    text, keyboard = await build_requests_page(db_session, owner, chat_id, direction, cursor)
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                    text=text or "Заявок в списке не осталось.", reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # "message is not modified" - страница уже актуальна
+        logger.debug(f"Страница списка {message_id} в чате {chat_id} не обновлена: {e}")
+
+
+# --- История переписки: постраничный просмотр ---
+# Страница - HISTORY_PAGE_SIZE сообщений по ключу id. Сначала показываются последние сообщения.
+# callback_data: history_<id заявки>_<last|prev|next>_<курсор>, курсор - id первого/последнего сообщения.
+HISTORY_PAGE_SIZE = 10
+HISTORY_MESSAGE_LIMIT = 300  # Длинные сообщения на странице обрезаются
+
+
+def can_view_request_history(request, user_id: int) -> bool:
+    return (user_id in (request.user_id, request.assigned_admin_id)
+            or REQUEST_TYPE_ADMIN_TYPES.get(request.request_type) in admin_roster.admin_types(user_id))
+
+
+async def build_history_page(db_session: AsyncSession, request, direction: str = "last",
+                             cursor: int = 0) -> tuple:
+    """Текст и клавиатура страницы истории; (None, None), если сообщений нет."""
+    conditions = [RequestMessage.request_id == request.id]
+    if direction == "prev":
+        conditions.append(RequestMessage.id < cursor)
+    elif direction == "next":
+        conditions.append(RequestMessage.id > cursor)
+    query = select(RequestMessage).where(*conditions).limit(HISTORY_PAGE_SIZE + 1)
+    if direction == "next":
+        query = query.order_by(RequestMessage.id)
+    else:
+        query = query.order_by(RequestMessage.id.desc())
+    messages = list((await db_session.scalars(query)).all())
+    has_more = len(messages) > HISTORY_PAGE_SIZE
+    messages = messages[:HISTORY_PAGE_SIZE]
+    if not messages:
+        return None, None
+    if direction == "next":
+        has_older, has_newer = True, has_more
+    else:
+        messages.reverse()
+        has_older, has_newer = has_more, direction == "prev"
+
+    creator = await user_profile_cache.get(db_session, request.user_id)
+    creator_name = creator.full_name if creator and creator.full_name else "Пользователь"
+    lines = [f"📜 История уточнений по заявке ID:{request.id}"]
+    for item in messages:
+        sender = creator_name if item.sender_id == request.user_id else "Администратор"
+        text = item.text if len(item.text) <= HISTORY_MESSAGE_LIMIT else item.text[:HISTORY_MESSAGE_LIMIT] + "..."
+        lines.append(f"\n{item.created_at.strftime('%Y-%m-%d %H:%M')} {sender}:\n{text}")
+
+    navigation = []
+    if has_older:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Раньше", callback_data=f"history_{request.id}_prev_{messages[0].id}"))
+    if has_newer:
+        navigation.append(InlineKeyboardButton(
+            text="Позже ➡️", callback_data=f"history_{request.id}_next_{messages[-1].id}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[navigation] if navigation else [])
+
+
+# --- Полнотекстовый поиск заявок ---
+# /search <текст> ищет по описанию заявки и переписке уточнений (таблица requests_fts, FTS5).
+# Результаты упорядочены по релевантности (bm25) среди всех совпадений, при равной - от новых к старым;
+# сортировка и OFFSET страницы выполняются в самом запросе FTS5, без чтения таблиц заявок.
+# Текст запроса не помещается в callback_data, поэтому кнопки навигации хранят только
+# номер страницы, а запрос берется из первой строки сообщения.
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_TERMS = 8
+SEARCH_TITLE_PREFIX = "🔎 Поиск: "
+
+requests_fts = table("requests_fts", column("rowid"), column("rank"), column("request_type"))
+
+
+def build_fts_query(text: str) -> Optional[str]:
+    """Запрос FTS5 из произвольного текста: каждое слово ищется как префикс ("принтер"* найдет "принтера").
+    Синтаксис FTS5 (кавычки, NEAR, -) из пользовательского текста не используется."""
+    words = re.findall(r"\w+", text.lower())[:SEARCH_MAX_TERMS]
+    if not words:
+        return None
+    # Ищем только в тексте заявки: служебная колонка user_id в поиске по словам не участвует
+    return "{description messages} : (" + " ".join(f'"{word}"*' for word in words) + ")"
+
+
+def search_scope(user_id: int, fts_query: str) -> tuple:
+    """Видимость заявок в поиске: (запрос FTS5, условия WHERE) для requests_fts.
+
+    Администратор видит заявки своих типов, пользователь - свои: его ID добавляется в сам запрос FTS5.
+    """
+    request_types = [request_type for request_type, admin_type in REQUEST_TYPE_ADMIN_TYPES.items()
+                     if admin_type in admin_roster.admin_types(user_id)]
+    if not request_types:
+        return f'user_id : "{user_id}" AND {fts_query}', []
+    if len(request_types) == len(REQUEST_TYPE_ADMIN_TYPES):
+        return fts_query, []
+    return fts_query, [requests_fts.c.request_type.in_(request_types)]
+
+
+async def build_search_page(db_session: AsyncSession, user_id: int, text: str, page: int = 0) -> tuple:
+    """Текст и клавиатура страницы результатов; (None, None), если ничего не найдено."""
+    fts_query = build_fts_query(text)
+    if fts_query is None:
+        return None, None
+    # Страница отбирается и ранжируется целиком в FTS (индекс содержит и оперативные, и архивные заявки),
+    # после чего ее заявки читаются из обеих таблиц по первичному ключу
+    fts_query, conditions = search_scope(user_id, fts_query)
+    request_ids = (await db_session.scalars(
+        select(requests_fts.c.rowid)
+        .where(literal_column("requests_fts").op("MATCH")(fts_query), *conditions)
+        .order_by(requests_fts.c.rank, requests_fts.c.rowid.desc())
+        .offset(page * SEARCH_PAGE_SIZE).limit(SEARCH_PAGE_SIZE + 1))).all()
+    has_more = len(request_ids) > SEARCH_PAGE_SIZE
+    request_ids = request_ids[:SEARCH_PAGE_SIZE]
+    if not request_ids:
+        return None, None
+    found = {req.id: req for req in (await db_session.execute(union_all(
+        select(Request.__table__).where(Request.id.in_(request_ids)),
+        select(*(ArchivedRequest.__table__.c[c.name] for c in Request.__table__.c))
+        .where(ArchivedRequest.id.in_(request_ids))))).all()}
+    requests = [found[request_id] for request_id in request_ids if request_id in found]
+    if not requests:
+        return None, None
+
+    lines = [f"{SEARCH_TITLE_PREFIX}{text}"]
+    for req in requests:
+        lines.append(f"\nID:{req.id} ({req.request_type}) от {req.created_at.strftime('%Y-%m-%d')}, "
+                     f"{req.status.label}\n{_format_list_description(req.description[:100])}")
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"search_{page - 1}"))
+    if has_more:
+        navigation.append(InlineKeyboardButton(text="Дальше ➡️", callback_data=f"search_{page + 1}"))
+    keyboard = [[InlineKeyboardButton(text=f"📜 #{req.id}", callback_data=f"history_{req.id}_last_0")
+                 for req in requests[i:i + 5]] for i in range(0, len(requests), 5)]
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+# --- Выгрузка заявок ---
+# /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [xlsx] - все заявки за период (включая архив) с данными
+# пользователей в порядке ID. Строки читаются из БД порциями по ключу (ID больше последнего выгруженного),
+# каждая порция - в своей короткой сессии: долгая читающая транзакция не дает SQLite перенести WAL
+# в основной файл (checkpoint), и журнал растет всю выгрузку. Порция сразу дописывается во временный
+# файл в отдельном потоке, поэтому выгрузка не держит все строки в памяти и не останавливает цикл событий.
+EXPORT_COLUMNS = ["ID", "Тип", "Статус", "Срочность", "Желаемый срок", "Создана", "Принята", "Выполнена",
+                  "Описание", "Пользователь", "Телефон", "Организация", "Кабинет", "Исполнитель"]
+
+
+def build_export_query(request_types: list, date_from: datetime, date_to: datetime):
+    """Порция выгрузки: до EXPORT_CHUNK_SIZE заявок за период с ID больше параметра after_id.
+
+    Запрос строится один раз на выгрузку и выполняется для каждой порции с новым after_id.
+    """
+    after_id = bindparam("after_id", type_=Integer)
+
+    def chunk(requests_table):
+        # ORDER BY и LIMIT в каждой ветке UNION: SQLite идет по первичному ключу таблицы от after_id
+        # и останавливается, набрав порцию, а не отбирает и сортирует весь остаток периода
+        return select(*(requests_table.c[column.name] for column in Request.__table__.c)).where(
+            requests_table.c.id > after_id, requests_table.c.request_type.in_(request_types),
+            requests_table.c.created_at >= date_from, requests_table.c.created_at < date_to,
+        ).order_by(requests_table.c.id).limit(EXPORT_CHUNK_SIZE).subquery()
+    live, archive = chunk(Request.__table__), chunk(ArchivedRequest.__table__)
+    all_requests = union_all(select(live), select(archive)).subquery("all_requests")
+    creator = aliased(User)
+    assignee = aliased(User)
+    return (
+        select(all_requests.c.id, all_requests.c.request_type, all_requests.c.status, all_requests.c.urgency,
+               all_requests.c.due_date, all_requests.c.created_at, all_requests.c.accepted_at,
+               all_requests.c.completed_at, all_requests.c.description, creator.full_name, creator.phone_number,
+               creator.organization, creator.office_number, assignee.full_name)
+        .outerjoin(creator, creator.id == all_requests.c.user_id)
+        .outerjoin(assignee, assignee.id == all_requests.c.assigned_admin_id)
+        .order_by(all_requests.c.id)
+        .limit(EXPORT_CHUNK_SIZE)
+    )
+
+
+def _export_row(row) -> list:
+    values = list(row)
+    values[2] = row.status.label if row.status else ""
+    values[3] = "Как можно скорее" if row.urgency == "ASAP" else "К дате"
+    for index in (5, 6, 7):
+        values[index] = values[index].strftime("%Y-%m-%d %H:%M") if values[index] else ""
+    return ["" if value is None else value for value in values]
+
+
+class _CsvExportWriter:
+    extension = "csv"
+
+    def __init__(self, path: str):
+        # BOM - чтобы Excel открыл кириллицу без выбора кодировки
+        self.file = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.file, delimiter=";")
+        self.writer.writerow(EXPORT_COLUMNS)
+
+    def write(self, rows: list):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class _XlsxExportWriter:
+    extension = "xlsx"
+
+    def __init__(self, path: str):
+        # Импорт при первой выгрузке в XLSX: openpyxl больше нигде не нужен, а загружается заметное время
+        from openpyxl import Workbook
+        self.path = path
+        self.workbook = Workbook(write_only=True)  # Строки сбрасываются во временный файл, а не копятся в памяти
+        self.sheet = self.workbook.create_sheet("Заявки")
+        self.sheet.append(EXPORT_COLUMNS)
+
+    def write(self, rows: list):
+        for row in rows:
+            self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+
+async def export_requests(session_factory: async_sessionmaker, request_types: list, date_from: datetime,
+                          date_to: datetime, file_format: str, path: str) -> int:
+    """Пишет заявки за период в файл path; возвращает число строк."""
+    writer = await asyncio.to_thread(_XlsxExportWriter if file_format == "xlsx" else _CsvExportWriter, path)
+    query = build_export_query(request_types, date_from, date_to)
+    exported = 0
+    last_id = 0
+    try:
+        while True:
+            # Сессия закрывается до записи в файл: между порциями транзакция чтения не открыта
+            async with session_factory() as db_session:
+                rows = (await db_session.execute(query, {"after_id": last_id})).all()
+            if rows:
+                await asyncio.to_thread(writer.write, [_export_row(row) for row in rows])
+                exported += len(rows)
+                last_id = rows[-1].id
+            if len(rows) < EXPORT_CHUNK_SIZE:
+                break
+    finally:
+        await asyncio.to_thread(writer.close)
+    return exported
+
+
+def _zip_file(path: str, archive_path: str, name: str):
+    with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.write(path, arcname=name)
+
+
 # --- Хендлеры ---
 
 # Инициализация роутеров
@@ -223,9 +2797,8 @@ router = Dispatcher()
 
 # --- Хендлер команды /start ---
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
-    db = next(get_db())
-    user = db.query(User).filter(User.id == message.from_user.id).first()
+async def cmd_start(message: Message, state: FSMContext, db: AsyncSession):
+    user = await user_profile_cache.get(db, message.from_user.id)
 
     # Очищаем все активные состояния при /start
     await state.clear()
@@ -234,14 +2807,15 @@ async def cmd_start(message: Message, state: FSMContext):
         new_user = User(id=message.from_user.id)
         db.add(new_user)
         try:
-            db.commit()
-            db.refresh(new_user)
+            await db.commit()
+            await db.refresh(new_user)
+            user_profile_cache.put(new_user)
             logger.info(f"Новый пользователь {message.from_user.id} добавлен в БД.")
         except IntegrityError:
-            db.rollback()
+            await db.rollback()
             logger.warning(
                 f"Пользователь {message.from_user.id} уже существует, но не был найден в начале сессии. Продолжаем.")
-            user = db.query(User).filter(User.id == message.from_user.id).first()
+            user = await user_profile_cache.get(db, message.from_user.id)
             if not user:
                 await message.answer("Произошла ошибка при инициализации пользователя. Попробуйте еще раз.")
                 return
@@ -257,6 +2831,168 @@ async def cmd_start(message: Message, state: FSMContext):
         await state.clear()
 
 
+# Перечитывает таблицу admins (например, после ее ручного изменения) без перезапуска бота
+@router.message(Command("reload_admins"))
+async def reload_admins(message: Message, db: AsyncSession):
+    if not admin_roster.is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой функции.")
+        return
+    await admin_roster.reload(db)
+    await admin_workload.reload(db)
+    await message.answer(f"Список администраторов обновлен. ИТ: {len(admin_roster.recipients('IT'))}, "
+                         f"АХО: {len(admin_roster.recipients('AHO'))}.")
+
+
+# Поиск по заявкам: /search <текст>
+@router.message(Command("search"))
+async def search_requests(message: Message, command: CommandObject, db: AsyncSession):
+    text = (command.args or "").strip()
+    if not text:
+        await message.answer("Укажите, что искать, например: /search принтер")
+        return
+    user = await user_profile_cache.get(db, message.from_user.id)
+    if not user or not user.registered:
+        await message.answer("Вы не зарегистрированы. Пожалуйста, начните с команды /start.")
+        return
+    page_text, keyboard = await build_search_page(db, message.from_user.id, text)
+    await message.answer(page_text or "Ничего не найдено.", reply_markup=keyboard)
+
+
+# Отчет по заявкам для администраторов: /stats [число дней], по умолчанию неделя
+@router.message(Command("stats"))
+async def show_stats(message: Message, command: CommandObject, db: AsyncSession):
+    if not admin_roster.is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой функции.")
+        return
+    days = int(command.args) if command.args and command.args.strip().isdigit() else 7
+    days = min(max(days, 1), 366)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="📄 Выгрузить CSV", callback_data=f"stats_csv_{days}")]])
+    await message.answer(await build_stats_report(db, message.from_user.id, days), reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("stats_csv_"))
+async def export_stats_csv(callback_query: CallbackQuery, db: AsyncSession):
+    await callback_query.answer()
+    if not admin_roster.is_admin(callback_query.from_user.id):
+        await callback_query.message.answer("У вас нет доступа к этой функции.")
+        return
+    days = int(callback_query.data.split('_')[2])
+    content = await build_stats_csv(db, callback_query.from_user.id, days)
+    await callback_query.message.answer_document(
+        BufferedInputFile(content, filename=f"stats_{datetime.now().strftime('%Y%m%d')}_{days}d.csv"),
+        caption=f"Статистика за {days} дн.")
+
+
+# Выгрузка заявок за период для администраторов
+@router.message(Command("export"))
+async def export_requests_command(message: Message, command: CommandObject, db: AsyncSession):
+    if not admin_roster.is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой функции.")
+        return
+    args = (command.args or "").split()
+    file_format = "xlsx" if "xlsx" in (arg.lower() for arg in args) else "csv"
+    try:
+        dates = [datetime.strptime(arg, "%Y-%m-%d") for arg in args if arg.lower() != "xlsx"]
+    except ValueError:
+        await message.answer("Формат: /export [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [xlsx], например: "
+                             "/export 2025-01-01 2025-03-31 xlsx")
+        return
+    date_to = dates[1] if len(dates) > 1 else datetime.now()
+    date_from = dates[0] if dates else date_to - timedelta(days=EXPORT_DEFAULT_DAYS)
+    date_to = date_to.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)  # Включительно
+
+    period = f"{date_from.strftime('%Y-%m-%d')}_{(date_to - timedelta(days=1)).strftime('%Y-%m-%d')}"
+    await message.answer(f"Готовлю выгрузку заявок за {period.replace('_', ' - ')}...")
+    with tempfile.TemporaryDirectory() as directory:
+        filename = f"requests_{period}.{file_format}"
+        path = os.path.join(directory, filename)
+        try:
+            exported = await export_requests(SessionLocal, stats_scope(message.from_user.id), date_from, date_to,
+                                             file_format, path)
+        except ImportError:
+            await message.answer("Выгрузка в XLSX недоступна: не установлен пакет openpyxl. Используйте CSV.")
+            return
+        if not exported:
+            await message.answer("За этот период заявок нет.")
+            return
+        if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+            # Большой CSV хорошо сжимается; XLSX уже сжат
+            archive_path = f"{path}.zip"
+            await asyncio.to_thread(_zip_file, path, archive_path, filename)
+            path, filename = archive_path, f"{filename}.zip"
+            if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+                await message.answer("Файл выгрузки больше 50 МБ. Пожалуйста, выберите период короче.")
+                return
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"Заявок: {exported}")
+    logger.info(f"Администратор {message.from_user.id} выгрузил {exported} заявок за {period} ({file_format}).")
+
+
+# Ручное назначение исполнителя (в том числе поверх автоназначения): /assign <ID заявки> [ID администратора],
+# без ID администратора заявка назначается тому, кто выполнил команду
+@router.message(Command("assign"))
+async def assign_request_command(message: Message, command: CommandObject, db: AsyncSession):
+    if not admin_roster.is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой функции.")
+        return
+    args = (command.args or "").split()
+    if not 1 <= len(args) <= 2 or not all(arg.isdigit() for arg in args):
+        await message.answer("Формат: /assign <ID заявки> [ID администратора], например: /assign 15 123456789.\n"
+                             "Без ID администратора заявка назначается вам.")
+        return
+    request_id = int(args[0])
+    admin_id = int(args[1]) if len(args) > 1 else message.from_user.id
+
+    request = await db.get(Request, request_id, options=[joinedload(Request.creator)])
+    if not request:
+        await message.answer("Заявка не найдена.")
+        return
+    admin_type = REQUEST_TYPE_ADMIN_TYPES.get(request.request_type)
+    if admin_type not in admin_roster.admin_types(message.from_user.id):
+        await message.answer("Вы не можете назначать исполнителей заявок этого типа.")
+        return
+    if admin_type not in admin_roster.admin_types(admin_id):
+        await message.answer(f"Пользователь {admin_id} не является администратором заявок типа {request.request_type}.")
+        return
+    if request.status not in (RequestStatus.NEW, RequestStatus.IN_PROGRESS):
+        await message.answer(f"Заявку со статусом \"{request.status.label}\" нельзя переназначить.")
+        return
+    if request.assigned_admin_id == admin_id:
+        await message.answer("Этот администратор уже назначен исполнителем заявки.")
+        return
+
+    # Имена читаются до UPDATE: после него транзакция держит блокировку записи SQLite
+    assignee = await user_profile_cache.get(db, admin_id)
+    actor = await user_profile_cache.get(db, message.from_user.id)
+    assignee_name = assignee.full_name if assignee else str(admin_id)
+    if not await reassign_request(db, request, admin_id, assignee_name,
+                                  actor.full_name if actor else "Неизвестный администратор"):
+        await db.rollback()
+        status = await db.scalar(select(Request.status).where(Request.id == request_id))
+        await message.answer(f"Заявку со статусом \"{status.label}\" нельзя переназначить.")
+        return
+    await db.commit()
+    await message.answer(f"Заявка ID:{request_id} назначена исполнителю {assignee_name} "
+                         f"(открытых заявок у исполнителя: {admin_workload.load(admin_id)}).")
+    logger.info(f"Заявка ID:{request_id} переназначена администратором {message.from_user.id} на {admin_id}.")
+
+
+@router.callback_query(F.data.startswith("search_"))
+async def paginate_search_results(callback_query: CallbackQuery, db: AsyncSession):
+    await callback_query.answer()
+    title = (callback_query.message.text or "").split("\n", 1)[0]
+    if not title.startswith(SEARCH_TITLE_PREFIX):
+        return
+    page_text, keyboard = await build_search_page(db, callback_query.from_user.id,
+                                                  title[len(SEARCH_TITLE_PREFIX):], int(callback_query.data.split('_')[1]))
+    if not page_text:
+        return
+    try:
+        await callback_query.message.edit_text(page_text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        logger.debug(f"Страница поиска не обновлена: {e}")
+
+
 # --- Хендлеры регистрации ---
 @router.message(RegistrationStates.waiting_for_full_name)
 async def process_full_name(message: Message, state: FSMContext):
@@ -286,7 +3022,7 @@ async def process_phone_number(message: Message, state: FSMContext):
 
 # Хендлер для выбора организации из инлайн-клавиатуры
 @router.callback_query(RegistrationStates.waiting_for_organization_choice, F.data.startswith("org_idx_"))
-async def process_organization_selection(callback_query: CallbackQuery, state: FSMContext):
+async def process_organization_selection(callback_query: CallbackQuery, state: FSMContext, db: AsyncSession):
     await callback_query.answer()
     org_index = int(callback_query.data.split('_')[2])
 
@@ -302,7 +3038,7 @@ async def process_organization_selection(callback_query: CallbackQuery, state: F
                 await callback_query.message.answer("Пожалуйста, укажите номер кабинета:")
                 await state.set_state(RegistrationStates.waiting_for_office_number)
             else:
-                await complete_registration(callback_query.message, state)  # Завершаем регистрацию
+                await complete_registration(callback_query.message, state, db)  # Завершаем регистрацию
         except Exception as e:
             logger.error(f"Ошибка при редактировании сообщения после выбора организации: {e}")
             await callback_query.message.answer(
@@ -330,7 +3066,7 @@ async def process_other_organization_selection(callback_query: CallbackQuery, st
 
 # Хендлер для ручного ввода организации
 @router.message(RegistrationStates.waiting_for_manual_organization_input)
-async def process_manual_organization_input(message: Message, state: FSMContext):
+async def process_manual_organization_input(message: Message, state: FSMContext, db: AsyncSession):
     if not message.text:
         await message.answer("Пожалуйста, введите название вашей организации текстом.")
         return
@@ -339,22 +3075,21 @@ async def process_manual_organization_input(message: Message, state: FSMContext)
     await state.update_data(organization=organization_name)
 
     # Если ручной ввод, номер кабинета не запрашивается
-    await complete_registration(message, state)
+    await complete_registration(message, state, db)
 
 
 @router.message(RegistrationStates.waiting_for_office_number)
-async def process_office_number(message: Message, state: FSMContext):
+async def process_office_number(message: Message, state: FSMContext, db: AsyncSession):
     if not message.text:
         await message.answer("Пожалуйста, введите номер кабинета текстом.")
         return
     await state.update_data(office_number=message.text)
-    await complete_registration(message, state)
+    await complete_registration(message, state, db)
 
 
-async def complete_registration(message: Message, state: FSMContext):
+async def complete_registration(message: Message, state: FSMContext, db: AsyncSession):
     user_data = await state.get_data()
-    db = next(get_db())
-    user = db.query(User).filter(User.id == message.from_user.id).first()
+    user = await db.get(User, message.from_user.id)
 
     if user:
         user.full_name = user_data.get('full_name')
@@ -363,7 +3098,8 @@ async def complete_registration(message: Message, state: FSMContext):
         # Убедимся, что office_number устанавливается только если он был запрошен и введен
         user.office_number = user_data.get('office_number') if 'office_number' in user_data else None
         user.registered = True
-        db.commit()
+        await db.commit()
+        user_profile_cache.put(user)
         logger.info(f"Пользователь {user.id} успешно зарегистрирован.")
         await message.answer("Регистрация завершена! Теперь вы можете создавать заявки.",
                              reply_markup=get_main_menu_keyboard(user.role))
@@ -377,9 +3113,8 @@ async def complete_registration(message: Message, state: FSMContext):
 # --- Хендлеры создания заявок ---
 @router.message(F.text == "Создать ИТ-заявку")
 @router.message(F.text == "Создать АХО-заявку")
-async def start_new_request(message: Message, state: FSMContext):
-    db = next(get_db())
-    user = db.query(User).filter(User.id == message.from_user.id).first()
+async def start_new_request(message: Message, state: FSMContext, db: AsyncSession):
+    user = await user_profile_cache.get(db, message.from_user.id)
 
     if not user or not user.registered:
         await message.answer(
@@ -392,10 +3127,39 @@ async def start_new_request(message: Message, state: FSMContext):
     await state.set_state(NewRequestStates.waiting_for_description)
 
 
+# Фото, документы и голосовые сообщения при создании заявки. Файл не скачивается: в состоянии
+# сохраняется только file_id. Подпись к первому вложению может служить описанием заявки
+@router.message(StateFilter(NewRequestStates.waiting_for_description, NewRequestStates.waiting_for_urgency,
+                            NewRequestStates.waiting_for_date), ATTACHMENT_FILTER)
+async def process_request_attachment(message: Message, state: FSMContext):
+    async with attachment_locks.hold(state.key):
+        await _add_request_attachment(message, state)
+
+
+async def _add_request_attachment(message: Message, state: FSMContext):
+    user_data = await state.get_data()
+    attachments = user_data.get('attachments', [])
+    if len(attachments) >= MAX_REQUEST_ATTACHMENTS:
+        await message.answer(f"К заявке можно приложить не больше {MAX_REQUEST_ATTACHMENTS} файлов.")
+        return
+    await state.update_data(attachments=attachments + [extract_attachment(message)])
+
+    if await state.get_state() != NewRequestStates.waiting_for_description.state:
+        return  # Остальные файлы альбома или файл, отправленный после описания
+    if message.caption:
+        await state.update_data(description=message.caption)
+        await message.answer("Как срочно необходимо выполнить заявку?", reply_markup=get_urgency_keyboard())
+        await state.set_state(NewRequestStates.waiting_for_urgency)
+    elif not message.media_group_id or message.media_group_id != user_data.get('last_media_group_id'):
+        # На альбом отвечаем один раз, а не на каждый файл
+        await state.update_data(last_media_group_id=message.media_group_id)
+        await message.answer("Файл добавлен к заявке. Теперь опишите проблему текстом.")
+
+
 @router.message(NewRequestStates.waiting_for_description)
 async def process_description(message: Message, state: FSMContext):
     if not message.text:
-        await message.answer("Пожалуйста, введите описание проблемы текстом.")
+        await message.answer("Пожалуйста, введите описание проблемы текстом или приложите файл с подписью.")
         return
     await state.update_data(description=message.text)
     await message.answer("Как срочно необходимо выполнить заявку?", reply_markup=get_urgency_keyboard())
@@ -403,11 +3167,11 @@ async def process_description(message: Message, state: FSMContext):
 
 
 @router.callback_query(NewRequestStates.waiting_for_urgency, F.data.in_({"urgency_asap", "urgency_date"}))
-async def process_urgency_callback(callback_query: CallbackQuery, state: FSMContext):
+async def process_urgency_callback(callback_query: CallbackQuery, state: FSMContext, db: AsyncSession):
     await callback_query.answer()  # Убираем "часики" с кнопки
     if callback_query.data == "urgency_asap":
         await state.update_data(urgency="ASAP")
-        await save_request(callback_query.message, state, callback_query.from_user.id, bot=callback_query.bot)
+        await save_request(callback_query.message, state, callback_query.from_user.id, db=db)
     elif callback_query.data == "urgency_date":
         await state.update_data(urgency="DATE")
         await callback_query.message.answer(
@@ -416,25 +3180,25 @@ async def process_urgency_callback(callback_query: CallbackQuery, state: FSMCont
 
 
 @router.message(NewRequestStates.waiting_for_date)
-async def process_date(message: Message, state: FSMContext):
+async def process_date(message: Message, state: FSMContext, db: AsyncSession):
     try:
-        datetime.strptime(message.text, "%Y-%m-%d %H:%M")
+        datetime.strptime(message.text, DUE_DATE_FORMAT)
         await state.update_data(due_date=message.text)
-        await save_request(message, state, message.from_user.id, bot=message.bot)
+        await save_request(message, state, message.from_user.id, db=db)
     except ValueError:
         await message.answer(
             "Неверный формат даты и времени. Пожалуйста, используйте формат ГГГГ-ММ-ДД ЧЧ:ММ (например, 2025-12-31 10:00).")
 
 
-async def save_request(message: Message, state: FSMContext, user_id: int, bot: Bot):
+async def save_request(message: Message, state: FSMContext, user_id: int, db: AsyncSession):
     user_data = await state.get_data()
     request_type = user_data.get('request_type')
     description = user_data.get('description')
     urgency = user_data.get('urgency')
     due_date = user_data.get('due_date') if urgency == "DATE" else None
+    attachments = user_data.get('attachments', [])
 
-    db = next(get_db())
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
 
     if not user:
         await message.answer("Произошла ошибка: пользователь не найден. Пожалуйста, попробуйте начать заново (/start).")
@@ -447,120 +3211,305 @@ async def save_request(message: Message, state: FSMContext, user_id: int, bot: B
         description=description,
         urgency=urgency,
         due_date=due_date,
-        status="Принято"
+        status=RequestStatus.NEW,
+        # В режиме автоназначения исполнитель выбирается сразу, по текущей нагрузке
+        assigned_admin_id=admin_workload.pick(db, request_type) if AUTO_ASSIGN else None
     )
     db.add(new_request)
-    db.commit()
-    db.refresh(new_request)  # Обновляем объект, чтобы получить сгенерированный ID
+    await db.flush()  # Получаем сгенерированный ID заявки
+    admin_workload.track(db, new_request)
+
+    # Заявка, вложения, уведомления администраторов (outbox) и статистика фиксируются одним коммитом:
+    # заявка не может сохраниться без уведомлений. Между flush и коммитом нет вызовов Bot API -
+    # блокировка записи SQLite держится только на время этих записей
+    db.add_all(RequestAttachment(request_id=new_request.id, sender_id=user_id, **attachment)
+               for attachment in attachments)
+    notify_admins(db, new_request, user, attachments)
+    await record_request_stats(db, "created", new_request, user.organization)
+    await db.commit()
+    sla_scheduler.schedule(new_request)
 
-    await message.answer("Ваша заявка успешно создана и будет рассмотрена.")
     await state.clear()
-
-    # Уведомление администраторов
-    await notify_admins(db, new_request, user, bot)
+    await message.answer("Ваша заявка успешно создана и будет рассмотрена.")
     logger.info(f"Заявка ID:{new_request.id} от пользователя {user.id} создана и отправлена администраторам.")
 
 
-async def notify_admins(db_session, request: Request, user: User, bot: Bot):
-    # Определяем тип администраторов для уведомления
-    admin_type_filter = 'IT_ADMIN' if request.request_type == 'IT' else 'AHO_ADMIN'
+# Текст заявки для администратора (используется в уведомлении и при его обновлении)
+def build_admin_request_text(request: Request, creator: User, is_new: bool = False) -> str:
+    user_details = f"📞 Телефон: {creator.phone_number}\n🏢 Организация: {creator.organization}"
+    if creator.office_number:
+        user_details += f"\n🚪 Кабинет: {creator.office_number}"
 
-    # Получаем ID администраторов из таблицы Admin
-    admin_ids_to_notify = [admin.id for admin in
-                           db_session.query(Admin).filter(Admin.admin_type == admin_type_filter).all()]
-
-    user_details = f"📞 Телефон: {user.phone_number}\n🏢 Организация: {user.organization}"
-    if user.office_number:
-        user_details += f"\n🚪 Кабинет: {user.office_number}"
-
-    request_info = (
-        f"🚨 Новая заявка ({request.request_type}) от {user.full_name} 🚨\n"
+    return (
+        f"🚨 {'Новая заявка' if is_new else 'Заявка'} ({request.request_type}) от {creator.full_name} 🚨\n"
         f"{user_details}\n"
         f"📝 Описание: {request.description}\n"
         f"⏰ Срочность: {'Как можно скорее' if request.urgency == 'ASAP' else f'К {request.due_date}'}\n"
         f"🆔 Заявка ID: {request.id}"
     )
 
-    keyboard = get_admin_new_request_keyboard(request.id)
 
+def update_admin_notifications(db_session: AsyncSession, notifications: list, request: Request, creator: User,
+                               status_line: str,
+                               keyboard_for_admin: Callable[[int], Optional[InlineKeyboardMarkup]] = None) -> set:
+    """Ставит в outbox редактирование копий уведомления о заявке (строк RequestNotification) у администраторов.
+
+    keyboard_for_admin(admin_id) возвращает клавиатуру для конкретного администратора
+    (None - кнопки убираются). Возвращает множество (chat_id, message_id) обновляемых сообщений.
+    """
+    text = f"{build_admin_request_text(request, creator)}\n\n{status_line}"
+    for notification in notifications:
+        keyboard = keyboard_for_admin(notification.admin_chat_id) if keyboard_for_admin else None
+        enqueue_message(db_session, notification.admin_chat_id, "edit_message_text",
+                        message_id=notification.message_id, text=text, reply_markup=keyboard)
+    return {(notification.admin_chat_id, notification.message_id) for notification in notifications}
+
+
+class RequestTransition(NamedTuple):
+    """Допустимый переход статуса заявки и его побочные эффекты.
+
+    Шаблоны форматируются полями request, creator, description (начало описания),
+    status (название нового статуса) и actor (имя того, кто выполнил переход).
+    """
+    from_statuses: tuple
+    to_status: RequestStatus
+    status_line: str  # Строка статуса в копиях уведомления у администраторов
+    # Клавиатура в копии уведомления у исполнителя; остальным администраторам кнопки не нужны
+    assignee_keyboard: Optional[Callable[[int], InlineKeyboardMarkup]] = None
+    user_text: Optional[str] = None  # Сообщение создателю заявки
+    assignee_text: Optional[str] = None  # Сообщение исполнителю, если он назначен
+    # Администратор берет заявку в работу: при первом таком переходе ставится accepted_at
+    accepts: bool = False
+
+
+REQUEST_TRANSITIONS = {
+    "accept": RequestTransition(
+        (RequestStatus.NEW,), RequestStatus.IN_PROGRESS, "✅ Статус: {status} ({actor})",
+        assignee_keyboard=get_admin_done_keyboard,
+        user_text="Ваша заявка ID:{request.id} ({description}...) принята к исполнению.\nИсполнитель: {actor}.",
+        accepts=True),
+    # Во время уточнения кнопки в копиях уведомления не нужны: диалогом управляет отдельное сообщение
+    "clarify_start": RequestTransition(
+        OPEN_STATUSES, RequestStatus.CLARIFICATION, "❓ Статус: {status}",
+        user_text="Администратор начал диалог по вашей заявке ID:{request.id} ({description}...).\n"
+                  "Вы можете отправлять сообщения в ответ.",
+        accepts=True),
+    # Исполнителю после уточнения сразу предлагаем завершить заявку. Сообщение пользователю
+    # отправляет хендлер: оно зависит от того, участвует ли пользователь еще в диалоге
+    "clarify_end": RequestTransition(
+        (RequestStatus.CLARIFICATION,), RequestStatus.IN_PROGRESS, "✅ Статус: {status}",
+        assignee_keyboard=get_admin_done_keyboard),
+    # Исполнитель закрывает только заявку, которую принял; назначенная, но не принятая остается новой
+    "admin_done": RequestTransition(
+        (RequestStatus.IN_PROGRESS, RequestStatus.CLARIFICATION), RequestStatus.DONE, "✅ Статус: {status}",
+        user_text="🎉 Ваша заявка ID:{request.id} ({description}...) исполнена!"),
+    "user_done": RequestTransition(
+        OPEN_STATUSES, RequestStatus.DONE, "✅ Статус: {status} (отмечено пользователем)",
+        assignee_text="🎉 Пользователь {creator.full_name} отметил заявку ID:{request.id} как выполненную!"),
+}
+
+
+async def apply_transition(db_session: AsyncSession, action: str, request: Request, *conditions,
+                           actor_name: str = "", **values) -> Optional[set]:
+    """Выполняет переход action из REQUEST_TRANSITIONS для заявки, загруженной вместе с creator.
+
+    Статус меняется условным UPDATE (transition_request). Если переход состоялся, в outbox ставятся
+    правки копий уведомления и сообщения из таблицы переходов, а возвращается множество
+    (chat_id, message_id) обновляемых копий. Если заявку уже перевел другой запрос, возвращает None
+    и ничего не ставит в очередь - вызывающий сразу завершает транзакцию.
+    """
+    transition = REQUEST_TRANSITIONS[action]
+    creator = request.creator
+    # Копии уведомления читаются до UPDATE: после него транзакция держит блокировку записи SQLite
+    notifications = (await db_session.scalars(
+        select(RequestNotification).where(RequestNotification.request_id == request.id))).all()
+    now = datetime.now()
+    if transition.accepts:
+        values.setdefault("accepted_at", func.coalesce(Request.accepted_at, now))
+    if not await transition_request(db_session, request.id, transition.from_statuses, transition.to_status,
+                                    *conditions, **values):
+        return None
+    # RETURNING с populate_existing сбрасывает связи заявки: возвращаем уже загруженного создателя
+    set_committed_value(request, "creator", creator)
+    admin_workload.track(db_session, request)
+
+    # Агрегаты для /stats: accepted_at равен now, только если заявку взяли в работу именно сейчас
+    if transition.accepts and request.accepted_at == now:
+        await record_request_stats(db_session, "accepted", request, creator.organization)
+    if transition.to_status == RequestStatus.DONE:
+        await record_request_stats(db_session, "completed", request, creator.organization)
+
+    fields = dict(request=request, creator=creator, description=request.description[:50],
+                  status=transition.to_status.label, actor=actor_name)
+    keyboard_for_admin = None
+    if transition.assignee_keyboard:
+        def keyboard_for_admin(chat_id):
+            return transition.assignee_keyboard(request.id) if chat_id == request.assigned_admin_id else None
+    updated_messages = update_admin_notifications(
+        db_session, notifications, request, creator, transition.status_line.format(**fields), keyboard_for_admin)
+
+    if transition.user_text:
+        enqueue_message(db_session, request.user_id, "send_message", text=transition.user_text.format(**fields))
+    # Исполнитель берется из RETURNING: заявку могли принять, пока выполнялся этот запрос
+    if transition.assignee_text and request.assigned_admin_id:
+        enqueue_message(db_session, request.assigned_admin_id, "send_message",
+                        text=transition.assignee_text.format(**fields))
+    return updated_messages
+
+
+def notify_admins(db_session: AsyncSession, request: Request, user: User, attachments: list = ()):
+    request_info = build_admin_request_text(request, user, is_new=True)
+    if request.assigned_admin_id:
+        # Автоназначенную заявку получает только исполнитель
+        admin_ids_to_notify = (request.assigned_admin_id,)
+        request_info += "\n\n👤 Заявка назначена вам автоматически."
+    else:
+        # Администраторы нужного типа берутся из таблицы маршрутизации в памяти
+        admin_ids_to_notify = admin_roster.recipients(request.request_type)
+
+    keyboard = get_admin_new_request_keyboard(request.id)
+    # Рассылку выполняет outbox_delivery; ID отправленных сообщений он сохранит в RequestNotification
     for admin_id in admin_ids_to_notify:
-        try:
-            sent_message = await bot.send_message(chat_id=admin_id, text=request_info, reply_markup=keyboard)
-            # Сохраняем ID сообщения, отправленного администратору, для последующего редактирования
-            request.admin_message_id = sent_message.message_id
-            db_session.commit()
-            logger.info(f"Уведомление о заявке {request.id} отправлено администратору {admin_id}.")
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление администратору {admin_id} о заявке {request.id}: {e}")
+        enqueue_message(db_session, admin_id, "send_message", request_id=request.id,
+                        text=request_info, reply_markup=keyboard)
+        # Вложения идут следом за уведомлением (outbox сохраняет порядок сообщений в чате)
+        for attachment in attachments:
+            enqueue_attachment(db_session, admin_id, attachment, f"📎 Вложение к заявке ID:{request.id}")
+    logger.info(f"Заявка {request.id}: уведомления для {len(admin_ids_to_notify)} администраторов поставлены в очередь.")
+
+
+async def reassign_request(db_session: AsyncSession, request: Request, admin_id: int, assignee_name: str,
+                           actor_name: str) -> bool:
+    """Передает заявку, загруженную вместе с creator, исполнителю admin_id (команда /assign).
+
+    Как и apply_transition, меняет заявку условным UPDATE: переназначить можно только заявку,
+    которая ждет администратора или в работе (не во время уточнения). Копии уведомления у прочих
+    администраторов теряют кнопки, новый исполнитель получает уведомление с кнопками.
+    Возвращает False, если статус заявки успели изменить.
+    """
+    creator = request.creator
+    previous_admin_id = request.assigned_admin_id
+    notifications = (await db_session.scalars(
+        select(RequestNotification).where(RequestNotification.request_id == request.id))).all()
+    if not await db_session.scalar(
+            update(Request)
+            .where(Request.id == request.id, Request.status.in_((RequestStatus.NEW, RequestStatus.IN_PROGRESS)))
+            .values(assigned_admin_id=admin_id)
+            .returning(Request)
+            .execution_options(synchronize_session=False, populate_existing=True)):
+        return False
+    set_committed_value(request, "creator", creator)
+    admin_workload.track(db_session, request)
+
+    keyboard_factory = get_admin_new_request_keyboard if request.status == RequestStatus.NEW else get_admin_done_keyboard
+    updated_messages = update_admin_notifications(
+        db_session, notifications, request, creator, f"👤 Исполнитель: {assignee_name} (назначил {actor_name})",
+        lambda chat_id: keyboard_factory(request.id) if chat_id == admin_id else None)
+    if admin_id not in {chat_id for chat_id, _ in updated_messages}:
+        # С request_id outbox доставляет только копии непринятой заявки; копию заявки в работе
+        # хендлер "Выполнено" обновит сам, как сообщение не из уведомления
+        enqueue_message(db_session, admin_id, "send_message",
+                        request_id=request.id if request.status == RequestStatus.NEW else None,
+                        text=f"{build_admin_request_text(request, creator)}\n\n👤 Заявка назначена вам ({actor_name}).",
+                        reply_markup=keyboard_factory(request.id))
+    if previous_admin_id and previous_admin_id != admin_id:
+        enqueue_message(db_session, previous_admin_id, "send_message",
+                        text=f"↪️ Заявка ID:{request.id} передана исполнителю {assignee_name}.")
+    if request.status == RequestStatus.IN_PROGRESS:
+        enqueue_message(db_session, request.user_id, "send_message",
+                        text=f"Исполнитель по вашей заявке ID:{request.id} ({request.description[:50]}...) "
+                             f"изменен: {assignee_name}.")
+    return True
 
 
 # --- Хендлеры действий администраторов ---
 @router.callback_query(F.data.startswith("admin_accept_"))
-async def admin_accept_request(callback_query: CallbackQuery, bot: Bot):
+async def admin_accept_request(callback_query: CallbackQuery, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[2])
     admin_id = callback_query.from_user.id
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
-    admin_user = db.query(User).filter(User.id == admin_id).first()
+    request = await db.get(Request, request_id, options=[joinedload(Request.creator)])
+    admin_user = await user_profile_cache.get(db, admin_id)
 
     if not request:
         await callback_query.message.answer("Заявка не найдена.")
         return
 
-    if request.status != "Принято":
-        await callback_query.message.answer(f"Эта заявка уже имеет статус: {request.status}.")
+    if request.status != RequestStatus.NEW:
+        await callback_query.message.answer(f"Эта заявка уже имеет статус: {request.status.label}.")
         return
 
-    request.status = "Принято к исполнению"
-    request.assigned_admin_id = admin_id
-    db.commit()
-    logger.info(f"Заявка ID:{request.id} принята к исполнению администратором {admin_id}.")
-
-    # Обновляем сообщение администратору
-    try:
-        await callback_query.message.edit_text(
-            f"{callback_query.message.text}\n\n✅ Статус: Принято к исполнению ({admin_user.full_name})",
-            reply_markup=None  # Убираем кнопки после принятия
-        )
-    except Exception as e:
-        logger.error(f"Не удалось обновить сообщение администратору для заявки {request.id}: {e}")
+    if request.assigned_admin_id not in (None, admin_id):
+        await callback_query.message.answer("Эта заявка назначена другому администратору.")
+        return
 
-    # Уведомляем пользователя
-    user_full_name = admin_user.full_name if admin_user else "Неизвестный администратор"
-    try:
-        await bot.send_message(
-            chat_id=request.user_id,
-            text=f"Ваша заявка ID:{request.id} ({request.description[:50]}...) принята к исполнению.\n"
-                 f"Исполнитель: {user_full_name}."
-        )
-    except Exception as e:
-        logger.error(f"Не удалось уведомить пользователя {request.user_id} о принятии заявки {request.id}: {e}")
+    # Назначение - условный UPDATE: при одновременных нажатиях выигрывает один администратор.
+    # Назначенную заявку (автоназначение, /assign) может принять только ее исполнитель.
+    # Копии уведомления обновляются у всех: исполнителю - кнопка "Выполнено", остальным - без кнопок
+    admin_name = admin_user.full_name if admin_user else "Неизвестный администратор"
+    updated_messages = await apply_transition(
+        db, "accept", request, func.coalesce(Request.assigned_admin_id, admin_id) == admin_id,
+        actor_name=admin_name, assigned_admin_id=admin_id)
+    if updated_messages is None:
+        await db.rollback()
+        status = await db.scalar(select(Request.status).where(Request.id == request_id))
+        if status == RequestStatus.NEW:
+            await callback_query.message.answer("Эта заявка назначена другому администратору.")
+        else:
+            await callback_query.message.answer(f"Эта заявка уже имеет статус: {status.label}.")
+        return
+    # Статус и уведомления фиксируются одной транзакцией
+    await db.commit()
+    logger.info(f"Заявка ID:{request.id} принята к исполнению администратором {admin_id}.")
+    list_page = get_list_page_refresh_data(callback_query.message)
+    if list_page:
+        # Заявка принята со страницы списка - перерисовываем страницу с новым статусом
+        await refresh_list_page(callback_query.bot, db, callback_query.message.chat.id,
+                                callback_query.message.message_id, list_page)
+    elif (callback_query.message.chat.id, callback_query.message.message_id) not in updated_messages:
+        # Заявка принята не из уведомления (например, из старого сообщения)
+        try:
+            await callback_query.message.edit_text(
+                f"{callback_query.message.text}\n\n✅ Статус: {RequestStatus.IN_PROGRESS.label} ({admin_name})",
+                reply_markup=None  # Убираем кнопки после принятия
+            )
+        except Exception as e:
+            logger.error(f"Не удалось обновить сообщение администратору для заявки {request.id}: {e}")
 
 
 @router.callback_query(F.data.startswith("admin_clarify_start_"))
-async def admin_clarify_start(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+async def admin_clarify_start(callback_query: CallbackQuery, state: FSMContext, bot: Bot, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[3])
     admin_id = callback_query.from_user.id
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
+    request = await db.get(Request, request_id, options=[joinedload(Request.creator)])
 
     if not request:
         await callback_query.message.answer("Заявка не найдена.")
         return
 
-    if request.status == "Выполнено":
+    if request.status == RequestStatus.DONE:
+        await callback_query.message.answer("Эта заявка уже выполнена.")
+        return
+
+    # Переводим заявку в "Уточнение" и назначаем администратора, если это первое уточнение.
+    # Если заявку успели закрыть, диалог не начинается
+    if await apply_transition(db, "clarify_start", request,
+                              assigned_admin_id=func.coalesce(Request.assigned_admin_id, admin_id)) is None:
+        await db.rollback()
         await callback_query.message.answer("Эта заявка уже выполнена.")
         return
+    await db.commit()
 
     # Сохраняем данные для диалога уточнения в состоянии администратора
     await state.update_data(
         target_user_id=request.user_id,
         request_id=request_id,
-        original_admin_message_id=callback_query.message.message_id
+        relay_header=clarification_relay_header(request),
+        original_admin_message_id=callback_query.message.message_id,
+        original_admin_list_page=get_list_page_refresh_data(callback_query.message)
     )
     await state.set_state(ClarificationState.admin_active_dialogue)
 
@@ -570,27 +3519,13 @@ async def admin_clarify_start(callback_query: CallbackQuery, state: FSMContext,
                             key=StorageKey(bot_id=bot.id, chat_id=request.user_id, user_id=request.user_id))
     await user_state.update_data(
         target_admin_id=admin_id,  # Сохраняем ID администратора, чтобы пользователь знал, кому отвечать
-        request_id=request_id
+        request_id=request_id,
+        relay_header=clarification_relay_header(request, request.creator.full_name)
     )
     await user_state.set_state(ClarificationState.user_active_dialogue)
-
-    # Обновляем статус заявки и назначаем администратора, если это первое уточнение
-    if not request.assigned_admin_id:  # Если админ еще не был назначен
-        request.assigned_admin_id = admin_id
-    request.status = "Уточнение"
-    db.commit()
+    clarification_dialogues.touch(admin_id, request.user_id, request_id)
     logger.info(f"Администратор {admin_id} начал уточнение для заявки {request.id}. Статус: Уточнение.")
 
-    # Уведомляем пользователя о начале диалога
-    try:
-        await bot.send_message(
-            chat_id=request.user_id,
-            text=f"Администратор начал диалог по вашей заявке ID:{request.id} ({request.description[:50]}...).\n"
-                 "Вы можете отправлять сообщения в ответ."
-        )
-    except Exception as e:
-        logger.error(f"Не удалось уведомить пользователя {request.user_id} о начале диалога уточнения: {e}")
-
     await callback_query.message.answer(
         "Вы начали диалог уточнения с пользователем. Отправляйте сообщения. "
         "Для завершения диалога нажмите кнопку:",
@@ -600,9 +3535,9 @@ async def admin_clarify_start(callback_query: CallbackQuery, state: FSMContext,
 
 # Хендлер для сообщений от администратора во время активного диалога уточнения
 @router.message(StateFilter(ClarificationState.admin_active_dialogue))
-async def process_admin_clarification_message(message: Message, state: FSMContext, bot: Bot):
-    if not message.text:
-        # Не выводим сообщение, если это не текст (например, стикер, фото)
+async def process_admin_clarification_message(message: Message, state: FSMContext, bot: Bot, db: AsyncSession):
+    if not message.text and not extract_attachment(message):
+        # Не выводим сообщение, если это не текст и не файл (например, стикер)
         # await message.answer("Пожалуйста, введите сообщение текстом.")
         return
 
@@ -616,24 +3551,25 @@ async def process_admin_clarification_message(message: Message, state: FSMContex
         await state.clear()
         return
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
+    clarification_dialogues.touch(message.from_user.id, target_user_id, request_id)
+    relay_header = state_data.get('relay_header')
+    if relay_header is None:
+        # Диалог начат до того, как заголовок стал храниться в состоянии
+        request = await db.get(Request, request_id)
+        relay_header = clarification_relay_header(request)
+        await state.update_data(relay_header=relay_header)
 
     try:
         # Отправляем сообщение пользователю
-        await bot.send_message(
-            chat_id=target_user_id,
-            text=f"💬 От администратора по заявке ID:{request.id} ({request.description[:50] if request else '...'})\n\n"
-                 f"{message.text}"
-        )
+        await relay_clarification_message(message, bot, db, request_id, target_user_id, relay_header)
         # Удалено: await message.answer("Сообщение отправлено.") - чтобы не дублировать сообщения
     except Exception as e:
         await message.answer("Не удалось отправить сообщение пользователю. Возможно, он заблокировал бота.")
-        logger.error(f"Не удалось отправить сообщение пользователю {target_user_id} для заявки {request.id}: {e}")
+        logger.error(f"Не удалось отправить сообщение пользователю {target_user_id} для заявки {request_id}: {e}")
 
 
 @router.callback_query(F.data.startswith("admin_clarify_end_"))
-async def admin_clarify_end(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+async def admin_clarify_end(callback_query: CallbackQuery, state: FSMContext, bot: Bot, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[3])
     admin_id = callback_query.from_user.id
@@ -641,13 +3577,13 @@ async def admin_clarify_end(callback_query: CallbackQuery, state: FSMContext, bo
     state_data = await state.get_data()
     target_user_id = state_data.get('target_user_id')
     original_admin_message_id = state_data.get('original_admin_message_id')
+    original_admin_list_page = state_data.get('original_admin_list_page')
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
-    user_creator = db.query(User).filter(User.id == request.user_id).first()  # Fetch the user who created the request
+    request = await db.get(Request, request_id, options=[joinedload(Request.creator)])
 
     # Очищаем состояние администратора
     await state.clear()
+    clarification_dialogues.end(admin_id, target_user_id)
     await callback_query.message.answer("Диалог уточнения завершен.")
 
     # Очищаем состояние пользователя, если он был в этом диалоге
@@ -660,45 +3596,35 @@ async def admin_clarify_end(callback_query: CallbackQuery, state: FSMContext, bo
                 'request_id') == request_id:
             await user_state.clear()
             logger.info(f"Состояние пользователя {target_user_id} очищено после завершения диалога администратором.")
-            try:
-                await bot.send_message(
-                    chat_id=target_user_id,
-                    text=f"Мы поняли вашу проблему по заявке ID:{request.id} ({request.description[:50] if request else '...'}), ожидайте ее выполнение."
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить пользователя {target_user_id} о завершении диалога: {e}")
-
-    # Обновляем статус заявки на "Принято к исполнению"
-    if request:
-        request.status = "Принято к исполнению"
-        db.commit()
+            enqueue_message(
+                db, target_user_id, "send_message",
+                text=f"Мы поняли вашу проблему по заявке ID:{request.id} ({request.description[:50] if request else '...'}), ожидайте ее выполнение.")
+
+    # Обновляем статус заявки на "Принято к исполнению" (если ее не закрыли во время диалога)
+    updated_messages = await apply_transition(db, "clarify_end", request) if request else None
+    if request and updated_messages is None:
+        await db.commit()  # Сообщение пользователю о завершении диалога все равно отправляется
+        logger.info(f"Заявка {request_id} уже не в статусе 'Уточнение', статус после диалога не меняется.")
+    elif request:
+        await db.commit()
         logger.info(
             f"Статус заявки {request.id} изменен с 'Уточнение' на 'Принято к исполнению' после завершения диалога.")
 
-        # Реконструируем сообщение для администратора с обновленным статусом
-        user_details = f"📞 Телефон: {user_creator.phone_number}\n🏢 Организация: {user_creator.organization}"
-        if user_creator.office_number:
-            user_details += f"\n🚪 Кабинет: {user_creator.office_number}"
-
-        request_info = (
-            f"🚨 Заявка ({request.request_type}) от {user_creator.full_name} 🚨\n"
-            f"{user_details}\n"
-            f"📝 Описание: {request.description}\n"
-            f"⏰ Срочность: {'Как можно скорее' if request.urgency == 'ASAP' else f'К {request.due_date}'}\n"
-            f"🆔 Заявка ID: {request.id}\n\n"
-            f"✅ Статус: {request.status}"  # Обновленный статус
-        )
-        # После завершения уточнения и перехода в "Принято к исполнению", кнопки убираются
-        # (или можно показать кнопку "Выполнено", если администратор уже принял ее к исполнению)
-        keyboard = get_admin_done_keyboard(request.id)  # Теперь сразу предлагаем завершить
-
-        if original_admin_message_id:
+        # Уточнение могло быть начато не из уведомления: со страницы списка "Мои принятые заявки"
+        # (перерисовываем страницу) или из другого сообщения о заявке
+        if original_admin_message_id and original_admin_list_page:
+            await refresh_list_page(bot, db, callback_query.message.chat.id, original_admin_message_id,
+                                    original_admin_list_page)
+        elif original_admin_message_id and (
+                callback_query.message.chat.id, original_admin_message_id) not in updated_messages:
+            status_line = f"✅ Статус: {request.status.label}"
+            request_info = f"{build_admin_request_text(request, request.creator)}\n\n{status_line}"
             try:
                 await bot.edit_message_text(
                     chat_id=callback_query.message.chat.id,
                     message_id=original_admin_message_id,
                     text=request_info,
-                    reply_markup=keyboard
+                    reply_markup=get_admin_done_keyboard(request.id)
                 )
                 logger.info(f"Сообщение администратору для заявки {request.id} обновлено после завершения диалога.")
             except Exception as e:
@@ -709,61 +3635,28 @@ async def admin_clarify_end(callback_query: CallbackQuery, state: FSMContext, bo
 
 
 @router.message(F.text == "Мои принятые заявки")
-async def show_assigned_requests(message: Message):
-    db = next(get_db())
+async def show_assigned_requests(message: Message, db: AsyncSession):
     admin_id = message.from_user.id
-    admin_user = db.query(User).filter(User.id == admin_id).first()
 
-    if not admin_user or admin_user.role not in ['it_admin', 'aho_admin']:
+    if not admin_roster.is_admin(admin_id):
         await message.answer("У вас нет доступа к этой функции.")
         return
 
-    two_days_ago = datetime.now() - timedelta(days=2)
-
-    requests = db.query(Request).filter(
-        Request.assigned_admin_id == admin_id,
-        (Request.status != "Выполнено") | (Request.completed_at >= two_days_ago)  # Фильтрация по дате для выполненных
-    ).order_by(Request.created_at.desc()).all()
-
-    if not requests:
+    # Одно сообщение с первой страницей; остальные страницы - по кнопкам навигации
+    text, keyboard = await build_requests_page(db, "admin", admin_id)
+    if not text:
         await message.answer("У вас пока нет принятых к исполнению заявок или недавно выполненных.")
         return
-
-    for req in requests:
-        user = db.query(User).filter(User.id == req.user_id).first()
-        user_info = f"{user.full_name}, {user.organization}, {user.phone_number}"
-        if user and user.office_number:
-            user_info += f", каб. {user.office_number}"
-
-        request_text = (
-            f"--- Заявка ID: {req.id} ({req.request_type}) ---\n"
-            f"От: {user_info}\n"
-            f"Описание: {req.description}\n"
-            f"Срочность: {'Как можно скорее' if req.urgency == 'ASAP' else f'К {req.due_date}'}\n"
-            f"Статус: {req.status}"
-        )
-
-        keyboard_to_show = None
-        if req.status == "Принято":
-            keyboard_to_show = get_admin_new_request_keyboard(req.id)  # Принять/Отправить уточнение
-        elif req.status == "Принято к исполнению":
-            keyboard_to_show = get_admin_done_keyboard(req.id)  # Выполнено
-        elif req.status == "Уточнение":
-            keyboard_to_show = get_admin_clarify_active_keyboard(req.id)  # Завершить уточнение
-        # Для выполненных заявок (в рамках 2 дней) кнопки не отображаются
-
-        await message.answer(request_text, reply_markup=keyboard_to_show)
+    await message.answer(text, reply_markup=keyboard)
 
 
 @router.callback_query(F.data.startswith("admin_done_"))
-async def admin_done_request(callback_query: CallbackQuery, bot: Bot):
+async def admin_done_request(callback_query: CallbackQuery, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[2])
     admin_id = callback_query.from_user.id
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
-    admin_user = db.query(User).filter(User.id == admin_id).first()
+    request = await db.get(Request, request_id, options=[joinedload(Request.creator)])
 
     if not request:
         await callback_query.message.answer("Заявка не найдена.")
@@ -773,150 +3666,161 @@ async def admin_done_request(callback_query: CallbackQuery, bot: Bot):
         await callback_query.message.answer("Вы не являетесь исполнителем этой заявки.")
         return
 
-    if request.status == "Выполнено":
+    if request.status == RequestStatus.DONE:
         await callback_query.message.answer("Эта заявка уже отмечена как выполненная.")
         return
 
-    request.status = "Выполнено"
-    request.completed_at = datetime.now()  # Устанавливаем время выполнения
-    db.commit()
-    logger.info(f"Заявка ID:{request.id} отмечена как 'Выполнено' администратором {admin_id}.")
-
-    # Обновляем сообщение администратору
-    try:
-        await callback_query.message.edit_text(
-            f"{callback_query.message.text}\n\n✅ Статус: Выполнено",
-            reply_markup=None  # Убираем кнопки после выполнения
-        )
-    except Exception as e:
-        logger.error(f"Не удалось обновить сообщение администратору для заявки {request.id}: {e}")
+    if request.status == RequestStatus.NEW:
+        await callback_query.message.answer("Сначала примите заявку к исполнению.")
+        return
 
-    # Уведомляем пользователя
-    try:
-        await bot.send_message(
-            chat_id=request.user_id,
-            text=f"🎉 Ваша заявка ID:{request.id} ({request.description[:50]}...) исполнена!"
-        )
-    except Exception as e:
-        logger.error(f"Не удалось уведомить пользователя {request.user_id} о выполнении заявки {request.id}: {e}")
+    # Заявку могли одновременно закрыть пользователь или повторное нажатие - выигрывает один переход
+    updated_messages = await apply_transition(db, "admin_done", request, Request.assigned_admin_id == admin_id,
+                                              completed_at=datetime.now())
+    if updated_messages is None:
+        await db.rollback()
+        await callback_query.message.answer("Эта заявка уже отмечена как выполненная.")
+        return
+    await db.commit()
+    logger.info(f"Заявка ID:{request.id} отмечена как 'Выполнено' администратором {admin_id}.")
+    list_page = get_list_page_refresh_data(callback_query.message)
+    if list_page:
+        await refresh_list_page(callback_query.bot, db, callback_query.message.chat.id,
+                                callback_query.message.message_id, list_page)
+    elif (callback_query.message.chat.id, callback_query.message.message_id) not in updated_messages:
+        try:
+            await callback_query.message.edit_text(
+                f"{callback_query.message.text}\n\n✅ Статус: {RequestStatus.DONE.label}",
+                reply_markup=None  # Убираем кнопки после выполнения
+            )
+        except Exception as e:
+            logger.error(f"Не удалось обновить сообщение администратору для заявки {request.id}: {e}")
 
 
 # --- Хендлеры действий пользователей ---
 @router.message(F.text == "Мои заявки")
-async def show_user_requests(message: Message):
-    db = next(get_db())
+async def show_user_requests(message: Message, db: AsyncSession):
     user_id = message.from_user.id
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await user_profile_cache.get(db, user_id)
 
     if not user or not user.registered:
         await message.answer(
             "Вы не зарегистрированы или регистрация не завершена. Пожалуйста, начните с команды /start.")
         return
 
-    two_days_ago = datetime.now() - timedelta(days=2)
+    text, keyboard = await build_requests_page(db, "user", user_id)
+    if not text:
+        await message.answer("У вас пока нет созданных заявок.")
+        return
+    await message.answer(text, reply_markup=keyboard)
 
-    requests = db.query(Request).filter(
-        Request.user_id == user_id,
-        (Request.status != "Выполнено") | (Request.completed_at >= two_days_ago)  # Фильтрация по дате для выполненных
-    ).order_by(Request.created_at.desc()).all()
 
-    if not requests:
-        await message.answer("У вас пока нет созданных заявок.")
+# Навигация по страницам списков "Мои заявки" и "Мои принятые заявки"
+@router.callback_query(F.data.startswith("list_"))
+async def paginate_requests_list(callback_query: CallbackQuery, db: AsyncSession):
+    await callback_query.answer()
+    _, owner, direction, cursor = callback_query.data.split('_', 3)
+    owner_id = callback_query.from_user.id
+    if owner == "admin" and not admin_roster.is_admin(owner_id):
+        await callback_query.message.answer("У вас нет доступа к этой функции.")
         return
+    await refresh_list_page(callback_query.bot, db, owner_id, callback_query.message.message_id,
+                            f"list_{owner}_{direction}_{cursor}")
 
-    for req in requests:
-        admin_info = ""
-        if req.assigned_admin_id:
-            admin_user = db.query(User).filter(User.id == req.assigned_admin_id).first()
-            if admin_user:
-                admin_info = f"Исполнитель: {admin_user.full_name}\n"
-
-        response_text = (
-            f"--- Заявка ID: {req.id} ({req.request_type}) ---\n"
-            f"Описание: {req.description}\n"
-            f"Срочность: {'Как можно скорее' if req.urgency == 'ASAP' else f'К {req.due_date}'}\n"
-            f"Статус: {req.status}\n"
-            f"{admin_info}"
-            f"Создана: {req.created_at.strftime('%Y-%m-%d %H:%M')}\n"
-        )
-        if req.status == "Выполнено" and req.completed_at:
-            response_text += f"Выполнена: {req.completed_at.strftime('%Y-%m-%d %H:%M')}\n"
-
-        # Добавляем кнопки, если заявка не выполнена или выполнена недавно
-        if req.status != "Выполнено" or (
-                req.status == "Выполнено" and req.completed_at and req.completed_at >= two_days_ago):
-            await message.answer(response_text, reply_markup=get_user_request_actions_keyboard(req.id, req.status))
-        else:
-            await message.answer(response_text)
+
+# История переписки по заявке: из списка открывается новым сообщением, навигация редактирует его
+@router.callback_query(F.data.startswith("history_"))
+async def show_request_history(callback_query: CallbackQuery, db: AsyncSession):
+    await callback_query.answer()
+    _, request_id, direction, cursor = callback_query.data.split('_', 3)
+    # История архивных заявок тоже доступна (например, из результатов поиска)
+    request = await db.get(Request, int(request_id)) or await db.get(ArchivedRequest, int(request_id))
+    if not request or not can_view_request_history(request, callback_query.from_user.id):
+        await callback_query.message.answer("Заявка не найдена.")
+        return
+
+    # Последние сообщения могут быть еще в буфере записи
+    await request_message_log.flush()
+    text, keyboard = await build_history_page(db, request, direction, int(cursor))
+    if direction == "last":
+        await callback_query.message.answer(
+            text or f"По заявке ID:{request.id} сообщений уточнения нет.", reply_markup=keyboard)
+        return
+    try:
+        await callback_query.message.edit_text(
+            text or f"По заявке ID:{request.id} сообщений уточнения нет.", reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        logger.debug(f"Страница истории заявки {request.id} не обновлена: {e}")
 
 
 @router.callback_query(F.data.startswith("user_done_"))
-async def user_mark_done_request(callback_query: CallbackQuery, bot: Bot):
+async def user_mark_done_request(callback_query: CallbackQuery, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[2])
     user_id = callback_query.from_user.id
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id, Request.user_id == user_id).first()
+    request = await db.scalar(select(Request).options(joinedload(Request.creator)).where(
+        Request.id == request_id, Request.user_id == user_id))
 
     if not request:
         await callback_query.message.answer("Заявка не найдена или вы не являетесь ее создателем.")
         return
 
-    if request.status == "Выполнено":
+    if request.status == RequestStatus.DONE:
         await callback_query.message.answer("Эта заявка уже отмечена как выполненная.")
         return
 
-    request.status = "Выполнено"
-    request.completed_at = datetime.now()  # Устанавливаем время выполнения
-    db.commit()
+    # Копии уведомления у администраторов обновляются, чтобы никто не пытался принять закрытую заявку;
+    # исполнитель, если заявка была принята, получает сообщение
+    if await apply_transition(db, "user_done", request, Request.user_id == user_id,
+                              completed_at=datetime.now()) is None:
+        await db.rollback()
+        await callback_query.message.answer("Эта заявка уже отмечена как выполненная.")
+        return
+    await db.commit()
     logger.info(f"Заявка ID:{request.id} отмечена пользователем {user_id} как 'Выполнено'.")
 
-    # Обновляем сообщение пользователя
-    try:
-        await callback_query.message.edit_text(
-            f"{callback_query.message.text}\n\n✅ Статус: Выполнено",
-            reply_markup=None  # Убираем кнопки после выполнения
-        )
-    except Exception as e:
-        logger.error(f"Не удалось обновить сообщение пользователя для заявки {request.id}: {e}")
-
-    # Уведомляем администратора, если заявка была принята
-    if request.assigned_admin_id:
+    # Обновляем сообщение пользователя: страницу списка перерисовываем, в остальных убираем кнопки
+    list_page = get_list_page_refresh_data(callback_query.message)
+    if list_page:
+        await refresh_list_page(callback_query.bot, db, callback_query.message.chat.id,
+                                callback_query.message.message_id, list_page)
+    else:
         try:
-            admin_user = db.query(User).filter(User.id == request.assigned_admin_id).first()
-            if admin_user:
-                await bot.send_message(
-                    chat_id=request.assigned_admin_id,
-                    text=f"🎉 Пользователь {request.creator.full_name} отметил заявку ID:{request.id} как выполненную!"
-                )
+            await callback_query.message.edit_text(
+                f"{callback_query.message.text}\n\n✅ Статус: {RequestStatus.DONE.label}",
+                reply_markup=None  # Убираем кнопки после выполнения
+            )
         except Exception as e:
-            logger.error(
-                f"Не удалось уведомить администратора {request.assigned_admin_id} о выполнении заявки {request.id} пользователем: {e}")
+            logger.error(f"Не удалось обновить сообщение пользователя для заявки {request.id}: {e}")
 
 
 @router.callback_query(F.data.startswith("user_clarify_start_"))
-async def user_clarify_start(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+async def user_clarify_start(callback_query: CallbackQuery, state: FSMContext, bot: Bot, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[3])
     user_id = callback_query.from_user.id
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id, Request.user_id == user_id).first()
+    request = await db.scalar(select(Request).where(Request.id == request_id, Request.user_id == user_id))
 
     if not request:
         await callback_query.message.answer("Заявка не найдена или вы не являетесь ее создателем.")
         return
 
-    if not request.assigned_admin_id:
+    # Назначенная автоматически, но еще не принятая заявка тоже ждет администратора
+    if not request.assigned_admin_id or request.status == RequestStatus.NEW:
         await callback_query.message.answer("Эта заявка еще не принята администратором. Уточнение невозможно.")
         return
 
+    creator = await user_profile_cache.get(db, request.user_id)
+
     # Сохраняем данные для диалога уточнения в состоянии пользователя
     await state.update_data(
         target_admin_id=request.assigned_admin_id,
         request_id=request_id,
-        original_user_message_id=callback_query.message.message_id
+        relay_header=clarification_relay_header(request, creator.full_name),
+        original_user_message_id=callback_query.message.message_id,
+        original_user_list_page=get_list_page_refresh_data(callback_query.message)
     )
     await state.set_state(ClarificationState.user_active_dialogue)
 
@@ -927,20 +3831,17 @@ async def user_clarify_start(callback_query: CallbackQuery, state: FSMContext, b
                                             user_id=request.assigned_admin_id))
     await admin_state.update_data(
         target_user_id=user_id,  # Сохраняем ID пользователя, чтобы администратор знал, кому отвечать
-        request_id=request_id
+        request_id=request_id,
+        relay_header=clarification_relay_header(request)
     )
     await admin_state.set_state(ClarificationState.admin_active_dialogue)
+    clarification_dialogues.touch(request.assigned_admin_id, user_id, request_id)
 
     # Уведомляем администратора о начале диалога
-    try:
-        await bot.send_message(
-            chat_id=request.assigned_admin_id,
-            text=f"Пользователь {request.creator.full_name} начал диалог по заявке ID:{request.id} ({request.description[:50] if request else '...'}).\n"
-                 "Вы можете отправлять сообщения в ответ."
-        )
-    except Exception as e:
-        logger.error(
-            f"Не удалось уведомить администратора {request.assigned_admin_id} о начале диалога уточнения от пользователя: {e}")
+    enqueue_message(
+        db, request.assigned_admin_id, "send_message",
+        text=f"Пользователь {creator.full_name} начал диалог по заявке ID:{request.id} ({request.description[:50] if request else '...'}).\n"
+             "Вы можете отправлять сообщения в ответ.")
 
     await callback_query.message.answer(
         "Вы начали диалог уточнения с администратором. Отправляйте сообщения. "
@@ -951,9 +3852,9 @@ async def user_clarify_start(callback_query: CallbackQuery, state: FSMContext, b
 
 # Хендлер для сообщений от пользователя во время активного диалога уточнения
 @router.message(StateFilter(ClarificationState.user_active_dialogue))
-async def process_user_clarification_message(message: Message, state: FSMContext, bot: Bot):
-    if not message.text:
-        # Не выводим сообщение, если это не текст (например, стикер, фото)
+async def process_user_clarification_message(message: Message, state: FSMContext, bot: Bot, db: AsyncSession):
+    if not message.text and not extract_attachment(message):
+        # Не выводим сообщение, если это не текст и не файл (например, стикер)
         # await message.answer("Пожалуйста, введите сообщение текстом.")
         return
 
@@ -967,25 +3868,26 @@ async def process_user_clarification_message(message: Message, state: FSMContext
         await state.clear()
         return
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
-    user = db.query(User).filter(User.id == message.from_user.id).first()
+    clarification_dialogues.touch(target_admin_id, message.from_user.id, request_id)
+    relay_header = state_data.get('relay_header')
+    if relay_header is None:
+        # Диалог начат до того, как заголовок стал храниться в состоянии
+        request = await db.get(Request, request_id)
+        user = await user_profile_cache.get(db, message.from_user.id)
+        relay_header = clarification_relay_header(request, user.full_name)
+        await state.update_data(relay_header=relay_header)
 
     try:
         # Отправляем сообщение администратору
-        await bot.send_message(
-            chat_id=target_admin_id,
-            text=f"💬 От пользователя {user.full_name} по заявке ID:{request.id} ({request.description[:50] if request else '...'})\n\n"
-                 f"{message.text}"
-        )
+        await relay_clarification_message(message, bot, db, request_id, target_admin_id, relay_header)
         # Удалено: await message.answer("Сообщение отправлено администратору.") - чтобы не дублировать сообщения
     except Exception as e:
         await message.answer("Не удалось отправить сообщение администратору. Возможно, он заблокировал бота.")
-        logger.error(f"Не удалось отправить сообщение администратору {target_admin_id} для заявки {request.id}: {e}")
+        logger.error(f"Не удалось отправить сообщение администратору {target_admin_id} для заявки {request_id}: {e}")
 
 
 @router.callback_query(F.data.startswith("user_clarify_end_"))
-async def user_clarify_end(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+async def user_clarify_end(callback_query: CallbackQuery, state: FSMContext, bot: Bot, db: AsyncSession):
     await callback_query.answer()
     request_id = int(callback_query.data.split('_')[3])
     user_id = callback_query.from_user.id
@@ -993,12 +3895,13 @@ async def user_clarify_end(callback_query: CallbackQuery, state: FSMContext, bot
     state_data = await state.get_data()
     target_admin_id = state_data.get('target_admin_id')
     original_user_message_id = state_data.get('original_user_message_id')
+    original_user_list_page = state_data.get('original_user_list_page')
 
-    db = next(get_db())
-    request = db.query(Request).filter(Request.id == request_id).first()
+    request = await db.get(Request, request_id)
 
     # Очищаем состояние пользователя
     await state.clear()
+    clarification_dialogues.end(target_admin_id, user_id)
     await callback_query.message.answer("Диалог уточнения завершен.")
 
     # Очищаем состояние администратора, если он был в этом диалоге
@@ -1011,16 +3914,15 @@ async def user_clarify_end(callback_query: CallbackQuery, state: FSMContext, bot
                 'request_id') == request_id:
             await admin_state.clear()
             logger.info(f"Состояние администратора {target_admin_id} очищено после завершения диалога пользователем.")
-            try:
-                await bot.send_message(
-                    chat_id=target_admin_id,
-                    text=f"Диалог по заявке ID:{request.id} ({request.description[:50] if request else '...'}) завершен пользователем."
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить администратора {target_admin_id} о завершении диалога: {e}")
-
-    # Обновляем сообщение пользователя, чтобы убрать кнопки
-    if original_user_message_id:
+            enqueue_message(
+                db, target_admin_id, "send_message",
+                text=f"Диалог по заявке ID:{request.id} ({request.description[:50] if request else '...'}) завершен пользователем.")
+
+    # Обновляем сообщение пользователя: страницу списка перерисовываем, в остальных убираем кнопки
+    if original_user_message_id and original_user_list_page:
+        await refresh_list_page(bot, db, callback_query.message.chat.id, original_user_message_id,
+                                original_user_list_page)
+    elif original_user_message_id:
         try:
             await bot.edit_message_reply_markup(
                 chat_id=callback_query.message.chat.id,
@@ -1040,50 +3942,86 @@ async def send_website_link(message: Message):
 
 # --- Инициализация администраторов в БД при запуске бота ---
 async def on_startup(dispatcher: Dispatcher, bot: Bot):
-    db = next(get_db())
-
-    # Добавляем IT-админов
-    for admin_id in IT_ADMIN_IDS:
-        admin_exists = db.query(Admin).filter(Admin.id == admin_id, Admin.admin_type == 'IT_ADMIN').first()
-        if not admin_exists:
-            db.add(Admin(id=admin_id, admin_type='IT_ADMIN'))
-            # Также убедимся, что они есть в таблице users и имеют соответствующую роль
-            user_exists = db.query(User).filter(User.id == admin_id).first()
-            if not user_exists:
-                db.add(User(id=admin_id, registered=True, role='it_admin', full_name=f"IT Admin {admin_id}",
-                            phone_number="N/A", organization="N/A"))
-            elif user_exists.role != 'it_admin':
-                user_exists.role = 'it_admin'
-                user_exists.registered = True  # Считаем админов зарегистрированными
-            logger.info(f"IT-администратор {admin_id} добавлен/обновлен.")
-
-    # Добавляем АХО-админов
-    for admin_id in AHO_ADMIN_IDS:
-        admin_exists = db.query(Admin).filter(Admin.id == admin_id, Admin.admin_type == 'AHO_ADMIN').first()
-        if not admin_exists:
-            db.add(Admin(id=admin_id, admin_type='AHO_ADMIN'))
-            # Также убедимся, что они есть в таблице users и имеют соответствующую роль
-            user_exists = db.query(User).filter(User.id == admin_id).first()
-            if not user_exists:
-                db.add(User(id=admin_id, registered=True, role='aho_admin', full_name=f"AHO Admin {admin_id}",
-                            phone_number="N/A", organization="N/A"))
-            elif user_exists.role != 'aho_admin':
-                user_exists.role = 'aho_admin'
-                user_exists.registered = True  # Считаем админов зарегистрированными
-            logger.info(f"АХО-администратор {admin_id} добавлен/обновлен.")
-
-    db.commit()
-    db.close()
-    logger.info("Администраторы успешно инициализированы в БД.")
-
-
-# --- Главная функция запуска бота ---
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
+    async with SessionLocal() as db:
+
+        # Добавляем IT-админов
+        for admin_id in IT_ADMIN_IDS:
+            admin_exists = await db.scalar(select(Admin).where(Admin.id == admin_id, Admin.admin_type == 'IT_ADMIN'))
+            if not admin_exists:
+                db.add(Admin(id=admin_id, admin_type='IT_ADMIN'))
+                # Также убедимся, что они есть в таблице users и имеют соответствующую роль
+                user_exists = await db.get(User, admin_id)
+                if not user_exists:
+                    db.add(User(id=admin_id, registered=True, role='it_admin', full_name=f"IT Admin {admin_id}",
+                                phone_number="N/A", organization="N/A"))
+                elif user_exists.role != 'it_admin':
+                    user_exists.role = 'it_admin'
+                    user_exists.registered = True  # Считаем админов зарегистрированными
+                logger.info(f"IT-администратор {admin_id} добавлен/обновлен.")
+
+        # Записываем добавленных пользователей, чтобы db.get ниже нашел тех, кто указан в обоих списках
+        await db.flush()
+
+        # Добавляем АХО-админов
+        for admin_id in AHO_ADMIN_IDS:
+            admin_exists = await db.scalar(select(Admin).where(Admin.id == admin_id, Admin.admin_type == 'AHO_ADMIN'))
+            if not admin_exists:
+                db.add(Admin(id=admin_id, admin_type='AHO_ADMIN'))
+                # Также убедимся, что они есть в таблице users и имеют соответствующую роль
+                user_exists = await db.get(User, admin_id)
+                if not user_exists:
+                    db.add(User(id=admin_id, registered=True, role='aho_admin', full_name=f"AHO Admin {admin_id}",
+                                phone_number="N/A", organization="N/A"))
+                elif user_exists.role != 'aho_admin':
+                    user_exists.role = 'aho_admin'
+                    user_exists.registered = True  # Считаем админов зарегистрированными
+                logger.info(f"АХО-администратор {admin_id} добавлен/обновлен.")
+
+        await db.commit()
+        # Роли администраторов могли измениться - профили перечитаются из БД при следующем обращении
+        for admin_id in IT_ADMIN_IDS + AHO_ADMIN_IDS:
+            user_profile_cache.invalidate(admin_id)
+        logger.info("Администраторы успешно инициализированы в БД.")
+        await admin_roster.reload(db)
+        await admin_workload.reload(db)
+
+    # Фоновая доставка уведомлений из outbox, включая оставшиеся с прошлого запуска
+    outbox_delivery.start(bot)
+    # Напоминания о сроках и эскалации: очередь событий восстанавливается из БД
+    await sla_scheduler.start()
+    # Автоматическое завершение заброшенных диалогов уточнения
+    await clarification_dialogues.start(bot, dispatcher.fsm.storage)
+    # Перенос давно выполненных заявок в архив
+    request_archiver.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher, bot: Bot):
+    await request_archiver.stop()
+    await clarification_dialogues.stop()
+    await request_message_log.close()
+    await sla_scheduler.stop()
+    await outbox_delivery.stop()
+
+
+# --- Сборка диспетчера ---
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=create_fsm_storage())
+
+    # Одна сессия БД на каждый апдейт
+    dp.update.outer_middleware(db_session_middleware)
+    # Метрики по каждому хендлеру
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
 
     # Регистрация всех хендлеров
     dp.message.register(cmd_start, CommandStart())
+    dp.message.register(reload_admins, Command("reload_admins"))
+    dp.message.register(search_requests, Command("search"))
+    dp.callback_query.register(paginate_search_results, F.data.startswith("search_"))
+    dp.message.register(show_stats, Command("stats"))
+    dp.callback_query.register(export_stats_csv, F.data.startswith("stats_csv_"))
+    dp.message.register(export_requests_command, Command("export"))
+    dp.message.register(assign_request_command, Command("assign"))
 
     # Регистрация хендлеров регистрации
     dp.message.register(process_full_name, RegistrationStates.waiting_for_full_name)
@@ -1100,6 +4038,10 @@ async def main():
 
     # Регистрация хендлеров создания заявок
     dp.message.register(start_new_request, F.text.in_({"Создать ИТ-заявку", "Создать АХО-заявку"}))
+    # Вложения регистрируются раньше описания и даты, чтобы файл не попал в их хендлеры
+    dp.message.register(process_request_attachment,
+                        StateFilter(NewRequestStates.waiting_for_description, NewRequestStates.waiting_for_urgency,
+                                    NewRequestStates.waiting_for_date), ATTACHMENT_FILTER)
     dp.message.register(process_description, NewRequestStates.waiting_for_description)
     dp.callback_query.register(process_urgency_callback, NewRequestStates.waiting_for_urgency,
                                F.data.in_({"urgency_asap", "urgency_date"}))
@@ -1115,18 +4057,123 @@ async def main():
 
     # Регистрация хендлеров действий пользователей
     dp.message.register(show_user_requests, F.text == "Мои заявки")
+    dp.callback_query.register(paginate_requests_list, F.data.startswith("list_"))
+    dp.callback_query.register(show_request_history, F.data.startswith("history_"))
     dp.callback_query.register(user_mark_done_request, F.data.startswith("user_done_"))
     dp.callback_query.register(user_clarify_start, F.data.startswith("user_clarify_start_"))
     dp.message.register(process_user_clarification_message, ClarificationState.user_active_dialogue)
     dp.callback_query.register(user_clarify_end, F.data.startswith("user_clarify_end_"))
     dp.message.register(send_website_link, F.text == "Портал бюджетной системы Липецкой области")
 
-    # Запуск функции инициализации при старте бота
-    dp.startup.register(lambda: on_startup(dp, bot))
+    # Запуск функции инициализации при старте бота (dispatcher и bot передаются aiogram)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+# --- Режим вебхука ---
+class WebhookServer:
+    """Принимает апдейты от Telegram по HTTP (aiohttp) и обрабатывает их пулом воркеров.
+
+    Очередь апдейтов ограничена: если воркеры не успевают, сервер отвечает 503,
+    и Telegram повторяет доставку позже (обратное давление вместо роста памяти).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, queue_size: int, workers: int, secret: Optional[str] = None):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.workers_count = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = []
+        self.accepted_total = 0
+        self.rejected_total = 0  # Апдейты, отклоненные из-за переполнения очереди
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            logger.warning(f"Получен некорректный апдейт через вебхук: {e}")
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected_total += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        self.accepted_total += 1
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке апдейта {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def start_workers(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.workers_count)]
+
+    async def stop_workers(self):
+        # Дорабатываем уже принятые апдейты, затем останавливаем воркеры
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    server = WebhookServer(dp, bot, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, WEBHOOK_SECRET)
+    metrics_exporter.webhook_server = server
+    runner = web.AppRunner(server.create_app())
+    await runner.setup()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    server.start_workers()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    # Без WEBHOOK_URL вебхук в Telegram не регистрируется (например, при локальной проверке или
+    # когда его уже зарегистрировал другой экземпляр бота за тем же прокси)
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    logger.info(f"Бот запущен. Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, "
+                f"воркеров: {WEBHOOK_WORKERS}, очередь: {WEBHOOK_QUEUE_SIZE}.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await server.stop_workers()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
 
+# --- Главная функция запуска бота ---
+async def main():
+    bot = Bot(token=BOT_TOKEN)
+    bot.session.middleware(bot_api_metrics)
+    dp = create_dispatcher()
+
+    # Создание таблиц до начала обработки обновлений
+    await init_db()
+
+    metrics_runner = await metrics_exporter.start(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
     # Запуск бота
-    logger.info("Бот запущен. Начинаю опрос...")
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            logger.info("Бот запущен. Начинаю опрос...")
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":